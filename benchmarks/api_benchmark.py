@@ -0,0 +1,132 @@
+""" Measures ConqueryConnection end to end against a local FakeConquery server.
+
+Run from the repository root with `python -m benchmarks.api_benchmark`, or as part of `python -m benchmarks.run`.
+"""
+from benchmarks.fake_server import FakeConquery
+from cqapi import ConqueryConnection
+import asyncio
+import time
+
+QUERY = {'type': 'CONCEPT_QUERY', 'root': {'type': 'CONCEPT', 'ids': ['demo.c0']}}
+
+
+async def _timed(call):
+    start = time.perf_counter()
+    result = await call()
+    return time.perf_counter() - start, result
+
+
+async def single_query(result_rows, latency=0.002, query_seconds=0.05):
+    """ Execute a query, poll until it is done, download and parse its result. """
+    async with FakeConquery(latency=latency, query_seconds=query_seconds, result_rows=result_rows) as server:
+        async with ConqueryConnection(server.url, check_connection=False) as cq:
+            async def run():
+                query_id = await cq.execute_query('demo', QUERY)
+                return await cq.get_query_result('demo', query_id)
+
+            seconds, rows = await _timed(run)
+            stats = cq.transfer_stats
+            return {
+                'result_rows': result_rows,
+                'seconds': seconds,
+                'rows_per_second': len(rows) / seconds,
+                'requests': server.requests,
+                'wire_bytes': stats.wire_bytes,
+                'decoded_bytes': stats.decoded_bytes,
+            }
+
+
+async def columnar_result(result_rows, latency=0.002):
+    """ Download a result and decode it into typed columns. """
+    async with FakeConquery(latency=latency, result_rows=result_rows) as server:
+        async with ConqueryConnection(server.url, check_connection=False) as cq:
+            query_id = await cq.execute_query('demo', QUERY)
+            seconds, __ = await _timed(lambda: cq.get_query_result_columns('demo', query_id))
+            return {'result_rows': result_rows, 'seconds': seconds, 'rows_per_second': result_rows / seconds}
+
+
+async def bulk_queries(query_count, max_concurrency, latency=0.002, query_seconds=0.05, shared_polling=False):
+    """ Execute many queries concurrently and fetch all of their results. """
+    async with FakeConquery(latency=latency, query_seconds=query_seconds, result_rows=100) as server:
+        async with ConqueryConnection(server.url, check_connection=False, shared_polling=shared_polling) as cq:
+            queries = [dict(QUERY, label=f"q{i}") for i in range(query_count)]
+            seconds, results = await _timed(lambda: cq.execute_many('demo', queries, max_concurrency))
+            assert not any(isinstance(result, BaseException) for result in results)
+            return {
+                'queries': query_count,
+                'max_concurrency': max_concurrency,
+                'shared_polling': shared_polling,
+                'seconds': seconds,
+                'queries_per_second': query_count / seconds,
+                'requests': server.requests,
+            }
+
+
+async def concept_crawl(width, depth, max_concurrency, latency=0.002):
+    """ Fetch the concept catalog and crawl all concept hierarchies. """
+    async with FakeConquery(latency=latency, concept_width=width, concept_depth=depth) as server:
+        async with ConqueryConnection(server.url, check_connection=False) as cq:
+            async def crawl():
+                return [node async for node in cq.crawl_concepts('demo', max_concurrency=max_concurrency)]
+
+            seconds, nodes = await _timed(crawl)
+            assert len(nodes) == len(server.concepts)
+            return {
+                'nodes': len(nodes),
+                'max_concurrency': max_concurrency,
+                'seconds': seconds,
+                'nodes_per_second': len(nodes) / seconds,
+            }
+
+
+async def stored_queries(count, max_concurrency, latency=0.002):
+    """ Fetch the definitions of all stored queries of a dataset. """
+    async with FakeConquery(latency=latency, stored_queries=count) as server:
+        async with ConqueryConnection(server.url, check_connection=False) as cq:
+            async def fetch():
+                listing = await cq.get_stored_queries('demo')
+                return [item async for item in cq.iter_stored_queries('demo', [entry['id'] for entry in listing],
+                                                                      max_concurrency)]
+
+            seconds, fetched = await _timed(fetch)
+            return {
+                'stored_queries': len(fetched),
+                'max_concurrency': max_concurrency,
+                'seconds': seconds,
+                'queries_per_second': len(fetched) / seconds,
+            }
+
+
+async def run_all(quick=False):
+    """ Run all scenarios.
+
+    :param quick: use small sizes, to check that the benchmarks work rather than to measure.
+    :return: dict from scenario name to list of results.
+    """
+    scale = 10 if quick else 1
+    results = {
+        'single_query': [await single_query(rows // scale) for rows in (10000, 100000, 1000000)],
+        'bulk_queries': [await bulk_queries(200 // scale, concurrency, shared_polling=shared_polling)
+                         for concurrency in (8, 32) for shared_polling in (False, True)],
+        'concept_crawl': [await concept_crawl(10, 3 if not quick else 2, concurrency) for concurrency in (1, 16)],
+        'stored_queries': [await stored_queries(1000 // scale, concurrency) for concurrency in (1, 16)],
+    }
+    if columnar_available():
+        results['columnar_result'] = [await columnar_result(rows // scale) for rows in (100000, 1000000)]
+    return results
+
+
+def columnar_available():
+    try:
+        import numpy
+    except ImportError:
+        return False
+    return True
+
+
+if __name__ == '__main__':
+    for name, results in asyncio.get_event_loop().run_until_complete(run_all()).items():
+        print(name)
+        for result in results:
+            print('  ' + ', '.join(f"{key}={value:.4g}" if isinstance(value, float) else f"{key}={value}"
+                                   for key, value in result.items()))
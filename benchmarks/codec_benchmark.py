@@ -0,0 +1,116 @@
+""" Compares decoding a concept catalog eagerly with each installed JSON codec with lazily decoding it as LazyObject, in
+time and in the memory the decoded catalog keeps.
+
+Run from the repository root with `python -m benchmarks.codec_benchmark`.
+"""
+from cqapi.codec import LazyObject, available_codecs, get_codec
+import json
+import time
+import tracemalloc
+
+
+def concept_catalog(concept_count):
+    """ UTF-8 encoded get_concepts response with concept_count tree concepts of two tables each. """
+    concepts = {}
+    for i in range(concept_count):
+        concept_id = f'demo.concept{i}'
+        concepts[concept_id] = {
+            'label': f'Ärztliche Leistung {i}',
+            'type': 'TREE',
+            'active': True,
+            'children': [f'{concept_id}.child{j}' for j in range(5)],
+            'tables': [{
+                'id': f'{concept_id}.table{t}',
+                'connectorId': f'{concept_id}.connector{t}',
+                'label': f'Tabelle {t}',
+                'filters': [{'id': f'{concept_id}.table{t}.filter{k}', 'label': 'Filter', 'type': 'SELECT',
+                             'options': [{'label': 'ja', 'value': 'j'}, {'label': 'nein', 'value': 'n'}]}
+                            for k in range(3)],
+                'selects': [{'id': f'{concept_id}.table{t}.select{k}', 'label': 'Select'} for k in range(3)],
+            } for t in range(2)],
+            'selects': [{'id': f'{concept_id}.select{k}', 'label': 'Select', 'resultType': {'type': 'STRING'}}
+                        for k in range(2)],
+        }
+    return json.dumps({'concepts': concepts}, ensure_ascii=False).encode('utf-8')
+
+
+def measure(decode, repeat):
+    """ Best time of decode over repeat runs and the memory its result keeps allocated. """
+    seconds = []
+    for __ in range(repeat):
+        start = time.perf_counter()
+        decode()
+        seconds.append(time.perf_counter() - start)
+    tracemalloc.start()
+    result = decode()
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return min(seconds), retained
+
+
+def run(concept_count, repeat=3):
+    body = concept_catalog(concept_count)
+    keys = [f'demo.concept{i}' for i in (0, concept_count // 2, concept_count - 1)]
+    codec = get_codec()
+
+    def lazy_concepts():
+        return LazyObject(body, codec).lazy('concepts')
+
+    def lazy_lookup(key):
+        def lookup():
+            concepts = lazy_concepts()
+            concepts[key]
+            return concepts
+        return lookup
+
+    def lazy_scan_all():
+        concepts = lazy_concepts()
+        len(concepts)
+        return concepts
+
+    def lazy_decode_all():
+        concepts = lazy_concepts()
+        for key in concepts:
+            concepts[key]
+        return concepts
+
+    scenarios = {f'eager_{name}': (lambda loads=get_codec(name).loads: loads(body)) for name in available_codecs()}
+    scenarios.update({
+        'lazy_first_key': lazy_lookup(keys[0]),
+        'lazy_middle_key': lazy_lookup(keys[1]),
+        'lazy_last_key': lazy_lookup(keys[2]),
+        'lazy_scan_all': lazy_scan_all,
+        'lazy_decode_all': lazy_decode_all,
+    })
+    results = {'concepts': concept_count, 'body_bytes': len(body), 'lazy_codec': codec.name}
+    for name, decode in scenarios.items():
+        seconds, retained = measure(decode, repeat)
+        results[f'{name}_seconds'] = seconds
+        results[f'{name}_retained_bytes'] = retained
+    return results
+
+
+CATALOG_SIZES = [1000, 10000]
+
+
+def run_all(quick=False):
+    """ Run the catalog benchmark.
+
+    :param quick: use small sizes, to check that the benchmark works rather than to measure.
+    :return: dict from benchmark name to list of results.
+    """
+    scale = 10 if quick else 1
+    return {'concept_catalog': [run(concept_count // scale) for concept_count in CATALOG_SIZES]}
+
+
+if __name__ == '__main__':
+    for result in run_all()['concept_catalog']:
+        print(f"{result['concepts']} concepts, {result['body_bytes'] / 2 ** 20:.1f} MiB, lazy members decoded with "
+              f"{result['lazy_codec']}")
+        print(f"{'scenario':>16} {'time [s]':>9} {'retained [MiB]':>15}")
+        for key in result:
+            if key.endswith('_seconds'):
+                name = key[:-len('_seconds')]
+                print(f"{name:>16} {result[key]:>9.3f} {result[f'{name}_retained_bytes'] / 2 ** 20:>15.1f}")
+        print()
@@ -0,0 +1,154 @@
+""" A local stand-in for the Conquery REST API to benchmark cqapi against.
+
+Serves a synthetic dataset with a concept hierarchy, stored queries and queries that take a configurable time to run
+and return results of a configurable size. Every response is delayed by a configurable latency.
+"""
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+import asyncio
+import itertools
+import time
+
+
+class FakeConquery(object):
+    """ Fake Conquery server, started and stopped as async context manager.
+
+    :example:
+    >>> async with FakeConquery(latency=0.005, query_seconds=0.1, result_rows=10000) as server:
+    ...     async with ConqueryConnection(server.url) as cq:
+    ...         ...
+    """
+
+    def __init__(self, latency=0.0, query_seconds=0.0, result_rows=1000, concept_width=10, concept_depth=3,
+                 stored_queries=100, dataset='demo'):
+        """
+        :param latency: seconds every response is delayed by.
+        :param query_seconds: seconds a query is RUNNING after its execution.
+        :param result_rows: number of rows of every query result.
+        :param concept_width: number of top-level concepts and of children of every concept node.
+        :param concept_depth: number of levels below the top-level concepts.
+        :param stored_queries: number of stored queries of the dataset.
+        :param dataset: id of the only dataset.
+        """
+        self.latency = latency
+        self.query_seconds = query_seconds
+        self.result_rows = result_rows
+        self.dataset = dataset
+        self.concepts = self._create_concepts(concept_width, concept_depth)
+        self.stored_queries = {
+            f"{dataset}.stored{i}": {'type': 'CONCEPT_QUERY', 'root': {'type': 'CONCEPT', 'ids': [f"{dataset}.c{i}"]}}
+            for i in range(stored_queries)
+        }
+        # query id -> time of its execution
+        self.executions = {}
+        self.requests = 0
+        self._ids = itertools.count()
+        self._server = None
+
+    @property
+    def url(self):
+        return str(self._server.make_url('')).rstrip('/')
+
+    async def __aenter__(self):
+        app = web.Application()
+        routes = [
+            ('GET', '/api/datasets', self._datasets),
+            ('GET', '/api/datasets/{dataset}/concepts', self._concept_catalog),
+            ('GET', '/api/datasets/{dataset}/concepts/{concept_id}', self._concept),
+            ('GET', '/api/datasets/{dataset}/stored-queries', self._stored_query_listing),
+            ('GET', '/api/datasets/{dataset}/stored-queries/{query_id}', self._stored_query),
+            ('POST', '/api/datasets/{dataset}/queries', self._execute),
+            ('GET', '/api/datasets/{dataset}/queries/{query_id}', self._status),
+            ('GET', '/api/datasets/{dataset}/result/{query_id}.csv', self._result),
+        ]
+        for method, path, handler in routes:
+            app.router.add_route(method, path, self._delayed(handler))
+        self._server = TestServer(app)
+        await self._server.start_server()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self._server.close()
+
+    def _create_concepts(self, width, depth):
+        concepts = {}
+
+        def add(concept_id, level):
+            children = [f"{concept_id}.{i}" for i in range(width)] if level < depth else []
+            concepts[concept_id] = {
+                'label': f"Concept {concept_id}",
+                'children': children,
+                'tables': [{'id': f"{concept_id}.table", 'connectorId': f"{concept_id}.connector",
+                            'selects': [{'id': f"{concept_id}.connector.select{i}"} for i in range(3)]}],
+            }
+            for child_id in children:
+                add(child_id, level + 1)
+
+        for i in range(width):
+            add(f"{self.dataset}.c{i}", 0)
+        return concepts
+
+    def _delayed(self, handler):
+        async def delayed(request):
+            self.requests += 1
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            return await handler(request)
+
+        return delayed
+
+    async def _datasets(self, request):
+        return web.json_response([{'id': self.dataset, 'label': self.dataset}])
+
+    async def _concept_catalog(self, request):
+        top_level = {concept_id: concept for concept_id, concept in self.concepts.items() if concept_id.count('.') == 1}
+        return web.json_response({'concepts': top_level})
+
+    async def _concept(self, request):
+        concept_id = request.match_info['concept_id']
+        if concept_id not in self.concepts:
+            raise web.HTTPNotFound()
+        return web.json_response({concept_id: self.concepts[concept_id]})
+
+    async def _stored_query_listing(self, request):
+        # like Conquery, the listing shows the stored queries and the executions along with their status
+        listing = [{'id': query_id, 'label': query_id, 'createdAt': '2019-08-05T19:03:03', 'status': 'DONE'}
+                   for query_id in self.stored_queries]
+        listing.extend({'id': query_id, 'label': query_id, 'status': self._status_of(query_id)}
+                       for query_id in self.executions)
+        return web.json_response(listing)
+
+    async def _stored_query(self, request):
+        query_id = request.match_info['query_id']
+        return web.json_response({'id': query_id, 'query': self.stored_queries[query_id]})
+
+    async def _execute(self, request):
+        await request.json()
+        query_id = f"{self.dataset}.q{next(self._ids)}"
+        self.executions[query_id] = time.monotonic()
+        return web.json_response({'id': query_id})
+
+    async def _status(self, request):
+        query_id = request.match_info['query_id']
+        response = {'id': query_id, 'status': self._status_of(query_id)}
+        if response['status'] == 'DONE':
+            response['resultUrl'] = f"{self.url}/api/datasets/{self.dataset}/result/{query_id}.csv"
+        return web.json_response(response)
+
+    def _status_of(self, query_id):
+        return 'DONE' if time.monotonic() - self.executions[query_id] >= self.query_seconds else 'RUNNING'
+
+    async def _result(self, request):
+        response = web.StreamResponse(headers={'Content-Type': 'text/csv'})
+        response.enable_compression()
+        await response.prepare(request)
+        await response.write(b'result;dates;count;label\n')
+        batch = []
+        for i in range(self.result_rows):
+            batch.append(f"{i}|ID{i};{{2005-01-01/2005-03-31}};{i % 97};Label {i % 13}\n")
+            if len(batch) == 1000:
+                await response.write(''.join(batch).encode('utf-8'))
+                batch = []
+        await response.write(''.join(batch).encode('utf-8'))
+        await response.write_eof()
+        return response
@@ -0,0 +1,109 @@
+""" Compares the copy-on-write query rewrites with the former deepcopy-per-level implementation, and chained rewrites
+with a single fused apply_edits traversal.
+
+Run from the repository root with `python -m benchmarks.rewrite_benchmark`.
+"""
+from copy import deepcopy
+from cqapi import util
+import timeit
+
+
+def deepcopy_add_selects(query, target_concept_id, selects):
+    """ add_selects_to_concept_query as implemented before the copy-on-write rewrite. """
+    query_object = deepcopy(query)
+    node_type = query_object.get('type')
+    if node_type == 'CONCEPT_QUERY':
+        query_object['root'] = deepcopy_add_selects(query_object.get('root'), target_concept_id, selects)
+    elif node_type in ('AND', 'OR'):
+        query_object['children'] = [deepcopy_add_selects(child, target_concept_id, selects)
+                                    for child in query_object.get('children')]
+    elif node_type in ('NEGATION', 'DATE_RESTRICTION'):
+        query_object['child'] = deepcopy_add_selects(query_object.get('child'), target_concept_id, selects)
+    elif node_type == 'CONCEPT' and target_concept_id in query_object.get('ids'):
+        query_object['selects'] = query_object.get('selects', []) + selects
+    return query_object
+
+
+def or_tree(concept_count, depth):
+    """ A CONCEPT_QUERY with `depth` nested AND nodes above an OR over `concept_count` CONCEPT nodes. """
+    node = {
+        'type': 'OR',
+        'children': [
+            {'type': 'CONCEPT', 'ids': [f'concept.{i}'], 'label': f'Concept {i}', 'tables': [{'id': f'table.{i}'}]}
+            for i in range(concept_count)
+        ]
+    }
+    for _ in range(depth):
+        node = {'type': 'AND', 'children': [node]}
+    return {'type': 'CONCEPT_QUERY', 'root': node}
+
+
+def run(concept_count, depth, repeat=5):
+    query = or_tree(concept_count, depth)
+    target = f'concept.{concept_count // 2}'
+    assert deepcopy_add_selects(query, target, ['select']) == util.add_selects_to_concept_query(query, target, ['select'])
+
+    baseline = min(timeit.repeat(lambda: deepcopy_add_selects(query, target, ['select']), number=1, repeat=repeat))
+    copy_on_write = min(timeit.repeat(lambda: util.add_selects_to_concept_query(query, target, ['select']),
+                                      number=1, repeat=repeat))
+    return {
+        'concepts': concept_count,
+        'depth': depth,
+        'deepcopy_seconds': baseline,
+        'copy_on_write_seconds': copy_on_write,
+        'speedup': baseline / copy_on_write
+    }
+
+
+def run_fused(concept_count, edit_count, repeat=5):
+    query = or_tree(concept_count, 1)
+    edits = [util.AddSelects(f'concept.{i}', ['select']) for i in range(0, concept_count, concept_count // edit_count)]
+
+    def chained():
+        edited = query
+        for edit in edits:
+            edited = util.add_selects_to_concept_query(edited, *edit)
+        return edited
+
+    assert chained() == util.apply_edits(query, edits)
+    chained_seconds = min(timeit.repeat(chained, number=1, repeat=repeat))
+    fused_seconds = min(timeit.repeat(lambda: util.apply_edits(query, edits), number=1, repeat=repeat))
+    return {
+        'concepts': concept_count,
+        'edits': len(edits),
+        'chained_seconds': chained_seconds,
+        'fused_seconds': fused_seconds,
+        'speedup': chained_seconds / fused_seconds
+    }
+
+
+REWRITE_SIZES = [(100, 1), (1000, 1), (1000, 10), (5000, 10)]
+FUSED_SIZES = [(1000, 20), (5000, 20), (5000, 100)]
+
+
+def run_all(quick=False):
+    """ Run all rewrite benchmarks.
+
+    :param quick: use small sizes, to check that the benchmarks work rather than to measure.
+    :return: dict from benchmark name to list of results.
+    """
+    scale = 10 if quick else 1
+    return {
+        'rewrite': [run(concept_count // scale, depth) for concept_count, depth in REWRITE_SIZES],
+        'apply_edits': [run_fused(concept_count // scale, edit_count // scale)
+                        for concept_count, edit_count in FUSED_SIZES],
+    }
+
+
+if __name__ == '__main__':
+    results = run_all()
+    print(f"{'concepts':>8} {'depth':>5} {'deepcopy [s]':>12} {'cow [s]':>10} {'speedup':>8}")
+    for result in results['rewrite']:
+        print(f"{result['concepts']:>8} {result['depth']:>5} {result['deepcopy_seconds']:>12.4f} "
+              f"{result['copy_on_write_seconds']:>10.4f} {result['speedup']:>7.1f}x")
+
+    print()
+    print(f"{'concepts':>8} {'edits':>5} {'chained [s]':>12} {'fused [s]':>10} {'speedup':>8}")
+    for result in results['apply_edits']:
+        print(f"{result['concepts']:>8} {result['edits']:>5} {result['chained_seconds']:>12.4f} "
+              f"{result['fused_seconds']:>10.4f} {result['speedup']:>7.1f}x")
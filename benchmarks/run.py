@@ -0,0 +1,45 @@
+""" Runs all benchmarks and writes their results as JSON, to track performance across versions.
+
+Run from the repository root with `python -m benchmarks.run --output results.json`. Pass `--quick` to check that the
+benchmarks work without waiting for meaningful measurements.
+"""
+from benchmarks import api_benchmark
+from benchmarks import codec_benchmark
+from benchmarks import rewrite_benchmark
+from cqapi.version import __version__
+import argparse
+import asyncio
+import datetime
+import json
+import platform
+import sys
+
+
+def run(quick=False):
+    return {
+        'cqapi_version': __version__,
+        'python_version': platform.python_version(),
+        'platform': platform.platform(),
+        'started_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'quick': quick,
+        'benchmarks': {
+            'api': asyncio.get_event_loop().run_until_complete(api_benchmark.run_all(quick)),
+            'rewrite': rewrite_benchmark.run_all(quick),
+            'codec': codec_benchmark.run_all(quick),
+        },
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--output', help="file to write the results to, stdout by default")
+    parser.add_argument('--quick', action='store_true', help="run with small sizes")
+    args = parser.parse_args()
+
+    results = run(args.quick)
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
@@ -1,3 +1,22 @@
 from .api import ConqueryConnection
+from .api import create_session
+from .api import CircuitOpenError
 from .api import ConqueryClientConnectionError
+from .api import ConqueryResponseError
+from .api import ConqueryServerError
+from .api import QueryFailedError
+from .api import QueryTimeoutError
+from .cache import ConceptCache
+from .cache import ConceptSnapshot
+from .cache import ResultCache
+from .cache import StoredQueryMirror
+from .limiter import AdaptiveLimiter
+from .metrics import InMemoryMetrics
+from .metrics import Metrics
+from .metrics import OpenTelemetryMetrics
+from .metrics import PrometheusMetrics
+from .polling import Backoff
+from .retry import RetryPolicy
+from .template import Placeholder
+from .template import QueryTemplate
 from .util import *
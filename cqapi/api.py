@@ -1,108 +1,1139 @@
 from aiohttp import ClientSession
 from aiohttp import ClientConnectorError
+from aiohttp import ClientTimeout
+from aiohttp import TCPConnector
+from collections import OrderedDict, deque
 from cqapi import util
-import csv
+from cqapi.cache import ConceptCache, ConceptSnapshot, ResultCache, StoredQueryMirror, canonical_query_key
+from cqapi.codec import JsonCodec, STDLIB_CODEC, get_codec, lazy_codec
+from cqapi.columnar import ColumnarDecoder
+from cqapi.download import MIN_RANGE_BYTES, download_ranges, iter_resumable
+from cqapi.encoding import ACCEPT_ENCODING, StreamDecoder, TransferStats
+from cqapi.errors import CqApiError, CircuitOpenError, ConqueryClientConnectionError, ConqueryResponseError
+from cqapi.errors import ConqueryServerError
+from cqapi.errors import QueryFailedError, QueryTimeoutError
+from cqapi.export import TableWriter, EXPORT_FORMATS
+from cqapi.limiter import NO_LIMIT, default_limiters
+from cqapi.metrics import Metrics, NULL_METRICS, trace_config, endpoint
+from cqapi.metrics import BODY_SECONDS, CANCELS, DECODED_BYTES, PARSE_SECONDS, POLLS, POLLS_PER_QUERY
+from cqapi.metrics import QUERY_WAIT_SECONDS, WIRE_BYTES
+from cqapi.polling import Backoff, FAILED_QUERY_STATES, query_status
+from cqapi.poller import StatusPoller
+from cqapi.results import CsvRowDecoder
+from cqapi.retry import RetryPolicy
+from cqapi.singleflight import SingleFlight
+import asyncio
+import os
+import tempfile
+import time
+import uuid
 
-class CqApiError(BaseException):
-    pass
 
+def create_session(limit=100, limit_per_host=0, keepalive_timeout=15, dns_cache_ttl=10, connect_timeout=5,
+                   read_timeout=5, metrics: Metrics=None):
+    """ Creates a ClientSession with a configured connection pool.
 
-class ConqueryClientConnectionError(CqApiError):
-    def __init__(self, msg):
-        self.message = msg
+    The session can be passed to several ConqueryConnections to share its pool. It has to be created within a running
+    event loop and closed by its creator.
 
+    :param limit: maximum number of simultaneous connections, 0 for no limit.
+    :param limit_per_host: maximum number of simultaneous connections to the same host, 0 for no limit.
+    :param keepalive_timeout: seconds to keep idle connections open for reuse.
+    :param dns_cache_ttl: seconds to cache resolved host names, None to cache them forever.
+    :param connect_timeout: timeout in seconds for establishing a connection, None for no timeout.
+    :param read_timeout: timeout in seconds between two reads from a connection, None for no timeout.
+    :param metrics: Metrics to record the DNS resolution, connection and time to first byte of every request in, see
+        `cqapi.metrics.trace_config`.
+    :return: aiohttp.ClientSession, leaving the decompression of responses to cqapi's request helpers.
+    """
+    connector = TCPConnector(limit=limit, limit_per_host=limit_per_host, keepalive_timeout=keepalive_timeout,
+                             ttl_dns_cache=dns_cache_ttl)
+    timeout = ClientTimeout(total=None, sock_connect=connect_timeout, sock_read=read_timeout)
+    trace_configs = [trace_config(metrics)] if metrics is not None and metrics.enabled else None
+    # responses are decompressed by cqapi while they are read, to count the bytes received over the network
+    return ClientSession(connector=connector, timeout=timeout, auto_decompress=False, trace_configs=trace_configs)
 
-async def get(session, url):
-    async with session.get(url) as response:
-        return await response.json()
 
+# prefix of the ids execute_query returns for queries whose result is in the result cache
+CACHED_RESULT_PREFIX = 'cqapi-cache.'
+# number of cached query ids whose queries are remembered, to execute them if their result is evicted from the cache
+MAX_CACHED_QUERIES = 4096
+# number of executions shared with identical queries at most, and seconds each one is shared at most, as Conquery
+# eventually deletes executions
+MAX_COALESCED_EXECUTIONS = 4096
+COALESCED_EXECUTION_SECONDS = 3600
 
-async def get_text(session, url):
-    async with session.get(url) as response:
-        return await response.text()
 
+async def get(session, url, stats: TransferStats=None, codec: JsonCodec=None, metrics: Metrics=None):
+    async with session.get(url, headers=_request_headers(session)) as response:
+        await _raise_for_server_error(session, response)
+        return await _read_json(session, response, stats, codec, metrics)
 
-async def post(session, url, data):
-    async with session.post(url, json=data) as response:
-        return await response.json()
+
+async def get_text(session, url, stats: TransferStats=None, metrics: Metrics=None):
+    async with session.get(url, headers=_request_headers(session)) as response:
+        await _raise_for_server_error(session, response)
+        body = await _read_body(session, response, stats, metrics)
+        return body.decode(response.charset or 'utf-8')
+
+
+async def get_conditional(session, url, etag=None, last_modified=None, stats: TransferStats=None,
+                          codec: JsonCodec=None, metrics: Metrics=None):
+    """ GET json unless it is unchanged since it was fetched with the given ETag or Last-Modified header.
+
+    :return: tuple of the response body (None if unchanged), ETag and Last-Modified header.
+    """
+    headers = _request_headers(session)
+    if etag is not None:
+        headers['If-None-Match'] = etag
+    if last_modified is not None:
+        headers['If-Modified-Since'] = last_modified
+    async with session.get(url, headers=headers) as response:
+        await _raise_for_server_error(session, response)
+        if response.status == 304:
+            return None, etag, last_modified
+        return (await _read_json(session, response, stats, codec, metrics), response.headers.get('ETag'),
+                response.headers.get('Last-Modified'))
+
+
+async def get_chunks(session, url, chunk_size=2**16, stats: TransferStats=None, start=0, end=None,
+                     metrics: Metrics=None):
+    """ GET the body at url in chunks, or only the byte range from start to end.
+
+    Byte ranges are requested uncompressed, as ranges of compressed bodies cannot be decoded on their own. Servers not
+    supporting range requests send the whole body, which is cut down to the range.
+
+    :raises ConqueryResponseError: if the server did not respond with the body, e.g. as the result expired (404).
+    """
+    headers = _request_headers(session)
+    if start or end is not None:
+        headers['Accept-Encoding'] = 'identity'
+        headers['Range'] = f"bytes={start}-{'' if end is None else end - 1}"
+    async with session.get(url, headers=headers) as response:
+        await _raise_for_server_error(session, response)
+        if response.status == 416:
+            # nothing left after start
+            return
+        if not 200 <= response.status < 300:
+            raise ConqueryResponseError(await _error_message(session, response), response.status)
+        skip = start if response.status != 206 else 0
+        remaining = end - start if end is not None else None
+        async for chunk in _iter_body(session, response, chunk_size, stats, metrics):
+            if skip:
+                skipped = min(skip, len(chunk))
+                chunk = chunk[skipped:]
+                skip -= skipped
+            if remaining is not None:
+                chunk = chunk[:remaining]
+                remaining -= len(chunk)
+            if chunk:
+                yield chunk
+            if remaining == 0:
+                return
+
+
+async def get_content_length(session, url):
+    """ Length of the body at url, if the server supports range requests for it.
+
+    :return: the length in bytes, or None if range requests are not supported.
+    """
+    headers = {'Range': 'bytes=0-0', 'Accept-Encoding': 'identity'}
+    async with session.get(url, headers=headers) as response:
+        await _raise_for_server_error(session, response)
+        if response.status != 206:
+            return None
+        # Content-Range: bytes 0-0/<length>
+        length = response.headers.get('Content-Range', '').rpartition('/')[2]
+        return int(length) if length.isdigit() else None
+
+
+async def post(session, url, data, stats: TransferStats=None, codec: JsonCodec=None, metrics: Metrics=None):
+    codec = codec if codec is not None else STDLIB_CODEC
+    headers = dict(_request_headers(session), **{'Content-Type': 'application/json'})
+    body = codec.dumps(data) if data is not None else None
+    async with session.post(url, data=body, headers=headers) as response:
+        await _raise_for_server_error(session, response)
+        return await _read_json(session, response, stats, codec, metrics)
+
+
+async def _raise_for_server_error(session, response):
+    """ Raises a ConqueryServerError if the server failed (5xx) or is overloaded (429). """
+    if response.status != 429 and response.status < 500:
+        return
+    retry_after = response.headers.get('Retry-After', '')
+    raise ConqueryServerError(await _error_message(session, response), response.status,
+                              float(retry_after) if retry_after.isdigit() else None)
+
+
+async def _error_message(session, response):
+    body = await _read_body(session, response, None)
+    return f"Conquery responded with {response.status} {response.reason}: {body[:200].decode('utf-8', 'replace')}"
+
+
+def _decodes_content(session):
+    """ Whether response bodies of the session are still compressed and have to be decoded by cqapi. """
+    return not getattr(session, 'auto_decompress', getattr(session, '_auto_decompress', True))
+
+
+def _request_headers(session):
+    if _decodes_content(session):
+        return {'Accept-Encoding': ACCEPT_ENCODING}
+    return {}
+
+
+async def _iter_body(session, response, chunk_size, stats, metrics=None):
+    """ Iterates over the decoded body of a response, counting the received bytes in stats and metrics. """
+    decoder = StreamDecoder(response.headers.get('Content-Encoding')) if _decodes_content(session) else None
+    if stats is not None:
+        stats.responses += 1
+    measured = metrics is not None and metrics.enabled
+    start = time.perf_counter() if measured else None
+    wire_bytes = decoded_bytes = 0
+    try:
+        async for chunk in response.content.iter_chunked(chunk_size):
+            decoded = decoder.decompress(chunk) if decoder is not None else chunk
+            wire_bytes += len(chunk)
+            decoded_bytes += len(decoded)
+            if stats is not None:
+                stats.wire_bytes += len(chunk)
+                stats.decoded_bytes += len(decoded)
+            if decoded:
+                yield decoded
+        if decoder is not None:
+            decoded = decoder.flush()
+            decoded_bytes += len(decoded)
+            if stats is not None:
+                stats.decoded_bytes += len(decoded)
+            if decoded:
+                yield decoded
+    finally:
+        if measured:
+            labels = {'endpoint': endpoint(response.url)}
+            metrics.observe(BODY_SECONDS, time.perf_counter() - start, labels)
+            metrics.increment(WIRE_BYTES, wire_bytes, labels)
+            metrics.increment(DECODED_BYTES, decoded_bytes, labels)
+
+
+async def _read_body(session, response, stats, metrics=None):
+    return b''.join([chunk async for chunk in _iter_body(session, response, 2**16, stats, metrics)])
+
+
+async def _read_json(session, response, stats, codec, metrics=None):
+    body = await _read_body(session, response, stats, metrics)
+    if not body.strip():
+        return None
+    codec = codec if codec is not None else STDLIB_CODEC
+    if metrics is None or not metrics.enabled:
+        return codec.loads(body)
+    start = time.perf_counter()
+    try:
+        return codec.loads(body)
+    finally:
+        metrics.observe(PARSE_SECONDS, time.perf_counter() - start, {'format': 'json'})
 
 
 class ConqueryConnection(object):
     async def __aenter__(self):
-        self._session = ClientSession()
+        if self._shared_session is not None:
+            self._session = self._shared_session
+        else:
+            self._session = create_session(self._pool_limit, self._pool_limit_per_host, self._keepalive_timeout,
+                                           self._dns_cache_ttl, self._connect_timeout, self._read_timeout,
+                                           self._metrics)
         # try to fail early if conquery is not available at self._url
         if self._check_connection:
             try:
                 await self.get_datasets()
-            except ClientConnectorError:
-                error_msg = f"Could not connect to Conquery, are you sure {self._url} is the right address?"
-                raise ConqueryClientConnectionError(error_msg)
+            except BaseException as e:
+                # __aexit__ is not called if entering fails
+                if self._shared_session is None:
+                    await self._session.close()
+                if isinstance(e, ClientConnectorError):
+                    error_msg = f"Could not connect to Conquery, are you sure {self._url} is the right address?"
+                    raise ConqueryClientConnectionError(error_msg)
+                raise
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        await self._session.close()
+        # coalesced calls run in tasks of their own, which would outlive the connection
+        for flights in (self._coalesced_results, self._coalesced_executions):
+            if flights is not None:
+                await flights.cancel()
+        if self._cancel_on_exit:
+            await asyncio.gather(*[self._cancel_execution(dataset, query_id, 'exit')
+                                   for query_id, dataset in list(self._running_executions.items())])
+        # let cancellations of abandoned queries finish before the session is closed
+        if self._cancellations:
+            await asyncio.gather(*self._cancellations)
+        try:
+            if self._poller is not None:
+                await self._poller.close()
+        finally:
+            # a shared session is closed by its owner
+            if self._shared_session is None:
+                await self._session.close()
 
-    def __init__(self, url, requests_timout=5, check_connection = True):
+    def __init__(self, url, requests_timout=5, check_connection = True, poll_backoff: Backoff=None,
+                 query_timeout: float=None, shared_polling=False, poll_concurrency=8,
+                 concept_cache: ConceptCache=None, pool_limit=100, pool_limit_per_host=0, keepalive_timeout=15,
+                 dns_cache_ttl=10, connect_timeout: float=None, read_timeout: float=None,
+                 session: ClientSession=None, result_cache: ResultCache=None, coalesce=False, download_retries=3,
+                 download_ranges=1, spool_directory=None, json_codec='auto', metrics: Metrics=None,
+                 cancel_abandoned=True, cancel_on_exit=False, adaptive_limits=False, retry_policy: RetryPolicy=None):
+        """
+        :param url: address (including the port) of the Conquery instance.
+        :param requests_timout: default connect and read timeout in seconds for single requests.
+        :param check_connection: fail early on entering if Conquery cannot be reached.
+        :param poll_backoff: Backoff between status polls while waiting for a query, see `cqapi.polling.Backoff`.
+        :param query_timeout: default time in seconds to wait for a query to finish, None to wait indefinitely.
+        :param shared_polling: poll all pending queries from a single background task, see `cqapi.poller.StatusPoller`.
+        :param poll_concurrency: maximum number of concurrent status requests of the shared poller.
+        :param concept_cache: cache for concept definitions, see `cqapi.cache.ConceptCache`. Pass the same instance to
+            several connections to share it.
+        :param pool_limit: maximum number of simultaneous connections, 0 for no limit.
+        :param pool_limit_per_host: maximum number of simultaneous connections to the same host, 0 for no limit.
+        :param keepalive_timeout: seconds to keep idle connections open for reuse.
+        :param dns_cache_ttl: seconds to cache resolved host names, None to cache them forever.
+        :param connect_timeout: timeout in seconds for establishing a connection, defaults to requests_timout.
+        :param read_timeout: timeout in seconds between two reads from a connection, defaults to requests_timout.
+        :param session: ClientSession to use instead of creating one, e.g. to share a pool created by
+            `create_session` with other connections. The pool settings above are ignored in that case.
+        :param result_cache: cache for query results on local disk, see `cqapi.cache.ResultCache`.
+        :param coalesce: execute identical queries only once while they are running and share their results between
+            concurrent get_query_result calls, see `cqapi.singleflight.SingleFlight`.
+        :param download_retries: maximum number of times a result download is resumed after transient failures without
+            receiving any data in between, see `cqapi.download.iter_resumable`.
+        :param download_ranges: number of byte ranges to download large results in parallel, 1 to stream results over
+            a single connection. Results downloaded in parallel are spooled to a temporary file first.
+        :param spool_directory: directory for the temporary files of parallel downloads, defaults to the system's
+            temporary directory.
+        :param json_codec: JsonCodec or name of the JSON library to encode requests and decode responses with, see
+            `cqapi.codec.get_codec`. Defaults to the fastest installed one.
+        :param metrics: Metrics to record request timings, transferred bytes, polls, waits and parse durations in, see
+            `cqapi.metrics`. The DNS resolution, connection and time to first byte of requests are only recorded on
+            sessions created by the connection or by `create_session` with the same metrics.
+        :param cancel_abandoned: cancel queries started by this connection on the server once nobody waits for them
+            anymore, because all waits for them were cancelled or timed out.
+        :param cancel_on_exit: cancel all queries started by this connection that were not seen finished on exit.
+        :param adaptive_limits: limit the concurrent query executions, status polls and result downloads with limits
+            adapting to the server's latency and errors, see `cqapi.limiter.AdaptiveLimiter`. True for
+            `cqapi.limiter.default_limiters()`, or a dict from 'execute', 'poll' and 'download' to the AdaptiveLimiter
+            of those requests. Requests of kinds missing in the dict are not limited.
+        :param retry_policy: RetryPolicy for requests failing with server errors, connection errors or timeouts, see
+            `cqapi.retry.RetryPolicy`. Defaults to retrying GET requests up to 3 times, and to opening a host's circuit
+            breaker after 5 consecutive failures. Result downloads are resumed according to download_retries instead.
+        """
         self._url = url.strip('/')
         self._check_connection = check_connection
         self._timeout = requests_timout
+        self._pool_limit = pool_limit
+        self._pool_limit_per_host = pool_limit_per_host
+        self._keepalive_timeout = keepalive_timeout
+        self._dns_cache_ttl = dns_cache_ttl
+        self._connect_timeout = connect_timeout if connect_timeout is not None else requests_timout
+        self._read_timeout = read_timeout if read_timeout is not None else requests_timout
+        self._shared_session = session
+        self._poll_backoff = poll_backoff if poll_backoff is not None else Backoff()
+        self._query_timeout = query_timeout
+        # query id -> number of status requests so far, for queries being waited for
+        self._poll_counts = {}
+        self._poller = StatusPoller(self, self._poll_backoff, poll_concurrency) if shared_polling else None
+        self._concept_cache = concept_cache
+        # dataset -> (cached concepts, ConceptIndex over them)
+        self._concept_indexes = {}
+        self._result_cache = result_cache
+        # query id -> result cache key, for executions whose result is yet to be cached
+        self._result_cache_keys = {}
+        # cached query id -> (dataset, query), to execute the query again if its result was evicted meanwhile, least
+        # recently returned first
+        self._cached_queries = OrderedDict()
+        self._coalesced_executions = SingleFlight() if coalesce else None
+        self._coalesced_results = SingleFlight() if coalesce else None
+        # query id -> coalescing key of its execution and when it was executed, oldest first
+        self._execution_keys = OrderedDict()
+        # query id -> number of execute_query calls it was returned to, for coalesced executions not seen finished
+        self._execution_holders = {}
+        self._transfer_stats = TransferStats()
+        if download_retries < 0 or download_ranges < 1:
+            raise ValueError("Invalid download settings. download_retries must not be negative and download_ranges "
+                             "must be at least 1")
+        self._download_retries = download_retries
+        self._download_ranges = download_ranges
+        self._spool_directory = spool_directory
+        self._codec = get_codec(json_codec) if isinstance(json_codec, str) else json_codec
+        self._lazy_codec = lazy_codec(self._codec)
+        self._metrics = metrics if metrics is not None else NULL_METRICS
+        self._retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self._cancel_abandoned = cancel_abandoned
+        self._cancel_on_exit = cancel_on_exit
+        # query id -> dataset, for queries started by this connection that were not seen finished yet
+        self._running_executions = {}
+        # query id -> number of coroutines waiting for it to finish
+        self._query_waiters = {}
+        # tasks cancelling abandoned queries on the server
+        self._cancellations = set()
+        if adaptive_limits is True:
+            adaptive_limits = default_limiters()
+        self._limiters = dict(adaptive_limits or {})
+        if not set(self._limiters) <= {'execute', 'poll', 'download'}:
+            raise ValueError("Invalid adaptive_limits. Keys must be 'execute', 'poll' or 'download'")
+        for limiter in self._limiters.values():
+            if limiter.metrics is None:
+                limiter.metrics = self._metrics
+
+    @property
+    def coalescing_stats(self):
+        """ Numbers of query executions and result downloads made and of those coalesced into them. """
+        if self._coalesced_executions is None:
+            return {}
+        return {
+            'executions': self._coalesced_executions.calls,
+            'coalesced_executions': self._coalesced_executions.coalesced,
+            'result_downloads': self._coalesced_results.calls,
+            'coalesced_result_downloads': self._coalesced_results.coalesced,
+        }
+
+    @property
+    def metrics(self):
+        """ The Metrics the connection records its measurements in. """
+        return self._metrics
+
+    @property
+    def limits(self):
+        """ dict from the kinds of requests with adaptive limits to their current limit. """
+        return {kind: limiter.limit for kind, limiter in self._limiters.items()}
+
+    def _retrying(self, method, url, call):
+        """ Make a request, retrying it according to the connection's RetryPolicy. """
+        return self._retry_policy.run(call, method, url, self._metrics)
+
+    def _limit(self, kind):
+        """ Slot of the adaptive limit of the given kind of requests, see `cqapi.limiter.AdaptiveLimiter.slot`. """
+        limiter = self._limiters.get(kind)
+        return limiter.slot() if limiter is not None else NO_LIMIT
+
+    @property
+    def transfer_stats(self):
+        """ TransferStats of the concept and result downloads, comparing the bytes received over the network with the
+        decompressed bytes.
+        """
+        return self._transfer_stats
 
     async def get_datasets(self):
-        response_list = await get(self._session, f"{self._url}/api/datasets")
+        url = f"{self._url}/api/datasets"
+        response_list = await self._retrying('GET', url, lambda: get(self._session, url, codec=self._codec,
+                                                                     metrics=self._metrics))
         return [d['id'] for d in response_list]
 
-    async def get_concepts(self, dataset):
-        response = await get(self._session, f"{self._url}/api/datasets/{dataset}/concepts")
+    async def get_concepts(self, dataset, lazy=False):
+        """ Returns the concepts of a dataset by concept id.
+
+        :param dataset:
+        :param lazy: return a read-only `cqapi.codec.LazyObject` that decodes each concept only once it is accessed,
+            instead of decoding the whole catalog up front.
+        """
+        url = f"{self._url}/api/datasets/{dataset}/concepts"
+        if lazy:
+            response = await self._get_concepts_json(dataset, url, self._lazy_codec, cache_key=f"{url}#lazy")
+            return response.lazy('concepts')
+        response = await self._get_concepts_json(dataset, url)
         return response['concepts']
 
     async def get_concept(self, dataset, concept_id):
-        response_dict = await get(self._session, f"{self._url}/api/datasets/{dataset}/concepts/{concept_id}")
+        response_dict = await self._get_concepts_json(dataset,
+                                                      f"{self._url}/api/datasets/{dataset}/concepts/{concept_id}")
         response_list = [dict(attrs, **{"ids": [c_id]}) for c_id, attrs in response_dict.items()]
         return response_list
 
+    async def crawl_concepts(self, dataset, roots: list=None, max_depth: int=None, max_concurrency=16,
+                             snapshot: ConceptSnapshot=None):
+        """ Fetches concept hierarchies concurrently and yields their nodes as they arrive.
+
+        Starting from the given root concepts, every node is fetched with `get_concept` unless it was already contained
+        in the response for one of its ancestors. Each node is yielded and fetched only once, even if it is reachable
+        from several roots.
+
+        :param dataset:
+        :param roots: ids of the concepts to start from, all top-level concepts of the dataset by default.
+        :param max_depth: depth of the deepest nodes to crawl, the roots having depth 0. None to crawl whole hierarchies.
+        :param max_concurrency: maximum number of concepts being fetched at the same time.
+        :param snapshot: `cqapi.cache.ConceptSnapshot` to revalidate stored concepts with instead of fetching them
+            again. It is saved once the crawl is complete.
+        :return: async iterator over tuples of concept id and concept node.
+        """
+        if roots is None:
+            roots = list(await self.get_concepts(dataset))
+
+        # ids of the nodes scheduled for fetching or already yielded
+        scheduled = set()
+        yielded = set()
+        pending = deque()
+        for concept_id in roots:
+            if concept_id not in scheduled:
+                scheduled.add(concept_id)
+                pending.append((concept_id, 0))
+
+        def fetch(item):
+            return self._fetch_concept_nodes(dataset, item[0], snapshot)
+
+        async for (concept_id, depth), nodes in _as_completed(fetch, pending, max_concurrency):
+            if isinstance(nodes, BaseException):
+                raise nodes
+            for node_id, node_depth in _nodes_by_depth(nodes, concept_id, depth):
+                if node_id in yielded or (max_depth is not None and node_depth > max_depth):
+                    continue
+                yielded.add(node_id)
+                node = nodes[node_id]
+                yield node_id, node
+                if max_depth is not None and node_depth >= max_depth:
+                    continue
+                for child_id in node.get('children') or []:
+                    if child_id not in nodes and child_id not in scheduled:
+                        scheduled.add(child_id)
+                        pending.append((child_id, node_depth + 1))
+        if snapshot is not None:
+            snapshot.save()
+
+    async def _fetch_concept_nodes(self, dataset, concept_id, snapshot):
+        url = f"{self._url}/api/datasets/{dataset}/concepts/{concept_id}"
+        if snapshot is None:
+            return await self._get_concepts_json(dataset, url)
+        entry = snapshot.get(url) or {}
+        nodes, etag, last_modified = await self._retrying('GET', url, lambda: get_conditional(
+            self._session, url, entry.get('etag'), entry.get('last_modified'), stats=self._transfer_stats,
+            codec=self._codec, metrics=self._metrics))
+        unchanged = nodes is None
+        if unchanged:
+            nodes = entry['nodes']
+        snapshot.visit(url, nodes, etag, last_modified, unchanged)
+        return nodes
+
+    def invalidate_concepts(self, dataset=None):
+        """ Drop cached concept definitions of the given dataset, or of all datasets if none is given. """
+        if self._concept_cache is not None:
+            self._concept_cache.invalidate(dataset)
+        if dataset is None:
+            self._concept_indexes.clear()
+        else:
+            self._concept_indexes.pop(dataset, None)
+
+    async def _get_concepts_json(self, dataset, url, codec: JsonCodec=None, cache_key=None):
+        codec = codec if codec is not None else self._codec
+        if self._concept_cache is None:
+            return await self._retrying('GET', url, lambda: get(self._session, url, stats=self._transfer_stats,
+                                                                codec=codec, metrics=self._metrics))
+
+        async def fetch(stale_entry):
+            etag = stale_entry.etag if stale_entry is not None else None
+            last_modified = stale_entry.last_modified if stale_entry is not None else None
+            return await self._retrying('GET', url, lambda: get_conditional(
+                self._session, url, etag, last_modified, stats=self._transfer_stats, codec=codec,
+                metrics=self._metrics))
+
+        return await self._concept_cache.fetch(cache_key or url, dataset, fetch)
+
     async def get_stored_queries(self, dataset):
-        response_list = await get(self._session, f"{self._url}/api/datasets/{dataset}/stored-queries")
+        url = f"{self._url}/api/datasets/{dataset}/stored-queries"
+        response_list = await self._retrying('GET', url, lambda: get(self._session, url, codec=self._codec,
+                                                                     metrics=self._metrics))
         return response_list
 
     async def get_stored_query(self, dataset, query_id):
-        result = await get(self._session, f"{self._url}/api/datasets/{dataset}/stored-queries/{query_id}")
+        url = f"{self._url}/api/datasets/{dataset}/stored-queries/{query_id}"
+        result = await self._retrying('GET', url, lambda: get(self._session, url, codec=self._codec,
+                                                              metrics=self._metrics))
         return result.get('query')
 
+    async def iter_stored_queries(self, dataset, query_ids, max_concurrency=16):
+        """ Fetches many stored query definitions concurrently and yields them as soon as they are available.
+
+        :param dataset:
+        :param query_ids: iterable of ids of stored queries, taken lazily.
+        :param max_concurrency: maximum number of definitions being fetched at the same time.
+        :return: async iterator over tuples of query id and query definition or the raised exception.
+        """
+        async for query_id, result in _as_completed(lambda query_id: self.get_stored_query(dataset, query_id),
+                                                    query_ids, max_concurrency):
+            yield query_id, result
+
+    async def mirror_stored_queries(self, dataset, mirror: StoredQueryMirror, max_concurrency=16,
+                                    change_fields: list=None):
+        """ Updates a local mirror of the stored queries of a dataset.
+
+        Only the definitions of queries that are new or whose listing entry changed are fetched, concurrently. Queries
+        no longer listed are removed from the mirror. The mirror is saved afterwards, unless fetching a definition
+        failed.
+
+        :param dataset:
+        :param mirror: `cqapi.cache.StoredQueryMirror` to update.
+        :param max_concurrency: maximum number of definitions being fetched at the same time.
+        :param change_fields: fields of the listing entries to compare to detect changed queries, e.g.
+            `['createdAt', 'label']`. All fields by default.
+        :return: dict with the numbers of fetched, unchanged and removed queries.
+        """
+        listing = await self.get_stored_queries(dataset)
+        entries = {}
+        for listed in listing:
+            entries[listed['id']] = {key: value for key, value in listed.items() if key != 'query'}
+
+        def changed(query_id, entry):
+            stored = mirror.entry(query_id)
+            if stored is None:
+                return True
+            if change_fields is None:
+                return stored != entry
+            return any(stored.get(field) != entry.get(field) for field in change_fields)
+
+        stats = {'fetched': 0, 'unchanged': 0, 'removed': 0}
+        to_fetch = []
+        for listed in listing:
+            query_id = listed['id']
+            if not changed(query_id, entries[query_id]):
+                stats['unchanged'] += 1
+            elif 'query' in listed:
+                # older Conquery versions list the definitions themselves
+                mirror.put(query_id, entries[query_id], listed['query'])
+                stats['fetched'] += 1
+            else:
+                to_fetch.append(query_id)
+
+        async for query_id, query in self.iter_stored_queries(dataset, to_fetch, max_concurrency):
+            if isinstance(query, (Exception, CqApiError)):
+                raise query
+            mirror.put(query_id, entries[query_id], query)
+            stats['fetched'] += 1
+
+        for query_id in [query_id for query_id in mirror if query_id not in entries]:
+            mirror.remove(query_id)
+            stats['removed'] += 1
+        mirror.save()
+        return stats
+
     async def get_query(self, dataset, query_id):
-        result = await get(self._session, f"{self._url}/api/datasets/{dataset}/queries/{query_id}")
+        url = f"{self._url}/api/datasets/{dataset}/queries/{query_id}"
+
+        async def request():
+            async with self._limit('poll'):
+                return await get(self._session, url, codec=self._codec, metrics=self._metrics)
+
+        result = await self._retrying('GET', url, request)
+        if isinstance(result, dict) and (result.get('status') == 'DONE' or result.get('status') in FAILED_QUERY_STATES):
+            self._running_executions.pop(query_id, None)
         return result
 
+    async def cancel_query(self, dataset, query_id):
+        """ Cancels the execution of a query on the server. """
+        self._running_executions.pop(query_id, None)
+        self._execution_holders.pop(query_id, None)
+        url = f"{self._url}/api/datasets/{dataset}/queries/{query_id}/cancel"
+        await self._retrying('POST', url, lambda: post(self._session, url, None, codec=self._codec,
+                                                       metrics=self._metrics))
+
+    async def _cancel_execution(self, dataset, query_id, reason):
+        """ Cancels a query started by this connection, ignoring failures as the query may have ended meanwhile. """
+        self._metrics.increment(CANCELS, labels={'reason': reason})
+        try:
+            await self.cancel_query(dataset, query_id)
+        except (Exception, CqApiError):
+            pass
+
+    def _release(self, query_id, reason):
+        """ A caller of execute_query gave up on the query, abandon it unless others still hold it. """
+        holders = self._execution_holders.get(query_id, 0)
+        if holders > 1:
+            self._execution_holders[query_id] = holders - 1
+            return
+        self._execution_holders.pop(query_id, None)
+        self._abandon(query_id, reason)
+
+    def _abandon(self, query_id, reason):
+        """ Cancel a query started by this connection in the background, once nobody waits for or holds it anymore. """
+        if not self._cancel_abandoned or query_id in self._query_waiters or query_id in self._execution_holders:
+            return
+        dataset = self._running_executions.pop(query_id, None)
+        if dataset is None:
+            return
+        self._forget_execution(query_id)
+        task = asyncio.ensure_future(self._cancel_execution(dataset, query_id, reason))
+        self._cancellations.add(task)
+        task.add_done_callback(self._cancellations.discard)
+
     async def execute_query(self, dataset, query):
-        result = await post(self._session, f"{self._url}/api/datasets/{dataset}/queries", query)
+        """ Starts the execution of a query.
+
+        With a result cache, the query is not executed if its result is cached. The returned id then refers to the
+        cached result and can only be used to get the result.
+
+        With coalescing, an identical query that is still running (its result has not been requested yet) is not
+        executed again, its id is returned instead.
+
+        :return: the id of the query execution.
+        """
+        if self._result_cache is None and self._coalesced_executions is None:
+            return await self._submit_query(dataset, query)
+
+        key = canonical_query_key(dataset, query)
+        if self._result_cache is not None and key in self._result_cache:
+            cached_query_id = CACHED_RESULT_PREFIX + key
+            self._cached_queries[cached_query_id] = (dataset, query)
+            self._cached_queries.move_to_end(cached_query_id)
+            if len(self._cached_queries) > MAX_CACHED_QUERIES:
+                self._cached_queries.popitem(last=False)
+            return cached_query_id
+
+        if self._coalesced_executions is not None:
+            self._expire_coalesced_executions()
+            query_id = await self._coalesced_executions.do(key, lambda: self._submit_query(dataset, query), keep=True)
+            if query_id not in self._execution_keys:
+                self._execution_keys[query_id] = (key, time.monotonic())
+            self._execution_holders[query_id] = self._execution_holders.get(query_id, 0) + 1
+        else:
+            query_id = await self._submit_query(dataset, query)
+        if self._result_cache is not None:
+            self._result_cache_keys[query_id] = key
+        return query_id
+
+    async def _submit_query(self, dataset, query):
+        url = f"{self._url}/api/datasets/{dataset}/queries"
+
+        async def request():
+            async with self._limit('execute'):
+                return await post(self._session, url, query, codec=self._codec, metrics=self._metrics)
+
+        result = await self._retrying('POST', url, request)
         try:
-            return result['id']
+            query_id = result['id']
         except KeyError:
             raise ValueError("Error encountered when executing query", result.get('message'), result.get('details'))
+        self._running_executions[query_id] = dataset
+        return query_id
+
+    async def wait_for_query(self, dataset, query_id, timeout: float=None):
+        """ Polls the status of a query with backoff until it is DONE.
+
+        :param dataset:
+        :param query_id:
+        :param timeout: seconds to wait at most, defaults to the connection's query_timeout.
+        :return: the query description of the finished query, see `get_query`.
+        :raises QueryFailedError: if the query is FAILED or CANCELED.
+        :raises QueryTimeoutError: if the query did not finish in time.
+        :raises ConqueryResponseError: if Conquery does not know the query, e.g. as it expired.
+
+        Queries started by this connection are cancelled on the server if the wait timed out, was cancelled or failed and
+        no other coroutine waits for them, unless the connection was created with `cancel_abandoned=False`. With
+        coalescing, they are only cancelled once all callers of execute_query they were returned to gave up on them.
+        """
+        return await self._wait_for_query(dataset, query_id, timeout)
 
-    async def get_query_result(self, dataset, query_id):
+    async def _wait_for_query(self, dataset, query_id, timeout, release=True):
+        """ wait_for_query, releasing the caller's hold on the query if the wait fails unless release is False. """
+        if timeout is None:
+            timeout = self._query_timeout
+        if self._poller is not None:
+            polling = self._poller.wait(dataset, query_id)
+        else:
+            polling = self._poll_until_done(dataset, query_id)
+        self._query_waiters[query_id] = self._query_waiters.get(query_id, 0) + 1
+        start = time.perf_counter()
+        outcome = 'error'
+        try:
+            response = await asyncio.wait_for(polling, timeout)
+            outcome = 'done'
+            return response
+        except QueryFailedError:
+            outcome = 'failed'
+            raise
+        except asyncio.TimeoutError:
+            outcome = 'timeout'
+            raise QueryTimeoutError(f"Query {query_id} did not finish within {timeout} seconds")
+        except asyncio.CancelledError:
+            outcome = 'cancelled'
+            raise
+        finally:
+            self._metrics.observe(QUERY_WAIT_SECONDS, time.perf_counter() - start, {'outcome': outcome})
+            self._metrics.observe(POLLS_PER_QUERY, self._poll_counts.get(query_id, 0))
+            self._query_waiters[query_id] -= 1
+            if not self._query_waiters[query_id]:
+                del self._query_waiters[query_id]
+                self._poll_counts.pop(query_id, None)
+            if outcome != 'done':
+                # identical queries are executed anew rather than sharing an execution that failed or was given up on
+                self._forget_coalesced_execution(query_id)
+            if outcome in ('done', 'failed'):
+                self._running_executions.pop(query_id, None)
+                self._execution_holders.pop(query_id, None)
+            elif release:
+                self._release(query_id, outcome)
+            else:
+                self._abandon(query_id, outcome)
+
+    async def _poll_until_done(self, dataset, query_id):
+        delays = self._poll_backoff.delays()
+        while True:
+            try:
+                response = await self.get_query(dataset, query_id)
+            except CircuitOpenError as e:
+                # the host failed recently, which says nothing about the query. Wait until requests are let through
+                # again, wait_for_query bounds the wait by the query timeout.
+                await asyncio.sleep(max(e.retry_after or 0, next(delays)))
+                continue
+            self._count_poll(dataset, query_id)
+            status = query_status(query_id, response)
+            if status == 'DONE':
+                return response
+            if status in FAILED_QUERY_STATES:
+                raise QueryFailedError(f"Query {query_id} ended with status {status}", status, response)
+            await asyncio.sleep(next(delays))
+
+    def _count_poll(self, dataset, query_id):
+        if query_id in self._query_waiters:
+            self._poll_counts[query_id] = self._poll_counts.get(query_id, 0) + 1
+        self._metrics.increment(POLLS, labels={'dataset': dataset})
+
+    async def get_query_result(self, dataset, query_id, timeout: float=None):
         """ Returns results for given query.
         Blocks until the query is DONE.
 
         :param dataset:
         :param query_id:
-        :return: str containing the returned csv's
+        :param timeout: seconds to wait for the query to finish, see `wait_for_query`.
+        :return: list of rows of the returned csv. With coalescing, concurrent calls for the same query share the same
+            list, which must therefore not be modified in place.
         """
-        response = await self.get_query(dataset, query_id)
-        while not response['status'] == 'DONE':
-            response = await self.get_query(dataset, query_id)
+        if self._coalesced_results is None:
+            return await self._collect_query_result(dataset, query_id, timeout)
 
-        result_string = await self._download_query_results(response["resultUrl"])
-        return list(csv.reader(result_string.splitlines(), delimiter=';'))
+        # the shared download does not give up on the query on behalf of its callers, each caller does so itself
+        try:
+            return await self._coalesced_results.do(
+                (dataset, query_id), lambda: self._collect_query_result(dataset, query_id, timeout, release=False))
+        except asyncio.CancelledError:
+            self._release(query_id, 'cancelled')
+            raise
+        except QueryTimeoutError:
+            self._release(query_id, 'timeout')
+            raise
+        except (Exception, CqApiError):
+            self._release(query_id, 'error')
+            raise
+
+    async def _collect_query_result(self, dataset, query_id, timeout, release=True):
+        return [row async for rows in self._iter_result_batches(dataset, query_id, timeout, release) for row in rows]
 
-    async def _download_query_results(self, url):
-        return await get_text(self._session, url)
+    async def iter_query_result(self, dataset, query_id, timeout: float=None):
+        """ Iterates over the result rows of a given query as they are downloaded.
+        Blocks until the query is DONE.
 
-    async def create_concept_query_with_selects(self, dataset: str, concept_id: str, selects: list=None):
+        The result is never held in memory as a whole, rows are parsed and yielded chunk by chunk.
+
+        :param dataset:
+        :param query_id:
+        :param timeout: seconds to wait for the query to finish, see `wait_for_query`.
+        :return: async iterator over the rows of the returned csv
+        """
+        async for rows in self.iter_query_result_batches(dataset, query_id, timeout):
+            for row in rows:
+                yield row
+
+    async def iter_query_result_batches(self, dataset, query_id, timeout: float=None):
+        """ Iterates over the result of a given query in batches of rows, one batch per downloaded chunk.
+        Blocks until the query is DONE.
+
+        :param dataset:
+        :param query_id:
+        :param timeout: seconds to wait for the query to finish, see `wait_for_query`.
+        :return: async iterator over lists of rows of the returned csv
+        """
+        async for rows in self._iter_result_batches(dataset, query_id, timeout):
+            yield rows
+
+    async def _iter_result_batches(self, dataset, query_id, timeout, release=True):
+        decoder = CsvRowDecoder(delimiter=';')
+        measured = self._metrics.enabled
+        parse_seconds = 0
+        async for chunk in self._iter_result_chunks(dataset, query_id, timeout, release):
+            if measured:
+                start = time.perf_counter()
+                rows = decoder.feed(chunk)
+                parse_seconds += time.perf_counter() - start
+            else:
+                rows = decoder.feed(chunk)
+            if rows:
+                yield rows
+        rows = decoder.close()
+        if measured:
+            self._metrics.observe(PARSE_SECONDS, parse_seconds, {'format': 'csv'})
+        if rows:
+            yield rows
+
+    async def get_query_result_columns(self, dataset, query_id, timeout: float=None, dtypes: dict=None):
+        """ Returns the result of a given query as typed columns instead of lists of strings. Blocks until the query is
+        DONE. Requires numpy.
+
+        Numbers and dates are decoded into numpy arrays, date ranges into DateRangeColumns and strings into
+        dictionary-encoded DictionaryColumns, see `cqapi.columnar.ColumnarDecoder`. The result is decoded batch by
+        batch while it is downloaded, so the rows are never held in memory as a whole.
+
+        :param dataset:
+        :param query_id:
+        :param timeout: seconds to wait for the query to finish, see `wait_for_query`.
+        :param dtypes: dict from column name to column type, for columns whose type should not be inferred.
+        :return: dict from column name to column, in the order of the result csv.
+        """
+        decoder = ColumnarDecoder(dtypes)
+        parse_seconds = 0
+        async for rows in self.iter_query_result_batches(dataset, query_id, timeout):
+            start = time.perf_counter()
+            decoder.feed(rows)
+            parse_seconds += time.perf_counter() - start
+        start = time.perf_counter()
+        columns = decoder.finish()
+        self._metrics.observe(PARSE_SECONDS, parse_seconds + time.perf_counter() - start, {'format': 'columnar'})
+        return columns
+
+    async def export_query_result(self, dataset, query_id, path, format='parquet', timeout: float=None,
+                                  dtypes: dict=None, row_group_size=65536):
+        """ Writes the result of a given query to a file while it is downloaded. Blocks until the query is DONE.
+
+        Only one row group of the result is held in memory at a time, so results much larger than the available memory
+        can be exported. The file is written to a temporary path and only moved to `path` once the export succeeded.
+
+        :param dataset:
+        :param query_id:
+        :param path: path of the file to write.
+        :param format: 'parquet', 'arrow' (arrow IPC file format) or 'csv'. Parquet and arrow require pyarrow, see
+            `cqapi.export.TableWriter` for the column types. Csv files are written as returned by Conquery.
+        :param timeout: seconds to wait for the query to finish, see `wait_for_query`.
+        :param dtypes: dict from column name to column type, for columns whose type should not be inferred.
+        :param row_group_size: number of rows per row group of parquet files, or record batch of arrow files.
+        """
+        if format not in EXPORT_FORMATS:
+            raise ValueError(f"Invalid format. Must be one of {list(EXPORT_FORMATS)}")
+        if format == 'csv':
+            temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            try:
+                with open(temp_path, 'wb') as file:
+                    async for chunk in self._iter_result_chunks(dataset, query_id, timeout):
+                        file.write(chunk)
+                os.replace(temp_path, path)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+            return
+
+        writer = TableWriter(path, format, dtypes, row_group_size)
+        try:
+            async for rows in self.iter_query_result_batches(dataset, query_id, timeout):
+                writer.write_rows(rows)
+            writer.close()
+        except BaseException:
+            writer.abort()
+            raise
+
+    async def _iter_result_chunks(self, dataset, query_id, timeout, release=True):
+        """ Iterates over the raw result csv of a query, from the result cache if possible. """
+        if query_id.startswith(CACHED_RESULT_PREFIX):
+            key = query_id[len(CACHED_RESULT_PREFIX):]
+            chunks = self._result_cache.iter_chunks(key)
+            if chunks is not None:
+                for chunk in chunks:
+                    yield chunk
+                return
+            cached_query = self._cached_queries.get(query_id)
+            if cached_query is None:
+                raise ValueError(f"The result of {query_id} is no longer cached, execute the query again")
+            # evicted since execute_query, execute it after all
+            query_id = await self._submit_query(*cached_query)
+            self._result_cache_keys[query_id] = key
+
+        try:
+            response = await self._wait_for_query(dataset, query_id, timeout, release)
+            key = self._result_cache_keys.get(query_id)
+        finally:
+            # the execution is finished or given up, identical queries are executed anew from now on
+            self._forget_execution(query_id)
+
+        writer = self._result_cache.writer(key) if key is not None else None
+        try:
+            async for chunk in self._download(response["resultUrl"]):
+                if writer is not None:
+                    writer.write(chunk)
+                yield chunk
+        except BaseException:
+            if writer is not None:
+                writer.abort()
+            raise
+        if writer is not None:
+            writer.commit()
+
+    def _forget_execution(self, query_id):
+        """ Drops what is kept about a query execution until its result is fetched. """
+        self._result_cache_keys.pop(query_id, None)
+        self._forget_coalesced_execution(query_id)
+
+    def _forget_coalesced_execution(self, query_id):
+        """ Stops returning the id of a query execution for identical queries. """
+        entry = self._execution_keys.pop(query_id, None)
+        if entry is not None:
+            self._coalesced_executions.forget(entry[0])
+
+    def _expire_coalesced_executions(self):
+        """ Forgets the oldest coalesced executions beyond MAX_COALESCED_EXECUTIONS or COALESCED_EXECUTION_SECONDS. """
+        expired = time.monotonic() - COALESCED_EXECUTION_SECONDS
+        while self._execution_keys:
+            query_id, (__, executed_at) = next(iter(self._execution_keys.items()))
+            if len(self._execution_keys) < MAX_COALESCED_EXECUTIONS and executed_at > expired:
+                return
+            self._forget_coalesced_execution(query_id)
+
+    async def _download(self, url):
+        """ Iterates over the chunks of a result, resuming the download after transient failures. """
+        if self._download_ranges > 1:
+            length = await self._retrying('GET', url, lambda: get_content_length(self._session, url))
+            if length is not None and length >= 2 * MIN_RANGE_BYTES:
+                async for chunk in self._download_spooled(url, length):
+                    yield chunk
+                return
+        async for chunk in iter_resumable(self._get_range, url, self._download_retries):
+            yield chunk
+
+    async def _download_spooled(self, url, length):
+        spool_path = os.path.join(self._spool_directory or tempfile.gettempdir(), f"cqapi-{uuid.uuid4().hex}.spool")
+        try:
+            await download_ranges(self._get_range, url, length, spool_path, self._download_ranges,
+                                  self._download_retries)
+            with open(spool_path, 'rb') as file:
+                for chunk in iter(lambda: file.read(2 ** 16), b''):
+                    yield chunk
+        finally:
+            if os.path.exists(spool_path):
+                os.remove(spool_path)
+
+    async def _get_range(self, url, start=0, end=None):
+        # resumed by iter_resumable instead of being retried, but still subject to the circuit breaker
+        async with self._retry_policy.guard(url, self._metrics), self._limit('download') as slot:
+            async for chunk in get_chunks(self._session, url, stats=self._transfer_stats, start=start, end=end,
+                                          metrics=self._metrics):
+                slot.responded()
+                yield chunk
+
+    async def execute_many(self, dataset, queries, max_concurrency=16, timeout: float=None):
+        """ Executes many queries and returns their results in order.
+
+        Submission, waiting and downloading of the results run with at most `max_concurrency` queries in flight. A
+        query that fails does not fail the batch, its exception is returned in place of its result.
+
+        :param dataset:
+        :param queries: iterable of queries to execute.
+        :param max_concurrency: maximum number of queries being executed at the same time.
+        :param timeout: seconds to wait for each query to finish, see `wait_for_query`.
+        :return: list with the result rows or the raised exception for each query, in the order of `queries`.
+        """
+        results = {}
+        async for index, result in self.execute_many_as_completed(dataset, queries, max_concurrency, timeout):
+            results[index] = result
+        return [results[index] for index in range(len(results))]
+
+    async def execute_many_as_completed(self, dataset, queries, max_concurrency=16, timeout: float=None):
+        """ Executes many queries and yields their results as soon as they are available.
+
+        Queries are taken from `queries` lazily, so it may as well be a generator producing the queries on demand.
+
+        :param dataset:
+        :param queries: iterable of queries to execute.
+        :param max_concurrency: maximum number of queries being executed at the same time.
+        :param timeout: seconds to wait for each query to finish, see `wait_for_query`.
+        :return: async iterator over tuples of the index of a query in `queries` and its result rows or the raised
+            exception.
+        """
+        async def execute(item):
+            query_id = await self.execute_query(dataset, item[1])
+            return await self.get_query_result(dataset, query_id, timeout)
+
+        async for (index, __), result in _as_completed(execute, enumerate(queries), max_concurrency):
+            yield index, result
+
+    async def get_concept_index(self, dataset):
+        """ Returns a ConceptIndex over all concepts of a dataset.
+
+        With a concept cache, the index is reused for as long as the cached concepts are.
+        """
         concepts = await self.get_concepts(dataset)
+        cached = self._concept_indexes.get(dataset)
+        if cached is not None and cached[0] is concepts:
+            return cached[1]
+        index = util.ConceptIndex(concepts)
+        if self._concept_cache is not None:
+            self._concept_indexes[dataset] = (concepts, index)
+        return index
+
+    async def create_concept_query_with_selects(self, dataset: str, concept_id: str, selects: list=None,
+                                                concept_index: util.ConceptIndex=None):
+        if concept_index is None:
+            concept_index = await self.get_concept_index(dataset)
 
         if selects is None:
-            selects = util.selects_per_concept(concepts).get(concept_id)
+            selects = util.selects_per_concept(concept_index).get(concept_id)
 
-        concept_query = util.concept_query_from_concept(concept_id, concepts.get(concept_id))
+        concept_query = util.concept_query_from_concept(concept_id, concept_index)
         return util.add_selects_to_concept_query(concept_query, concept_id, selects)
 
+
+async def _as_completed(factory, items, max_concurrency):
+    """ Runs factory(item) for the items with at most max_concurrency running at the same time and yields them as
+    they complete.
+
+    :param factory: coroutine function called with each item.
+    :param items: iterable of items, taken lazily. If it is a deque, items appended to it while iterating are taken as
+        well.
+    :param max_concurrency: maximum number of coroutines running at the same time.
+    :return: async iterator over tuples of item and the result of its coroutine or the raised exception.
+    """
+    if max_concurrency < 1:
+        raise ValueError("Invalid max_concurrency. Must be at least 1")
+    if isinstance(items, deque):
+        take, exhausted = items.popleft, IndexError
+    else:
+        take, exhausted = iter(items).__next__, StopIteration
+
+    in_flight = {}
+    try:
+        while True:
+            while len(in_flight) < max_concurrency:
+                try:
+                    item = take()
+                except exhausted:
+                    break
+                in_flight[asyncio.ensure_future(factory(item))] = item
+            if not in_flight:
+                return
+            done, __ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                item = in_flight.pop(task)
+                try:
+                    result = task.result()
+                except (Exception, CqApiError) as e:
+                    result = e
+                yield item, result
+    finally:
+        for task in in_flight:
+            task.cancel()
+
+
+def _nodes_by_depth(nodes, root_id, root_depth):
+    """ Ids of the nodes of a concept response with their depths, in breadth-first order from its root.
+
+    Nodes not reachable from the root through children lists are assigned the depth of the root.
+    """
+    depths = {root_id: root_depth} if root_id in nodes else {}
+    queue = deque(depths)
+    while queue:
+        node_id = queue.popleft()
+        for child_id in nodes[node_id].get('children') or []:
+            if child_id in nodes and child_id not in depths:
+                depths[child_id] = depths[node_id] + 1
+                queue.append(child_id)
+    for node_id in nodes:
+        depths.setdefault(node_id, root_depth)
+    return depths.items()
@@ -0,0 +1,386 @@
+from collections import OrderedDict
+import asyncio
+import hashlib
+import json
+import mmap
+import os
+import time
+import uuid
+
+
+class CacheEntry(object):
+    __slots__ = ('dataset', 'value', 'etag', 'last_modified', 'fetched_at')
+
+    def __init__(self, dataset, value, etag=None, last_modified=None):
+        self.dataset = dataset
+        self.value = value
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = time.monotonic()
+
+
+class ConceptCache(object):
+    """ LRU cache for concept definitions with a time to live.
+
+    Entries are keyed by request url, so one cache can be shared by several ConqueryConnections (even to different
+    Conquery instances) to cache concepts process-wide. Entries older than `ttl` are not discarded right away but
+    revalidated with the server using their ETag or Last-Modified header, if the server sent one.
+
+    Cached concept definitions are shared between all callers and must not be modified.
+    """
+
+    def __init__(self, ttl: float=300, max_entries=32):
+        """
+        :param ttl: seconds an entry is used without revalidation, None to never revalidate.
+        :param max_entries: maximum number of cached responses before the least recently used ones are evicted.
+        """
+        if max_entries < 1:
+            raise ValueError("Invalid max_entries. Must be at least 1")
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._fetches = {}
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """ Get an entry, fresh or stale, and mark it as recently used. """
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry: CacheEntry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def is_fresh(self, entry: CacheEntry):
+        return self.ttl is None or time.monotonic() - entry.fetched_at < self.ttl
+
+    def invalidate(self, dataset=None):
+        """ Remove all entries of the given dataset, or all entries if no dataset is given. """
+        if dataset is None:
+            self._entries.clear()
+        else:
+            for key in [key for key, entry in self._entries.items() if entry.dataset == dataset]:
+                del self._entries[key]
+
+    async def fetch(self, key, dataset, fetch):
+        """ Get the cached value for key, fetching or revalidating it if necessary.
+
+        Concurrent calls for the same key share a single fetch.
+
+        :param key: cache key, usually the request url.
+        :param dataset: dataset the entry belongs to, used for invalidation.
+        :param fetch: coroutine function taking the stale entry (or None) and returning a tuple of the response body
+            (None if the stale entry is still valid), ETag and Last-Modified header.
+        :return: the cached value.
+        """
+        entry = self.get(key)
+        if entry is not None and self.is_fresh(entry):
+            self.hits += 1
+            return entry.value
+
+        fetching = self._fetches.get(key)
+        if fetching is None:
+            fetching = asyncio.ensure_future(self._refresh(key, dataset, entry, fetch))
+            self._fetches[key] = fetching
+            fetching.add_done_callback(lambda __: self._fetches.pop(key, None))
+        else:
+            self.hits += 1
+        return await asyncio.shield(fetching)
+
+    async def _refresh(self, key, dataset, entry, fetch):
+        value, etag, last_modified = await fetch(entry)
+        if value is None and entry is not None:
+            self.revalidations += 1
+            entry.fetched_at = time.monotonic()
+            self.put(key, entry)
+            return entry.value
+        self.misses += 1
+        self.put(key, CacheEntry(dataset, value, etag, last_modified))
+        return value
+
+
+def canonical_query_key(dataset, query):
+    """ Hash identifying a query on a dataset, independent of the key order of the query definition and of select ids
+    listed more than once.
+
+    :return: hex digest of the canonical JSON encoding of dataset and query.
+    """
+    canonical_json = json.dumps([dataset, _normalize_selects(query)], sort_keys=True, separators=(',', ':'),
+                                ensure_ascii=False)
+    return hashlib.sha256(canonical_json.encode('utf-8')).hexdigest()
+
+
+def _normalize_selects(value):
+    """ Copy of a JSON value in which all select lists are free of duplicates, keeping their order. """
+    if isinstance(value, dict):
+        return {
+            key: list(dict.fromkeys(item)) if key == 'selects' and _is_id_list(item) else _normalize_selects(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [_normalize_selects(item) for item in value]
+    return value
+
+
+def _is_id_list(value):
+    return isinstance(value, list) and all(isinstance(item, str) for item in value)
+
+
+class ResultCache(object):
+    """ Size-bounded cache for query results on local disk.
+
+    Results are stored as the csv files downloaded from Conquery, one file per key. Once the cached files exceed
+    `max_bytes`, the least recently used ones are deleted. Cached results are read memory-mapped, so large results are
+    not read into memory up front.
+
+    The cache directory can be shared by several ConqueryConnections and processes.
+    """
+
+    def __init__(self, directory, max_bytes=2 ** 30, ttl: float=None):
+        """
+        :param directory: directory to store the results in, created if it does not exist.
+        :param max_bytes: maximum total size of the cached results in bytes.
+        :param ttl: seconds a result is valid after it was stored, None for no expiry.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.csv")
+
+    def __contains__(self, key):
+        return self._valid_path(key) is not None
+
+    def _valid_path(self, key):
+        path = self.path(key)
+        try:
+            # the modification time is the time a result was stored, the access time its last use
+            stored_at = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return None
+        if self.ttl is not None and time.time() - stored_at >= self.ttl:
+            self._remove(path)
+            return None
+        return path
+
+    def open(self, key):
+        """ Open a cached result memory-mapped.
+
+        :return: read-only mmap of the result csv, or None if the key is not cached. Close it after use.
+        """
+        path = self._valid_path(key)
+        if path is None:
+            self.misses += 1
+            return None
+        try:
+            with open(path, 'rb') as file:
+                os.utime(path, (time.time(), os.fstat(file.fileno()).st_mtime))
+                if os.fstat(file.fileno()).st_size == 0:
+                    # empty files cannot be mapped
+                    self.hits += 1
+                    return b''
+                result = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return result
+
+    def iter_chunks(self, key, chunk_size=2 ** 16):
+        """ Iterate over a cached result in chunks of bytes.
+
+        :return: generator over the chunks, or None if the key is not cached.
+        """
+        result = self.open(key)
+        if result is None:
+            return None
+        return self._iter_mapped(result, chunk_size)
+
+    @staticmethod
+    def _iter_mapped(result, chunk_size):
+        try:
+            for offset in range(0, len(result), chunk_size):
+                yield result[offset:offset + chunk_size]
+        finally:
+            if isinstance(result, mmap.mmap):
+                result.close()
+
+    def writer(self, key):
+        """ Writer storing a result under key once it is committed. """
+        return ResultWriter(self, key)
+
+    def invalidate(self, key=None):
+        """ Remove the result of a key, or all results if no key is given. """
+        if key is not None:
+            self._remove(self.path(key))
+            return
+        for name in os.listdir(self.directory):
+            if name.endswith('.csv'):
+                self._remove(os.path.join(self.directory, name))
+
+    def evict(self):
+        """ Remove expired results and the least recently used ones exceeding max_bytes. """
+        files = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.csv'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if self.ttl is not None and time.time() - stat.st_mtime >= self.ttl:
+                self._remove(path)
+            else:
+                files.append((stat.st_atime, stat.st_size, path))
+
+        total_bytes = sum(size for __, size, __ in files)
+        for __, size, path in sorted(files):
+            if total_bytes <= self.max_bytes:
+                break
+            self._remove(path)
+            total_bytes -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class ResultWriter(object):
+    """ Writes a result to a temporary file and moves it into the ResultCache on commit. """
+
+    def __init__(self, cache: ResultCache, key):
+        self._cache = cache
+        self._key = key
+        self._temp_path = os.path.join(cache.directory, f"{key}.{uuid.uuid4().hex}.tmp")
+        self._file = open(self._temp_path, 'wb')
+
+    def write(self, chunk):
+        self._file.write(chunk)
+
+    def commit(self):
+        """ Store the written result in the cache. """
+        self._file.close()
+        os.replace(self._temp_path, self._cache.path(self._key))
+        self._cache.evict()
+
+    def abort(self):
+        """ Discard the written result. """
+        self._file.close()
+        ResultCache._remove(self._temp_path)
+
+
+class ConceptSnapshot(object):
+    """ Concept nodes of a crawl stored in a local JSON file, see `ConqueryConnection.crawl_concepts`.
+
+    Each fetched concept is stored with the ETag and Last-Modified header of its response. A later crawl with the same
+    snapshot revalidates the stored concepts with the server and only fetches those that changed. Servers not sending
+    either header cause all concepts to be fetched again.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path of the snapshot file, loaded if it exists.
+        """
+        self.path = path
+        # concept url -> {'nodes': dict, 'etag': str, 'last_modified': str}
+        self._entries = {}
+        self._visited = {}
+        self.fetched = 0
+        self.unchanged = 0
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as file:
+                self._entries = json.load(file)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, url):
+        """ :return: dict of the stored nodes, etag and last_modified of a concept url, or None. """
+        return self._entries.get(url)
+
+    def visit(self, url, nodes, etag=None, last_modified=None, unchanged=False):
+        """ Record the nodes of a concept url fetched or revalidated by the current crawl. """
+        if unchanged:
+            self.unchanged += 1
+        else:
+            self.fetched += 1
+        self._visited[url] = {'nodes': nodes, 'etag': etag, 'last_modified': last_modified}
+
+    def save(self):
+        """ Replace the stored concepts with those visited since the last save. """
+        temp_path = f"{self.path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(self._visited, file, ensure_ascii=False)
+        os.replace(temp_path, self.path)
+        self._entries = self._visited
+        self._visited = {}
+
+
+class StoredQueryMirror(object):
+    """ Local copy of the stored queries of a dataset in a JSON file, see `ConqueryConnection.mirror_stored_queries`.
+
+    Each query definition is stored with the listing entry it was fetched for. Updating the mirror only fetches the
+    definitions whose listing entry changed since.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path of the mirror file, loaded if it exists.
+        """
+        self.path = path
+        # query id -> {'entry': listing entry without the query, 'query': query definition}
+        self._entries = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as file:
+                self._entries = json.load(file)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, query_id):
+        return query_id in self._entries
+
+    def __iter__(self):
+        return iter(list(self._entries))
+
+    @property
+    def queries(self):
+        """ dict from query id to query definition. """
+        return {query_id: entry['query'] for query_id, entry in self._entries.items()}
+
+    def entry(self, query_id):
+        """ :return: the listing entry the stored definition of a query was fetched for, or None. """
+        stored = self._entries.get(query_id)
+        return stored['entry'] if stored is not None else None
+
+    def put(self, query_id, entry, query):
+        self._entries[query_id] = {'entry': entry, 'query': query}
+
+    def remove(self, query_id):
+        self._entries.pop(query_id, None)
+
+    def save(self):
+        temp_path = f"{self.path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(self._entries, file, ensure_ascii=False)
+        os.replace(temp_path, self.path)
@@ -0,0 +1,253 @@
+from collections.abc import Mapping
+import json
+import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+class JsonCodec(object):
+    """ Encodes and decodes JSON with one of the supported JSON libraries. """
+
+    def __init__(self, name, loads, dumps):
+        """
+        :param name: name of the codec.
+        :param loads: function from UTF-8 encoded JSON bytes to the decoded value.
+        :param dumps: function from a value to UTF-8 encoded JSON bytes.
+        """
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+
+    def __repr__(self):
+        return f"JsonCodec({self.name!r})"
+
+
+def _stdlib_codec():
+    return JsonCodec('json', json.loads,
+                     lambda value: json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+
+
+def _orjson_codec():
+    return JsonCodec('orjson', orjson.loads, orjson.dumps)
+
+
+def _msgspec_codec():
+    return JsonCodec('msgspec', msgspec.json.decode, msgspec.json.encode)
+
+
+def _ujson_codec():
+    return JsonCodec('ujson', ujson.loads, lambda value: ujson.dumps(value, ensure_ascii=False).encode('utf-8'))
+
+
+# codec name -> (library, factory), in order of preference
+_CODECS = {
+    'orjson': (orjson, _orjson_codec),
+    'msgspec': (msgspec, _msgspec_codec),
+    'ujson': (ujson, _ujson_codec),
+    'json': (json, _stdlib_codec),
+}
+
+
+def available_codecs():
+    """ Names of the codecs whose libraries are installed, fastest first. """
+    return [name for name, (library, __) in _CODECS.items() if library is not None]
+
+
+def get_codec(name='auto'):
+    """ Get a JsonCodec by name.
+
+    :param name: one of 'orjson', 'msgspec', 'ujson' and 'json' (the standard library), or 'auto' for the fastest
+        installed one.
+    :raises ValueError: if the name is unknown or its library is not installed.
+    """
+    if name == 'auto':
+        name = available_codecs()[0]
+    if name not in _CODECS:
+        raise ValueError(f"Invalid codec {name}. Must be 'auto' or one of {list(_CODECS)}")
+    library, create = _CODECS[name]
+    if library is None:
+        raise ValueError(f"Codec {name} is not installed. Installed codecs are {available_codecs()}")
+    return create()
+
+
+STDLIB_CODEC = _stdlib_codec()
+
+
+def lazy_codec(codec: JsonCodec=None):
+    """ Codec decoding JSON objects into LazyObjects whose members are decoded with codec. """
+    codec = codec if codec is not None else STDLIB_CODEC
+    return JsonCodec(f"lazy {codec.name}", lambda body: LazyObject(body, codec), codec.dumps)
+
+
+_STRING = rb'"[^"\\]*(?:\\.[^"\\]*)*"'
+_WHITESPACE_PATTERN = re.compile(rb'\s*')
+_KEY_PATTERN = re.compile(rb'\s*(' + _STRING + rb')\s*:\s*', re.DOTALL)
+_SEPARATOR_PATTERN = re.compile(rb'\s*([,}])')
+# the C scanner of the json module, finding the end of a value at the speed of json.loads
+_scan_value = json.JSONDecoder().scan_once
+
+
+class LazyObject(Mapping):
+    """ Read-only mapping over a JSON object whose members are only decoded on access.
+
+    The JSON is scanned for the object's members only as far as needed to find an accessed key, so accessing a single
+    member of a large object does not even scan all of it. A member is decoded the first time it is accessed and kept
+    afterwards. Members that are objects themselves can be accessed as LazyObjects with `lazy`.
+
+    This keeps large responses like the concept catalog of a dataset in their compact encoded form until, and unless,
+    their parts are used, which takes a fraction of the memory of the decoded objects. Members are skipped with the C
+    scanner of the json module, so scanning all members takes about as long as json.loads. Accessing a few members is
+    faster than decoding all of them with any codec, but accessing all of them is slower than decoding them at once with
+    a fast codec like orjson; see `benchmarks/codec_benchmark.py`.
+    """
+
+    def __init__(self, body: bytes, codec: JsonCodec=None, start=0, end=None, text: str=None):
+        """
+        :param body: UTF-8 encoded JSON.
+        :param codec: codec to decode the members with.
+        :param start: position of the object in body.
+        :param end: position after the end of body to consider.
+        :param text: body decoded as latin-1, to share it with nested LazyObjects.
+        :raises ValueError: if there is no JSON object at start.
+        """
+        self._body = body
+        # the json scanner only reads str. Decoded as latin-1, every byte is one character, so positions in the text
+        # are positions in body.
+        self._text = text
+        self._codec = codec if codec is not None else STDLIB_CODEC
+        self._limit = end if end is not None else len(body)
+        start = _WHITESPACE_PATTERN.match(body, start, self._limit).end()
+        if body[start:start + 1] != b'{':
+            raise ValueError(f"Expected a JSON object at position {start}")
+        # key -> (start, end) of its value
+        self._spans = {}
+        self._decoded = {}
+        # key -> LazyObject, for members accessed with lazy
+        self._nested = {}
+        # key and LazyObject of the member being scanned, if it was accessed with lazy before it was scanned
+        self._pending = None
+        # position of the next member to scan, None once all members are scanned
+        self._position = start + 1
+        # position after the end of the object, once all members are scanned
+        self.end = None
+        empty = _SEPARATOR_PATTERN.match(body, start + 1, self._limit)
+        if empty is not None and empty.group(1) == b'}':
+            self._position = None
+            self.end = empty.end()
+
+    def __getitem__(self, key):
+        if key in self._decoded:
+            return self._decoded[key]
+        if key not in self._spans:
+            self._scan(key)
+        start, end = self._spans[key]
+        value = self._codec.loads(self._body[start:end])
+        self._decoded[key] = value
+        return value
+
+    def __iter__(self):
+        self._scan()
+        return iter(self._spans)
+
+    def __len__(self):
+        self._scan()
+        return len(self._spans)
+
+    def __contains__(self, key):
+        if key in self._spans or key in self._nested:
+            return True
+        try:
+            self._scan(key)
+        except KeyError:
+            return False
+        return True
+
+    def lazy(self, key):
+        """ The member key as LazyObject itself, without decoding it.
+
+        :raises KeyError: if there is no member key.
+        :raises TypeError: if the member is not a JSON object.
+        """
+        if key not in self._nested:
+            if key not in self._spans:
+                self._scan(key, lazy=True)
+                if key in self._nested:
+                    return self._nested[key]
+            start, end = self._spans[key]
+            if self._body[start:start + 1] != b'{':
+                raise TypeError(f"Member {key} is not a JSON object")
+            self._nested[key] = LazyObject(self._body, self._codec, start, end, self._latin1())
+        return self._nested[key]
+
+    def _finish(self):
+        """ Scan all members. :return: the position after the end of the object. """
+        self._scan()
+        return self.end
+
+    def _scan(self, until=None, lazy=False):
+        """ Scan members until the member until was found, or all members if until is None.
+
+        :param lazy: stop at the beginning of member until and register it as nested LazyObject, if it is an object.
+        :raises KeyError: if until is not a member.
+        """
+        body = self._body
+        while self._position is not None or self._pending is not None:
+            if self._pending is not None:
+                key, nested = self._pending
+                self._pending = None
+                value_start, value_end = self._position, nested._finish()
+            else:
+                key_match = _KEY_PATTERN.match(body, self._position, self._limit)
+                if key_match is None:
+                    raise ValueError(f"Expected an object key at position {self._position}")
+                key = json.loads(key_match.group(1))
+                value_start = key_match.end()
+                if lazy and key == until and body[value_start:value_start + 1] == b'{':
+                    # the end of the member is only known once the nested object was scanned
+                    nested = LazyObject(body, self._codec, value_start, self._limit, self._latin1())
+                    self._nested[key] = nested
+                    self._pending = (key, nested)
+                    self._position = value_start
+                    return
+                value_end = self._skip_value(value_start)
+            self._spans[key] = (value_start, value_end)
+            separator = _SEPARATOR_PATTERN.match(body, value_end, self._limit)
+            if separator is None:
+                raise ValueError(f"Expected ',' or '}}' at position {value_end}")
+            if separator.group(1) == b'}':
+                self._position = None
+                self.end = separator.end()
+            else:
+                self._position = separator.end()
+            if key == until:
+                return
+        if until is not None:
+            raise KeyError(until)
+
+    def _latin1(self):
+        if self._text is None:
+            self._text = self._body.decode('latin-1')
+        return self._text
+
+    def _skip_value(self, start):
+        """ Position after the JSON value at start, decoding it with the json scanner without keeping it. """
+        try:
+            __, end = _scan_value(self._latin1(), start)
+        except StopIteration:
+            raise ValueError(f"Expected a value at position {start}")
+        if end > self._limit:
+            raise ValueError("Unterminated JSON object")
+        return end
@@ -0,0 +1,299 @@
+import re
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+COLUMN_KINDS = ('int', 'float', 'date', 'daterange', 'string')
+
+_DATE_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+_DATE_RANGE_PATTERN = re.compile(r'^(\d{4}-\d{2}-\d{2})?/(\d{4}-\d{2}-\d{2})?$')
+# numbers with leading zeros, like ids such as 007, which would lose them when parsed
+_LEADING_ZERO_PATTERN = re.compile(r'^[+-]?0\d')
+# largest integer every smaller one of which a float64 represents exactly
+_MAX_EXACT_FLOAT_INT = 2 ** 53
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError("Columnar results require numpy, install it with 'pip install cqapi[columnar]'")
+
+
+class DictionaryColumn(object):
+    """ Dictionary-encoded column of strings.
+
+    Each distinct string is stored once in `categories`, the cells are stored as int32 `codes` indexing into them. Empty
+    cells have the code -1.
+    """
+
+    def __init__(self, codes, categories: list):
+        self.codes = codes
+        self.categories = categories
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, index):
+        code = self.codes[index]
+        return None if code < 0 else self.categories[code]
+
+    def to_list(self):
+        categories = self.categories
+        return [None if code < 0 else categories[code] for code in self.codes.tolist()]
+
+
+class DateRangeColumn(object):
+    """ Column of sets of date ranges, as Conquery returns them for date selects.
+
+    The ranges of all cells are stored in the datetime64[D] arrays `starts` and `ends`, NaT marking an open end. The
+    ranges of cell i are `starts[offsets[i]:offsets[i + 1]]` and `ends[offsets[i]:offsets[i + 1]]`. Empty cells have no
+    ranges.
+    """
+
+    def __init__(self, starts, ends, offsets):
+        self.starts = starts
+        self.ends = ends
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return list(zip(self.starts[start:end], self.ends[start:end]))
+
+    def to_list(self):
+        return [self[index] for index in range(len(self))]
+
+
+class ColumnarDecoder(object):
+    """ Decodes result rows into typed columns batch by batch.
+
+    The first row is the header. The type of a column is either declared or inferred from the first batch containing
+    values for it, numbers with leading zeros being inferred as strings:
+        * `'int'`: int64 array, or float64 array with NaN if the column has empty cells. Columns with empty cells and
+          ints too large for float64 to represent exactly are int64 masked arrays, masking the empty cells.
+        * `'float'`: float64 array with NaN for empty cells.
+        * `'date'`: datetime64[D] array with NaT for empty cells.
+        * `'daterange'`: DateRangeColumn, for Conquery date ranges like `{2005-01-01/2005-03-31, 2006-01-01/}`.
+        * `'string'`: DictionaryColumn.
+
+    If a later batch of an int column contains floats, the column is widened to float. Any other values not matching
+    the inferred type raise a ValueError, as the values decoded before cannot be turned back into the original strings;
+    declare the types of such columns.
+    """
+
+    def __init__(self, dtypes: dict=None):
+        """
+        :param dtypes: dict from column name to one of COLUMN_KINDS, declaring the type of that column.
+        """
+        _require_numpy()
+        for kind in (dtypes or {}).values():
+            if kind not in COLUMN_KINDS:
+                raise ValueError(f"Invalid column type {kind}. Must be one of {list(COLUMN_KINDS)}")
+        self._dtypes = dtypes or {}
+        self.names = None
+        self._builders = None
+
+    def feed(self, rows: list):
+        """ Decode a batch of rows, starting with the header row in the first batch. """
+        if self.names is None:
+            if not rows:
+                return
+            self.names = _unique_names(rows[0])
+            self._builders = [_ColumnBuilder(name, self._dtypes.get(name)) for name in self.names]
+            rows = rows[1:]
+        if not rows:
+            return
+        width = len(self.names)
+        # pad or cut short rows, then transpose the batch into columns
+        rows = [row if len(row) == width else (row + [''] * width)[:width] for row in rows]
+        for builder, values in zip(self._builders, zip(*rows)):
+            builder.append(values)
+
+    def finish(self):
+        """ :return: dict from column name to column. """
+        if self.names is None:
+            return {}
+        return {name: builder.finish() for name, builder in zip(self.names, self._builders)}
+
+
+def decode_columns(rows, dtypes: dict=None):
+    """ Decode result rows, including the header row, into typed columns, see ColumnarDecoder.
+
+    :return: dict from column name to column.
+    """
+    decoder = ColumnarDecoder(dtypes)
+    decoder.feed(rows)
+    return decoder.finish()
+
+
+def _unique_names(header):
+    names = []
+    seen = set()
+    for name in header:
+        unique_name = name
+        suffix = 1
+        while unique_name in seen:
+            unique_name = f"{name}_{suffix}"
+            suffix += 1
+        seen.add(unique_name)
+        names.append(unique_name)
+    return names
+
+
+class _ColumnBuilder(object):
+
+    def __init__(self, name, kind=None):
+        self.name = name
+        self.declared = kind is not None
+        self.kind = kind
+        # parsed batches, their format depends on kind
+        self.chunks = []
+        # number of leading empty cells while the kind is unknown
+        self.leading_empty = 0
+        # string -> code, for string columns
+        self.categories = {}
+
+    def append(self, values):
+        if self.kind is None:
+            self.kind = _infer_kind(values)
+            if self.kind is None:
+                self.leading_empty += len(values)
+                return
+            if self.leading_empty:
+                self.chunks.append(self._parse([''] * self.leading_empty))
+        try:
+            self.chunks.append(self._parse(values))
+        except (ValueError, OverflowError):
+            if self.declared:
+                raise ValueError(f"Values of column {self.name} do not match its declared type {self.kind}")
+            if not self._widens_to_float(values):
+                raise ValueError(f"Values of column {self.name} do not match its type {self.kind} inferred from the "
+                                 f"first batch, declare the type of the column")
+            self.chunks = [_int_to_float(chunk) for chunk in self.chunks]
+            self.kind = 'float'
+            self.chunks.append(self._parse(values))
+
+    def _widens_to_float(self, values):
+        """ Whether an int column can become a float column for values without changing the ints decoded before. """
+        return self.kind == 'int' and _parses(_parse_float, values) and _exact_as_floats(self.chunks)
+
+    def _parse(self, values):
+        if self.kind == 'string':
+            return _parse_strings(values, self.categories)
+        return _PARSERS[self.kind](values)
+
+    def finish(self):
+        if self.kind is None:
+            return DictionaryColumn(np.full(self.leading_empty, -1, dtype=np.int32), [])
+        if self.kind == 'string':
+            codes = np.concatenate(self.chunks) if self.chunks else np.empty(0, dtype=np.int32)
+            return DictionaryColumn(codes, list(self.categories))
+        if self.kind == 'daterange':
+            return _concatenate_date_ranges(self.chunks)
+        if self.kind == 'int':
+            if not any(empty.any() for __, empty in self.chunks):
+                return np.concatenate([values for values, __ in self.chunks])
+            if _exact_as_floats(self.chunks):
+                return np.concatenate([_int_to_float(chunk) for chunk in self.chunks])
+            # floats would round the large ints, mask the empty cells instead
+            return np.ma.MaskedArray(np.concatenate([values for values, __ in self.chunks]),
+                                     mask=np.concatenate([empty for __, empty in self.chunks]))
+        return np.concatenate(self.chunks)
+
+
+def _infer_kind(values):
+    non_empty = [value for value in values if value != '']
+    if not non_empty:
+        return None
+    if any(_LEADING_ZERO_PATTERN.match(value) for value in non_empty):
+        return 'string'
+    for kind in ('int', 'float', 'date', 'daterange'):
+        if _parses(_PARSERS[kind], non_empty):
+            return kind
+    return 'string'
+
+
+def _parses(parse, values):
+    try:
+        parse(values)
+        return True
+    except (ValueError, OverflowError):
+        return False
+
+
+def _parse_int(values):
+    empty = np.array([value == '' for value in values], dtype=bool)
+    filled = [value or '0' for value in values] if empty.any() else values
+    return np.array(filled).astype(np.int64), empty
+
+
+def _parse_float(values):
+    return np.array([value or 'nan' for value in values]).astype(np.float64)
+
+
+def _parse_date(values):
+    for value in values:
+        if value and not _DATE_PATTERN.match(value):
+            raise ValueError(f"Invalid date {value}")
+    return np.array([value or 'NaT' for value in values], dtype='datetime64[D]')
+
+
+def _parse_date_ranges(values):
+    starts = []
+    ends = []
+    offsets = [0]
+    for value in values:
+        if value:
+            if value[0] == '{' and value[-1] == '}':
+                value = value[1:-1]
+            for date_range in value.split(','):
+                match = _DATE_RANGE_PATTERN.match(date_range.strip())
+                if match is None:
+                    raise ValueError(f"Invalid date range {date_range}")
+                starts.append(match.group(1) or 'NaT')
+                ends.append(match.group(2) or 'NaT')
+        offsets.append(len(starts))
+    return (np.array(starts, dtype='datetime64[D]'), np.array(ends, dtype='datetime64[D]'),
+            np.array(offsets, dtype=np.int64))
+
+
+def _parse_strings(values, categories):
+    codes = np.empty(len(values), dtype=np.int32)
+    for index, value in enumerate(values):
+        codes[index] = -1 if value == '' else categories.setdefault(value, len(categories))
+    return codes
+
+
+_PARSERS = {
+    'int': _parse_int,
+    'float': _parse_float,
+    'date': _parse_date,
+    'daterange': _parse_date_ranges,
+}
+
+
+def _exact_as_floats(int_chunks):
+    """ Whether float64 represents all ints of the parsed int chunks exactly. """
+    return all(len(ints) == 0 or np.abs(ints).max() <= _MAX_EXACT_FLOAT_INT for ints, __ in int_chunks)
+
+
+def _int_to_float(chunk):
+    values, empty = chunk
+    floats = values.astype(np.float64)
+    floats[empty] = np.nan
+    return floats
+
+
+def _concatenate_date_ranges(chunks):
+    starts = np.concatenate([chunk[0] for chunk in chunks])
+    ends = np.concatenate([chunk[1] for chunk in chunks])
+    offsets = [np.zeros(1, dtype=np.int64)]
+    base = 0
+    for __, __, chunk_offsets in chunks:
+        offsets.append(chunk_offsets[1:] + base)
+        base += chunk_offsets[-1]
+    return DateRangeColumn(starts, ends, np.concatenate(offsets))
@@ -0,0 +1,80 @@
+from aiohttp import ClientConnectionError
+from aiohttp import ClientPayloadError
+from cqapi.errors import ConqueryServerError
+from cqapi.polling import Backoff
+import asyncio
+
+
+# errors after which a download is resumed
+TRANSIENT_ERRORS = (ClientConnectionError, ClientPayloadError, ConqueryServerError, asyncio.TimeoutError)
+
+# minimum size of a range fetched in parallel, smaller bodies are fetched with fewer ranges
+MIN_RANGE_BYTES = 2 ** 22
+
+
+async def iter_resumable(get_chunks, url, retries=3, backoff: Backoff=None, start=0, end=None):
+    """ Iterates over the body at url, resuming the download after transient failures.
+
+    Downloads are resumed with a range request starting at the first byte not received yet. Servers refusing range
+    requests send the whole body again, of which the bytes already received are skipped.
+
+    :param get_chunks: function from url, start and end to an async iterator over the chunks of that byte range, see
+        `cqapi.api.get_chunks`.
+    :param url:
+    :param retries: maximum number of times the download is resumed in a row without receiving any bytes.
+    :param backoff: Backoff between a failure and resuming the download.
+    :param start: offset of the first byte to download.
+    :param end: offset after the last byte to download, None for the end of the body.
+    :return: async iterator over the chunks of the body.
+    """
+    backoff = backoff if backoff is not None else Backoff()
+    offset = start
+    failures = 0
+    while True:
+        resumed_at = offset
+        try:
+            async for chunk in get_chunks(url, start=offset, end=end):
+                offset += len(chunk)
+                yield chunk
+            if end is None or offset >= end:
+                return
+            # connection closed before the range was complete
+            error = ClientPayloadError(f"Response ended at byte {offset} instead of {end}")
+        except TRANSIENT_ERRORS as e:
+            error = e
+        failures = failures + 1 if offset == resumed_at else 1
+        if failures > retries:
+            raise error
+        await asyncio.sleep(backoff.delay(failures - 1))
+
+
+async def download_ranges(get_chunks, url, length, path, ranges=4, retries=3, backoff: Backoff=None):
+    """ Downloads the body at url into a file by fetching several byte ranges of it in parallel.
+
+    Each range is resumed after transient failures like in `iter_resumable`.
+
+    :param get_chunks: function from url, start and end to an async iterator over the chunks of that byte range.
+    :param url:
+    :param length: length of the body in bytes.
+    :param path: path of the file to write, overwritten if it exists.
+    :param ranges: maximum number of ranges to fetch in parallel, each at least MIN_RANGE_BYTES long.
+    """
+    with open(path, 'wb') as file:
+        file.truncate(length)
+    if length == 0:
+        return
+
+    async def fetch(start, end):
+        with open(path, 'r+b') as file:
+            file.seek(start)
+            async for chunk in iter_resumable(get_chunks, url, retries, backoff, start, end):
+                file.write(chunk)
+
+    range_size = max(-(-length // ranges), MIN_RANGE_BYTES)
+    tasks = [asyncio.ensure_future(fetch(start, min(start + range_size, length)))
+             for start in range(0, length, range_size)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
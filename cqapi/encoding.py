@@ -0,0 +1,99 @@
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def supported_encodings():
+    """ Content encodings the client can decode, in order of preference. brotli and zstd are only supported if the
+    `brotli` or `zstandard` package is installed.
+    """
+    encodings = []
+    if zstandard is not None:
+        encodings.append('zstd')
+    if brotli is not None:
+        encodings.append('br')
+    encodings.extend(['gzip', 'deflate'])
+    return encodings
+
+
+ACCEPT_ENCODING = ', '.join(supported_encodings())
+
+
+class TransferStats(object):
+    """ Bytes received over the network and bytes after decompression. """
+
+    def __init__(self):
+        self.responses = 0
+        self.wire_bytes = 0
+        self.decoded_bytes = 0
+
+    def __repr__(self):
+        return f"TransferStats(responses={self.responses}, wire_bytes={self.wire_bytes}, " \
+               f"decoded_bytes={self.decoded_bytes})"
+
+    @property
+    def compression_ratio(self):
+        """ Decoded bytes per byte on the wire, 1.0 if nothing was received. """
+        return self.decoded_bytes / self.wire_bytes if self.wire_bytes else 1.0
+
+    def as_dict(self):
+        return {'responses': self.responses, 'wire_bytes': self.wire_bytes, 'decoded_bytes': self.decoded_bytes}
+
+
+class StreamDecoder(object):
+    """ Incrementally decompresses a response body with the given Content-Encoding.
+
+    :example:
+    >>> decoder = StreamDecoder('gzip')
+    >>> body = b''.join(decoder.decompress(chunk) for chunk in chunks) + decoder.flush()
+    """
+
+    def __init__(self, content_encoding: str=None):
+        """
+        :param content_encoding: value of the Content-Encoding header, None or 'identity' for uncompressed bodies.
+        :raises ValueError: if the encoding is not supported.
+        """
+        self.encoding = (content_encoding or 'identity').strip().lower()
+        if self.encoding == 'gzip':
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.encoding == 'deflate':
+            self._decompressor = zlib.decompressobj(zlib.MAX_WBITS)
+        elif self.encoding == 'br' and brotli is not None:
+            self._decompressor = brotli.Decompressor()
+        elif self.encoding == 'zstd' and zstandard is not None:
+            self._decompressor = zstandard.ZstdDecompressor().decompressobj()
+        elif self.encoding == 'identity':
+            self._decompressor = None
+        else:
+            raise ValueError(f"Unsupported Content-Encoding {content_encoding}. Must be one of "
+                             f"{['identity'] + supported_encodings()}")
+        self._started = False
+
+    def decompress(self, chunk: bytes):
+        """ :return: the decompressed bytes available after the chunk, possibly empty. """
+        if self._decompressor is None:
+            return chunk
+        if self.encoding == 'deflate' and not self._started and chunk:
+            self._started = True
+            try:
+                return self._decompressor.decompress(chunk)
+            except zlib.error:
+                # some servers send raw deflate streams without zlib header
+                self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        if self.encoding == 'br':
+            return self._decompressor.process(chunk)
+        return self._decompressor.decompress(chunk)
+
+    def flush(self):
+        """ :return: the remaining decompressed bytes at the end of the body. """
+        if self._decompressor is None or self.encoding in ('br', 'zstd'):
+            return b''
+        return self._decompressor.flush()
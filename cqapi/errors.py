@@ -0,0 +1,38 @@
+class CqApiError(BaseException):
+    pass
+
+
+class ConqueryClientConnectionError(CqApiError):
+    def __init__(self, msg):
+        self.message = msg
+
+
+class QueryFailedError(CqApiError):
+    def __init__(self, msg, status=None, response=None):
+        self.message = msg
+        self.status = status
+        self.response = response
+
+
+class QueryTimeoutError(CqApiError):
+    def __init__(self, msg):
+        self.message = msg
+
+
+class CircuitOpenError(CqApiError):
+    def __init__(self, msg, host=None, retry_after=None):
+        self.message = msg
+        self.host = host
+        self.retry_after = retry_after
+
+
+class ConqueryResponseError(CqApiError):
+    def __init__(self, msg, status=None):
+        self.message = msg
+        self.status = status
+
+
+class ConqueryServerError(ConqueryResponseError):
+    def __init__(self, msg, status=None, retry_after=None):
+        super().__init__(msg, status)
+        self.retry_after = retry_after
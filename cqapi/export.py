@@ -0,0 +1,156 @@
+from cqapi.columnar import COLUMN_KINDS, _PARSERS, _infer_kind, _unique_names
+import os
+import uuid
+
+try:
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    np = pa = pq = None
+
+
+EXPORT_FORMATS = ('parquet', 'arrow', 'csv')
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("Exporting to parquet or arrow requires numpy and pyarrow, install them with "
+                          "'pip install cqapi[export]'")
+
+
+def _to_int_array(values):
+    ints, empty = _PARSERS['int'](values)
+    return pa.array(ints, mask=empty)
+
+
+def _to_float_array(values):
+    return pa.array(_PARSERS['float'](values), from_pandas=True)
+
+
+def _to_date_array(values):
+    return pa.array(_PARSERS['date'](values), from_pandas=True)
+
+
+def _to_date_range_array(values):
+    starts, ends, offsets = _PARSERS['daterange'](values)
+    ranges = pa.StructArray.from_arrays([pa.array(starts, from_pandas=True), pa.array(ends, from_pandas=True)],
+                                        names=['start', 'end'])
+    return pa.ListArray.from_arrays(pa.array(offsets.astype(np.int32)), ranges)
+
+
+def _to_string_array(values):
+    return pa.array([value or None for value in values], type=pa.string())
+
+
+_CONVERTERS = {
+    'int': _to_int_array,
+    'float': _to_float_array,
+    'date': _to_date_array,
+    'daterange': _to_date_range_array,
+    'string': _to_string_array,
+}
+
+
+class TableWriter(object):
+    """ Writes result rows to a parquet or arrow file in row groups.
+
+    Rows are buffered until a row group is full, then converted to typed arrow columns and written, so memory usage
+    depends on the row group size rather than on the size of the result. The file is written to a temporary path next to
+    `path` and only moved there on `close`.
+
+    Column types are declared or inferred from the first row group, see `cqapi.columnar.ColumnarDecoder`. Columns
+    without any values in the first row group are written as strings. The types are fixed once the first row group is
+    written, so later values not matching them raise a ValueError; declare the types of such columns.
+
+    Date ranges are written as lists of structs with the fields `start` and `end`, both null for an open end.
+    """
+
+    def __init__(self, path, format='parquet', dtypes: dict=None, row_group_size=65536):
+        """
+        :param path: path of the file to write.
+        :param format: 'parquet' or 'arrow' (arrow IPC file format).
+        :param dtypes: dict from column name to one of COLUMN_KINDS, declaring the type of that column.
+        :param row_group_size: number of rows per row group, or record batch for arrow files.
+        """
+        _require_pyarrow()
+        if format not in ('parquet', 'arrow'):
+            raise ValueError("Invalid format. Must be one of ['parquet', 'arrow']")
+        for kind in (dtypes or {}).values():
+            if kind not in COLUMN_KINDS:
+                raise ValueError(f"Invalid column type {kind}. Must be one of {list(COLUMN_KINDS)}")
+        if row_group_size < 1:
+            raise ValueError("Invalid row_group_size. Must be at least 1")
+        self.path = path
+        self.format = format
+        self.row_group_size = row_group_size
+        self.rows_written = 0
+        self._dtypes = dtypes or {}
+        self._temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        self._names = None
+        self._kinds = None
+        self._schema = None
+        self._writer = None
+        self._buffer = []
+
+    def write_rows(self, rows: list):
+        """ Write a batch of rows, starting with the header row in the first batch. """
+        if self._names is None:
+            if not rows:
+                return
+            self._names = _unique_names(rows[0])
+            rows = rows[1:]
+        self._buffer.extend(rows)
+        while len(self._buffer) >= self.row_group_size:
+            row_group = self._buffer[:self.row_group_size]
+            del self._buffer[:self.row_group_size]
+            self._write_row_group(row_group)
+
+    def close(self):
+        """ Write the remaining rows and move the file to its path.
+
+        :return: number of rows written, without the header.
+        """
+        if self._buffer or self._writer is None:
+            self._write_row_group(self._buffer)
+            self._buffer = []
+        self._writer.close()
+        os.replace(self._temp_path, self.path)
+        return self.rows_written
+
+    def abort(self):
+        """ Discard the written file. """
+        if self._writer is not None:
+            self._writer.close()
+        try:
+            os.remove(self._temp_path)
+        except FileNotFoundError:
+            pass
+
+    def _write_row_group(self, rows):
+        names = self._names if self._names is not None else []
+        width = len(names)
+        rows = [row if len(row) == width else (row + [''] * width)[:width] for row in rows]
+        columns = list(zip(*rows)) if rows else [()] * width
+
+        if self._kinds is None:
+            self._kinds = [self._dtypes.get(name) or _infer_kind(values) or 'string'
+                           for name, values in zip(names, columns)]
+        try:
+            arrays = [_CONVERTERS[kind](list(values)) for kind, values in zip(self._kinds, columns)]
+        except (ValueError, OverflowError) as e:
+            raise ValueError(f"Values do not match the column types {dict(zip(names, self._kinds))} of the first row "
+                             f"group, declare the column types with dtypes. {e}")
+
+        if self._writer is None:
+            self._schema = pa.schema([pa.field(name, array.type) for name, array in zip(names, arrays)])
+            if self.format == 'parquet':
+                self._writer = pq.ParquetWriter(self._temp_path, self._schema)
+            else:
+                self._writer = pa.ipc.new_file(self._temp_path, self._schema)
+        table = pa.Table.from_arrays(arrays, schema=self._schema)
+        if self.format == 'parquet':
+            self._writer.write_table(table, row_group_size=self.row_group_size)
+        else:
+            self._writer.write_table(table, max_chunksize=self.row_group_size)
+        self.rows_written += len(rows)
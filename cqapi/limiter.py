@@ -0,0 +1,177 @@
+from aiohttp import ClientConnectionError
+from collections import deque
+from cqapi.errors import ConqueryServerError
+from cqapi.metrics import Metrics, LIMITER_LIMIT, LIMITER_WAIT_SECONDS
+import asyncio
+import time
+
+
+# errors signalling that the server is overloaded
+OVERLOAD_ERRORS = (ConqueryServerError, ClientConnectionError, asyncio.TimeoutError)
+
+
+class AdaptiveLimiter(object):
+    """ Limits the number of concurrent requests, adapting the limit to the latency and errors of the server with
+    additive increase and multiplicative decrease (AIMD).
+
+    Every request that succeeds within `target_latency` while the limit is in use raises the limit by `increase /
+    limit`, i.e. by about `increase` per limit's worth of requests. A request that times out, fails with a server error
+    (5xx or 429) or a connection error, or takes longer than `target_latency` cuts the limit by `decrease`. Requests
+    that started before the last cut do not cut it again, so a burst of failures only cuts the limit once.
+
+    :example:
+    >>> limiter = AdaptiveLimiter('poll', initial_limit=4, target_latency=0.5)
+    >>> async with limiter.slot():
+    ...     await get_query(...)
+    """
+
+    def __init__(self, name='requests', initial_limit=8, min_limit=1, max_limit=256, target_latency: float=1.0,
+                 increase=1.0, decrease=0.5, metrics: Metrics=None):
+        """
+        :param name: name of the limiter in metrics.
+        :param initial_limit: number of concurrent requests to start with.
+        :param min_limit: the limit is never cut below it.
+        :param max_limit: the limit is never raised above it.
+        :param target_latency: seconds a request may take without cutting the limit, None to only cut on errors.
+        :param increase: increase of the limit per limit's worth of successful requests.
+        :param decrease: factor the limit is multiplied with when cut.
+        :param metrics: Metrics to record the limit and the time waited for a slot in, see `cqapi.metrics`.
+        """
+        if not 1 <= min_limit <= initial_limit <= max_limit:
+            raise ValueError("Invalid AdaptiveLimiter. Must be 1 <= min_limit <= initial_limit <= max_limit")
+        if increase <= 0 or not 0 < decrease < 1:
+            raise ValueError("Invalid AdaptiveLimiter. increase must be positive and decrease between 0 and 1")
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.increase = increase
+        self.decrease = decrease
+        self._limit = float(initial_limit)
+        self._metrics = None
+        self.metrics = metrics
+        self.in_flight = 0
+        self._waiters = deque()
+        # incremented with every cut, to tell requests started before the last cut
+        self._epoch = 0
+
+    @property
+    def metrics(self):
+        return self._metrics
+
+    @metrics.setter
+    def metrics(self, metrics: Metrics):
+        self._metrics = metrics
+        self._record(LIMITER_LIMIT, self.limit)
+
+    @property
+    def limit(self):
+        """ Current number of concurrent requests allowed. """
+        return int(self._limit)
+
+    def slot(self):
+        """ Async context manager holding a slot for a request, feeding its latency and failure into the limit. """
+        return _Slot(self)
+
+    async def _acquire(self):
+        if self.in_flight < self.limit and not self._waiters:
+            self.in_flight += 1
+            return
+        start = time.perf_counter()
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            elif not waiter.cancelled():
+                # woken up just before being cancelled, pass the slot on
+                self._release()
+            raise
+        self._record(LIMITER_WAIT_SECONDS, time.perf_counter() - start)
+
+    def _release(self):
+        self.in_flight -= 1
+        while self._waiters and self.in_flight < self.limit:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    def _completed(self, epoch, in_flight, latency, overloaded):
+        limit = self._limit
+        if overloaded or (self.target_latency is not None and latency > self.target_latency):
+            if epoch == self._epoch:
+                self._epoch += 1
+                self._limit = max(self.min_limit, self._limit * self.decrease)
+        elif in_flight * 2 >= self._limit:
+            # only raise a limit that is actually used
+            self._limit = min(self.max_limit, self._limit + self.increase / self._limit)
+        if int(self._limit) != int(limit):
+            self._record(LIMITER_LIMIT, self.limit)
+        self._release()
+
+    def _record(self, name, value):
+        if self._metrics is None:
+            return
+        if name == LIMITER_LIMIT:
+            self._metrics.set(name, value, {'limiter': self.name})
+        else:
+            self._metrics.observe(name, value, {'limiter': self.name})
+
+
+class _Slot(object):
+    def __init__(self, limiter):
+        self._limiter = limiter
+        self._start = None
+        self._latency = None
+        self._epoch = None
+        self._in_flight = None
+
+    async def __aenter__(self):
+        await self._limiter._acquire()
+        self._epoch = self._limiter._epoch
+        self._in_flight = self._limiter.in_flight
+        self._start = time.perf_counter()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None and not issubclass(exc_type, OVERLOAD_ERRORS):
+            # the request failed for other reasons, e.g. it was cancelled or the query was invalid
+            self._limiter._release()
+            return
+        latency = self._latency if self._latency is not None else time.perf_counter() - self._start
+        self._limiter._completed(self._epoch, self._in_flight, latency, exc_type is not None)
+
+    def responded(self):
+        """ Take the time until now as latency of the request, e.g. once the first chunk of a long download arrived. """
+        if self._latency is None:
+            self._latency = time.perf_counter() - self._start
+
+
+class _NoLimit(object):
+    """ Slot of requests that are not limited. """
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def responded(self):
+        pass
+
+
+NO_LIMIT = _NoLimit()
+
+
+def default_limiters():
+    """ AdaptiveLimiters of query executions, status polls and downloads, with latency targets suiting each. Downloads
+    take as long as their results are large, so their latency is the time until the first chunk arrives.
+    """
+    return {
+        'execute': AdaptiveLimiter('execute', initial_limit=8, target_latency=2.0),
+        'poll': AdaptiveLimiter('poll', initial_limit=8, target_latency=0.5),
+        'download': AdaptiveLimiter('download', initial_limit=4, max_limit=64, target_latency=2.0),
+    }
@@ -0,0 +1,290 @@
+from aiohttp import TraceConfig
+from urllib.parse import urlsplit
+import re
+import time
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+
+# counter of finished requests, labels method, endpoint and status (the HTTP status or 'error')
+REQUESTS = 'cqapi_requests_total'
+# histogram of the time to resolve a host name
+DNS_SECONDS = 'cqapi_request_dns_seconds'
+# histogram of the time to establish a connection, including the DNS resolution
+CONNECT_SECONDS = 'cqapi_request_connect_seconds'
+# histogram of the time from the start of a request until its response headers arrived, labels method and endpoint
+TTFB_SECONDS = 'cqapi_request_ttfb_seconds'
+# histogram of the time to read a response body, label endpoint
+BODY_SECONDS = 'cqapi_response_body_seconds'
+# counters of the response bytes received over the network and after decompression, label endpoint
+WIRE_BYTES = 'cqapi_response_wire_bytes_total'
+DECODED_BYTES = 'cqapi_response_decoded_bytes_total'
+# counter of status requests while waiting for queries, label dataset
+POLLS = 'cqapi_polls_total'
+# histogram of the number of status requests it took to wait for a query
+POLLS_PER_QUERY = 'cqapi_polls_per_query'
+# histogram of the time waited for a query to finish, label outcome ('done', 'failed', 'timeout', 'cancelled' or
+# 'error')
+QUERY_WAIT_SECONDS = 'cqapi_query_wait_seconds'
+# counter of queries cancelled on the server, label reason ('timeout', 'cancelled' or 'exit')
+CANCELS = 'cqapi_cancels_total'
+# gauge of the queries the shared status poller waits for
+PENDING_POLLS = 'cqapi_poller_pending_queries'
+# histogram of the time spent waiting for a slot of a concurrency limit, label limiter
+LIMITER_WAIT_SECONDS = 'cqapi_limiter_wait_seconds'
+# gauge of the current limit of an adaptive concurrency limiter, label limiter
+LIMITER_LIMIT = 'cqapi_limiter_limit'
+# counter of retried requests, labels method and error (the name of the exception class)
+RETRIES = 'cqapi_retries_total'
+# gauge of the state of the circuit breaker of a host (0 closed, 1 open, 2 half-open), label host
+BREAKER_STATE = 'cqapi_circuit_breaker_state'
+# counter of requests rejected by an open circuit breaker, label host
+BREAKER_REJECTIONS = 'cqapi_circuit_breaker_rejections_total'
+# histogram of the time spent decoding a response or result, label format ('json', 'csv' or 'columnar')
+PARSE_SECONDS = 'cqapi_parse_seconds'
+
+DESCRIPTIONS = {
+    REQUESTS: "Finished requests to Conquery",
+    DNS_SECONDS: "Time to resolve the host name of a request",
+    CONNECT_SECONDS: "Time to establish a connection, including the host name resolution",
+    TTFB_SECONDS: "Time from the start of a request until its response headers arrived",
+    BODY_SECONDS: "Time to read a response body",
+    WIRE_BYTES: "Response bytes received over the network",
+    DECODED_BYTES: "Response bytes after decompression",
+    POLLS: "Status requests while waiting for queries",
+    POLLS_PER_QUERY: "Status requests it took to wait for a query",
+    QUERY_WAIT_SECONDS: "Time waited for a query to finish",
+    CANCELS: "Queries cancelled on the server",
+    PENDING_POLLS: "Queries the shared status poller waits for",
+    LIMITER_WAIT_SECONDS: "Time spent waiting for a slot of a concurrency limit",
+    LIMITER_LIMIT: "Current limit of an adaptive concurrency limiter",
+    RETRIES: "Retried requests",
+    BREAKER_STATE: "State of the circuit breaker of a host, 0 closed, 1 open and 2 half-open",
+    BREAKER_REJECTIONS: "Requests rejected by an open circuit breaker",
+    PARSE_SECONDS: "Time spent decoding responses and results",
+}
+
+_ID_SEGMENT_PATTERN = re.compile(r'(/(?:datasets|queries|concepts|stored-queries|result)/)[^/]+')
+
+
+def endpoint(url):
+    """ Path of url with all dataset, query and concept ids replaced by {id}, to label requests by endpoint.
+
+    :example:
+    >>> endpoint('http://localhost:8080/api/datasets/demo/queries/demo.q1')
+    '/api/datasets/{id}/queries/{id}'
+    """
+    return _ID_SEGMENT_PATTERN.sub(r'\1{id}', urlsplit(str(url)).path)
+
+
+class Metrics(object):
+    """ Receives the measurements of a ConqueryConnection, see the metric names above. This base class discards them.
+
+    Subclasses set `enabled` and implement `increment`, `observe` and `set`. Measurements that take extra work, like
+    timing every chunk of a download, are only made for enabled metrics, so the default adds next to no overhead.
+    """
+
+    enabled = False
+
+    def increment(self, name, value=1, labels: dict=None):
+        """ Add value to the counter name. """
+
+    def observe(self, name, value, labels: dict=None):
+        """ Record value in the histogram name. """
+
+    def set(self, name, value, labels: dict=None):
+        """ Set the gauge name to value. """
+
+
+NULL_METRICS = Metrics()
+
+
+class InMemoryMetrics(Metrics):
+    """ Keeps counters, gauges and summaries (count, sum, min and max) of histograms in memory, e.g. to log them at the
+    end of a batch or to inspect them in tests.
+
+    :example:
+    >>> metrics = InMemoryMetrics()
+    >>> async with ConqueryConnection(url, metrics=metrics) as cq:
+    ...     await cq.execute_many(dataset, queries)
+    >>> metrics.total(TTFB_SECONDS, endpoint='/api/datasets/{id}/queries/{id}')
+    0.53...
+    """
+
+    enabled = True
+
+    def __init__(self):
+        # (name, sorted tuple of label items) -> value
+        self.counters = {}
+        self.gauges = {}
+        # (name, sorted tuple of label items) -> [count, sum, min, max]
+        self.histograms = {}
+
+    def increment(self, name, value=1, labels: dict=None):
+        key = _key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels: dict=None):
+        key = _key(name, labels)
+        summary = self.histograms.get(key)
+        if summary is None:
+            self.histograms[key] = [1, value, value, value]
+        else:
+            summary[0] += 1
+            summary[1] += value
+            summary[2] = min(summary[2], value)
+            summary[3] = max(summary[3], value)
+
+    def set(self, name, value, labels: dict=None):
+        self.gauges[_key(name, labels)] = value
+
+    def total(self, name, **labels):
+        """ Sum of the counter, or of the observations of the histogram, name over all label values matching labels. """
+        return sum(value for key, value in self._matching(self.counters, name, labels)) + \
+            sum(summary[1] for key, summary in self._matching(self.histograms, name, labels))
+
+    def count(self, name, **labels):
+        """ Number of observations of the histogram name over all label values matching labels. """
+        return sum(summary[0] for key, summary in self._matching(self.histograms, name, labels))
+
+    def value(self, name, **labels):
+        """ Value of the gauge name with exactly the given labels, None if it was never set. """
+        return self.gauges.get(_key(name, labels))
+
+    @staticmethod
+    def _matching(values, name, labels):
+        return [(key, value) for key, value in values.items()
+                if key[0] == name and all(item in key[1] for item in labels.items())]
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items())) if labels else ()
+
+
+class PrometheusMetrics(Metrics):
+    """ Records the measurements as prometheus_client metrics. Requires prometheus_client.
+
+    Every metric is registered on first use, with the names listed above and the label names of its first measurement.
+    """
+
+    enabled = True
+
+    def __init__(self, registry=None, buckets=None):
+        """
+        :param registry: CollectorRegistry to register the metrics in, defaults to prometheus_client's global one.
+        :param buckets: buckets of the histograms, defaults to prometheus_client's default buckets.
+        """
+        if prometheus_client is None:
+            raise ImportError("PrometheusMetrics require prometheus_client. Install it with "
+                              "`pip install prometheus_client` or `pip install cqapi[prometheus]`")
+        self._registry = registry if registry is not None else prometheus_client.REGISTRY
+        self._buckets = buckets
+        self._metrics = {}
+
+    def increment(self, name, value=1, labels: dict=None):
+        self._metric(prometheus_client.Counter, name, labels).inc(value)
+
+    def observe(self, name, value, labels: dict=None):
+        self._metric(prometheus_client.Histogram, name, labels).observe(value)
+
+    def set(self, name, value, labels: dict=None):
+        self._metric(prometheus_client.Gauge, name, labels).set(value)
+
+    def _metric(self, kind, name, labels):
+        metric = self._metrics.get(name)
+        if metric is None:
+            options = {'buckets': self._buckets} if kind is prometheus_client.Histogram and self._buckets else {}
+            metric = kind(name, DESCRIPTIONS.get(name, name), sorted(labels or ()), registry=self._registry,
+                          **options)
+            self._metrics[name] = metric
+        return metric.labels(**labels) if labels else metric
+
+
+class OpenTelemetryMetrics(Metrics):
+    """ Records the measurements with the instruments of an OpenTelemetry Meter, labels becoming attributes.
+
+    Counters and histograms are recorded with counters and histograms of the meter, gauges with up-down counters by
+    adding the change to their previous value.
+
+    :example:
+    >>> from opentelemetry import metrics
+    >>> cq_metrics = OpenTelemetryMetrics(metrics.get_meter('cqapi'))
+    """
+
+    enabled = True
+
+    def __init__(self, meter):
+        """
+        :param meter: opentelemetry.metrics.Meter to create the instruments with.
+        """
+        self._meter = meter
+        self._instruments = {}
+        # gauge key -> last value
+        self._gauges = {}
+
+    def increment(self, name, value=1, labels: dict=None):
+        self._instrument(self._meter.create_counter, name).add(value, attributes=labels)
+
+    def observe(self, name, value, labels: dict=None):
+        self._instrument(self._meter.create_histogram, name).record(value, attributes=labels)
+
+    def set(self, name, value, labels: dict=None):
+        key = _key(name, labels)
+        change = value - self._gauges.get(key, 0)
+        self._gauges[key] = value
+        if change:
+            self._instrument(self._meter.create_up_down_counter, name).add(change, attributes=labels)
+
+    def _instrument(self, create, name):
+        instrument = self._instruments.get(name)
+        if instrument is None:
+            instrument = create(name, description=DESCRIPTIONS.get(name, name))
+            self._instruments[name] = instrument
+        return instrument
+
+
+def trace_config(metrics: Metrics):
+    """ aiohttp TraceConfig recording the DNS resolution, connection and time to first byte of every request of a
+    session, as well as the time spent waiting for a free connection of its pool, in metrics.
+    """
+    async def on_request_start(session, context, params):
+        context.start = time.perf_counter()
+        context.method = params.method
+        context.endpoint = endpoint(params.url)
+
+    async def on_request_end(session, context, params):
+        labels = {'method': context.method, 'endpoint': context.endpoint}
+        metrics.observe(TTFB_SECONDS, time.perf_counter() - context.start, labels)
+        metrics.increment(REQUESTS, labels=dict(labels, status=str(params.response.status)))
+
+    async def on_request_exception(session, context, params):
+        metrics.increment(REQUESTS, labels={'method': context.method, 'endpoint': context.endpoint, 'status': 'error'})
+
+    def timer(name, labels=None):
+        async def on_start(session, context, params):
+            context.timers = getattr(context, 'timers', {})
+            context.timers[name] = time.perf_counter()
+
+        async def on_end(session, context, params):
+            start = getattr(context, 'timers', {}).pop(name, None)
+            if start is not None:
+                metrics.observe(name, time.perf_counter() - start, labels)
+
+        return on_start, on_end
+
+    config = TraceConfig()
+    config.on_request_start.append(on_request_start)
+    config.on_request_end.append(on_request_end)
+    config.on_request_exception.append(on_request_exception)
+    for (on_start, on_end), start_signal, end_signal in [
+        (timer(DNS_SECONDS), config.on_dns_resolvehost_start, config.on_dns_resolvehost_end),
+        (timer(CONNECT_SECONDS), config.on_connection_create_start, config.on_connection_create_end),
+        (timer(LIMITER_WAIT_SECONDS, {'limiter': 'connection_pool'}), config.on_connection_queued_start,
+         config.on_connection_queued_end),
+    ]:
+        start_signal.append(on_start)
+        end_signal.append(on_end)
+    return config
@@ -0,0 +1,188 @@
+from contextlib import asynccontextmanager
+from cqapi.errors import CqApiError, CircuitOpenError, ConqueryResponseError, QueryFailedError
+from cqapi.metrics import LIMITER_WAIT_SECONDS, PENDING_POLLS
+from cqapi.polling import Backoff, FAILED_QUERY_STATES, query_status
+import asyncio
+import time
+
+
+class StatusPoller(object):
+    """ Polls the status of all pending queries of a ConqueryConnection on a single schedule.
+
+    Instead of one polling loop per waiting coroutine, a single background task sweeps over all pending queries. A sweep
+    over a dataset with many pending queries fetches the dataset's query listing once instead of polling each query,
+    so the request rate depends on the sweep interval rather than on the number of outstanding queries. Queries the
+    listing shows finished are fetched once more for their result url. Datasets with
+    only a few pending queries are polled query by query, with at most `max_concurrency` requests at a time.
+
+    The interval between sweeps follows `backoff` and starts over whenever a new query is watched.
+    """
+
+    def __init__(self, connection, backoff: Backoff=None, max_concurrency=8, listing_threshold=8):
+        """
+        :param connection: the ConqueryConnection used for polling.
+        :param backoff: Backoff between sweeps.
+        :param max_concurrency: maximum number of concurrent status requests.
+        :param listing_threshold: minimum number of pending queries of a dataset to poll the listing instead.
+        """
+        self._connection = connection
+        self._backoff = backoff if backoff is not None else Backoff()
+        self._max_concurrency = max_concurrency
+        self._listing_threshold = listing_threshold
+        # (dataset, query_id) -> future resolving to the query description once DONE
+        self._pending = {}
+        self._waiters = {}
+        self._task = None
+        self._restart_backoff = False
+        self.requests = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    async def wait(self, dataset, query_id):
+        """ Wait until the given query is DONE.
+
+        :return: the query description of the finished query, see `ConqueryConnection.get_query`.
+        :raises QueryFailedError: if the query is FAILED or CANCELED.
+        """
+        key = (dataset, query_id)
+        future = self._pending.get(key)
+        if future is None:
+            future = asyncio.get_event_loop().create_future()
+            self._pending[key] = future
+            self._restart_backoff = True
+            if self._task is None or self._task.done():
+                self._task = asyncio.ensure_future(self._run())
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            # shielded, a single waiter giving up must not cancel the result for all others
+            return await asyncio.shield(future)
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+                # nobody is interested anymore, stop polling for it
+                if self._pending.get(key) is future:
+                    del self._pending[key]
+                    future.cancel()
+
+    async def close(self):
+        """ Stop polling and cancel all pending waits. """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for future in self._pending.values():
+            future.cancel()
+        self._pending.clear()
+
+    async def _run(self):
+        semaphore = asyncio.Semaphore(self._max_concurrency)
+        delays = self._backoff.delays()
+        try:
+            while self._pending:
+                if self._restart_backoff:
+                    delays = self._backoff.delays()
+                    self._restart_backoff = False
+                self._connection.metrics.set(PENDING_POLLS, len(self._pending))
+                await self._sweep(semaphore)
+                if self._pending:
+                    await asyncio.sleep(next(delays))
+        except (Exception, CqApiError) as e:
+            # nobody would resolve the pending waits anymore, fail them instead of letting them hang
+            for dataset, query_id in list(self._pending):
+                self._fail(dataset, query_id, e)
+
+    async def _sweep(self, semaphore):
+        by_dataset = {}
+        for dataset, query_id in list(self._pending):
+            by_dataset.setdefault(dataset, []).append(query_id)
+
+        polls = []
+        for dataset, query_ids in by_dataset.items():
+            if len(query_ids) >= self._listing_threshold:
+                polls.append(self._poll_listing(dataset, query_ids, semaphore))
+            else:
+                polls.extend(self._poll_query(dataset, query_id, semaphore) for query_id in query_ids)
+        await asyncio.gather(*polls)
+
+    @asynccontextmanager
+    async def _slot(self, semaphore):
+        """ Hold one of the concurrent request slots, recording the time waited for it. """
+        start = time.perf_counter()
+        async with semaphore:
+            self._connection.metrics.observe(LIMITER_WAIT_SECONDS, time.perf_counter() - start, {'limiter': 'poller'})
+            yield
+
+    async def _poll_listing(self, dataset, query_ids, semaphore):
+        async with self._slot(semaphore):
+            self.requests += 1
+            try:
+                async with self._connection._limit('poll'):
+                    listing = await self._connection.get_stored_queries(dataset)
+            except CircuitOpenError:
+                # the host failed recently, poll again once the breaker lets requests through
+                return
+            except (Exception, CqApiError) as e:
+                for query_id in query_ids:
+                    self._fail(dataset, query_id, e)
+                return
+        if not isinstance(listing, list):
+            # e.g. the error Conquery responds with if the dataset is not accessible
+            code = listing.get('code') if isinstance(listing, dict) else None
+            error = ConqueryResponseError(f"Conquery responded with no query listing for dataset {dataset}: "
+                                          f"{str(listing)[:200]}", code)
+            for query_id in query_ids:
+                self._fail(dataset, query_id, error)
+            return
+        entries = {entry.get('id'): entry for entry in listing if isinstance(entry, dict)}
+        to_fetch = []
+        for query_id in query_ids:
+            status = entries.get(query_id, {}).get('status')
+            if status is None or status == 'DONE' or status in FAILED_QUERY_STATES:
+                to_fetch.append(query_id)
+            else:
+                self._update(dataset, query_id, entries[query_id])
+        # the listing only tells which executions changed their state. Finished ones are fetched one by one for their
+        # result url or error, as are executions not (yet) visible in the listing.
+        await asyncio.gather(*[self._poll_query(dataset, query_id, semaphore) for query_id in to_fetch])
+
+    async def _poll_query(self, dataset, query_id, semaphore):
+        async with self._slot(semaphore):
+            if (dataset, query_id) not in self._pending:
+                return
+            self.requests += 1
+            try:
+                response = await self._connection.get_query(dataset, query_id)
+            except CircuitOpenError:
+                return
+            except (Exception, CqApiError) as e:
+                self._fail(dataset, query_id, e)
+                return
+        self._update(dataset, query_id, response)
+
+    def _update(self, dataset, query_id, response):
+        future = self._pending.get((dataset, query_id))
+        if future is None:
+            return
+        self._connection._count_poll(dataset, query_id)
+        try:
+            status = query_status(query_id, response)
+        except ConqueryResponseError as e:
+            self._fail(dataset, query_id, e)
+            return
+        if status == 'DONE':
+            del self._pending[(dataset, query_id)]
+            if not future.done():
+                future.set_result(response)
+        elif status in FAILED_QUERY_STATES:
+            self._fail(dataset, query_id,
+                       QueryFailedError(f"Query {query_id} ended with status {status}", status, response))
+
+    def _fail(self, dataset, query_id, exception):
+        future = self._pending.pop((dataset, query_id), None)
+        if future is not None and not future.done():
+            future.set_exception(exception)
@@ -0,0 +1,60 @@
+from cqapi.errors import ConqueryResponseError
+import random
+
+
+# query states after which a query will never be DONE
+FAILED_QUERY_STATES = ('FAILED', 'CANCELED')
+
+
+def query_status(query_id, response):
+    """ The status in the description of a query, see `ConqueryConnection.get_query`.
+
+    :raises ConqueryResponseError: if the response is no query description, like the error Conquery responds with for
+        unknown or expired query ids.
+    """
+    if not isinstance(response, dict) or 'code' in response or 'status' not in response:
+        status = response.get('code') if isinstance(response, dict) else None
+        raise ConqueryResponseError(f"Conquery responded with no status for query {query_id}: {str(response)[:200]}",
+                                    status)
+    return response['status']
+
+
+class Backoff(object):
+    """ Exponential backoff with jitter.
+
+    The n-th delay is `initial * factor ** n`, capped at `max_delay`, and then randomly spread by up to `jitter` (as a
+    fraction of the delay) in either direction, so many clients waiting on the same server do not poll in lockstep.
+
+    :example:
+    >>> delays = Backoff(initial=0.5, factor=2, max_delay=4, jitter=0).delays()
+    >>> [next(delays) for _ in range(5)]
+    [0.5, 1.0, 2.0, 4.0, 4.0]
+    """
+
+    def __init__(self, initial=0.05, factor=1.5, max_delay=5.0, jitter=0.2):
+        if initial < 0 or max_delay < 0:
+            raise ValueError("Invalid Backoff. Delays must not be negative")
+        if factor < 1:
+            raise ValueError("Invalid Backoff. factor must be at least 1")
+        if not 0 <= jitter <= 1:
+            raise ValueError("Invalid Backoff. jitter must be between 0 and 1")
+        self.initial = initial
+        self.factor = factor
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def delay(self, attempt: int):
+        """ Delay in seconds before the given (zero-based) retry attempt. """
+        delay = min(self.initial * self.factor ** attempt, self.max_delay)
+        if self.jitter:
+            delay *= 1 + random.uniform(-self.jitter, self.jitter)
+        return delay
+
+    def delays(self):
+        """ Infinite generator of successive delays. """
+        attempt = 0
+        while True:
+            yield self.delay(attempt)
+            # stop growing the exponent once the cap is reached to avoid float overflow
+            if self.initial * self.factor ** attempt < self.max_delay:
+                attempt += 1
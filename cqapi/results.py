@@ -0,0 +1,93 @@
+import codecs
+import csv
+
+
+class CsvRowDecoder(object):
+    """ Incrementally decodes a Conquery result csv into rows.
+
+    Bytes are fed in arbitrarily sized chunks as they arrive from the network. Only complete records are parsed, so a
+    chunk boundary may fall anywhere, including inside of a multi-byte character or a quoted field spanning several
+    lines.
+
+    :example:
+    >>> decoder = CsvRowDecoder()
+    >>> decoder.feed(b'colA;colB\\n1;"A')
+    [['colA', 'colB']]
+    >>> decoder.feed(b'"\\n')
+    [['1', 'A']]
+    >>> decoder.close()
+    []
+    """
+
+    def __init__(self, delimiter=';', encoding='utf-8'):
+        self._delimiter = delimiter
+        self._decoder = codecs.getincrementaldecoder(encoding)()
+        # text after the last line break, waiting for the rest of its line
+        self._pending = ''
+        # lines of a record whose quoted field has not been closed yet
+        self._record = []
+        self._in_quotes = False
+
+    def feed(self, chunk: bytes):
+        """ Decode a chunk of the csv body.
+
+        :param chunk: next bytes of the csv body.
+        :return: list of rows completed by this chunk.
+        """
+        lines = (self._pending + self._decoder.decode(chunk)).split('\n')
+        self._pending = lines.pop()
+        return self._parse_lines(lines)
+
+    def close(self):
+        """ Flush the decoder once the body has been read completely.
+
+        :return: list of the remaining rows.
+        """
+        tail = self._pending + self._decoder.decode(b'', final=True)
+        self._pending = ''
+        rows = self._parse_lines([tail] if tail else [])
+        if self._record:
+            # unterminated quoted field, leave it to the csv module how to treat it
+            rows.extend(csv.reader(['\n'.join(self._record)], delimiter=self._delimiter))
+            self._record = []
+            self._in_quotes = False
+        return rows
+
+    def _parse_lines(self, lines):
+        records = []
+        for line in lines:
+            if self._in_quotes or '"' in line:
+                self._in_quotes = self._ends_in_quotes(line)
+            self._record.append(line)
+            if not self._in_quotes:
+                records.append('\n'.join(self._record))
+                self._record = []
+        return list(csv.reader(records, delimiter=self._delimiter))
+
+    def _ends_in_quotes(self, line):
+        """ Whether line ends inside of a quoted field, given whether it starts inside of one.
+
+        Follows the csv module: only a quote at the start of a field opens a quoted field, two quotes inside of it are
+        an escaped quote, and any other quote is part of the field.
+        """
+        in_quotes = self._in_quotes
+        i = 0
+        while True:
+            if in_quotes:
+                end = line.find('"', i)
+                if end < 0:
+                    return True
+                if line.startswith('"', end + 1):
+                    i = end + 2
+                    continue
+                in_quotes = False
+                i = end + 1
+            elif line.startswith('"', i):
+                in_quotes = True
+                i += 1
+                continue
+            # skip the rest of an unquoted field, or of a quoted one after its closing quote
+            delimiter = line.find(self._delimiter, i)
+            if delimiter < 0:
+                return False
+            i = delimiter + 1
@@ -0,0 +1,200 @@
+from aiohttp import ClientConnectionError
+from cqapi.errors import CqApiError, CircuitOpenError, ConqueryServerError
+from cqapi.metrics import Metrics, BREAKER_REJECTIONS, BREAKER_STATE, RETRIES
+from cqapi.polling import Backoff
+from urllib.parse import urlsplit
+import asyncio
+import time
+
+
+# errors after which a request is retried
+RETRYABLE_ERRORS = (ConqueryServerError, ClientConnectionError, asyncio.TimeoutError)
+
+
+class CircuitBreaker(object):
+    """ Stops sending requests to a host that failed repeatedly, so a degraded node is not hammered with retries.
+
+    The breaker is closed while requests succeed. After `failure_threshold` consecutive failures it opens and rejects
+    all requests with a CircuitOpenError for `reset_timeout` seconds. Then it is half-open and lets a single trial
+    request through, which closes it again if it succeeds or opens it for another `reset_timeout` if it fails.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    # values of the state gauge
+    _STATE_VALUES = {CLOSED: 0, OPEN: 1, HALF_OPEN: 2}
+
+    def __init__(self, host, failure_threshold=5, reset_timeout=30.0):
+        """
+        :param host: host the breaker guards, to label metrics and errors.
+        :param failure_threshold: number of consecutive failures that open the breaker.
+        :param reset_timeout: seconds until an open breaker lets a trial request through.
+        """
+        if failure_threshold < 1 or reset_timeout < 0:
+            raise ValueError("Invalid CircuitBreaker. failure_threshold must be at least 1 and reset_timeout must not "
+                             "be negative")
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def acquire(self, metrics: Metrics=None):
+        """ Admit a request.
+
+        :return: whether the request is the trial request of the half-open breaker, to pass on to `record`.
+        :raises CircuitOpenError: if the breaker is open, or half-open with its trial request still in flight.
+        """
+        state = self.state
+        if state == self.CLOSED:
+            return False
+        if state == self.HALF_OPEN and not self._trial:
+            self._trial = True
+            self._record_state(metrics)
+            return True
+        if metrics is not None:
+            metrics.increment(BREAKER_REJECTIONS, labels={'host': self.host})
+        retry_after = max(0.0, self._opened_at + self.reset_timeout - time.monotonic())
+        raise CircuitOpenError(f"Circuit breaker for {self.host} is open after {self.failures} consecutive failures",
+                               self.host, retry_after)
+
+    def record(self, success, metrics: Metrics=None, trial=False):
+        """ Record the outcome of an admitted request.
+
+        :param success: True if the host answered, False if it failed, None if the request was abandoned without
+            telling either.
+        :param trial: what `acquire` returned for the request.
+        """
+        if trial:
+            self._trial = False
+        if success is None:
+            return
+        if self._opened_at is not None and not trial:
+            # admitted before the breaker opened, only the trial request tells whether the host recovered
+            return
+        state = self.state
+        if success:
+            self.failures = 0
+            self._opened_at = None
+        else:
+            self.failures += 1
+            if trial or self.failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+        if self.state != state:
+            self._record_state(metrics)
+
+    def _record_state(self, metrics):
+        if metrics is not None:
+            metrics.set(BREAKER_STATE, self._STATE_VALUES[self.state], {'host': self.host})
+
+
+class RetryPolicy(object):
+    """ Retries requests after transient failures with exponential backoff and jitter, guarding every host with a
+    CircuitBreaker.
+
+    Requests are retried after server errors (5xx or 429), connection errors and timeouts. GET requests are idempotent
+    and retried by default, other requests only with `retry_posts`, as a POST that failed may have been executed
+    anyway. A `Retry-After` header of an error response extends the backoff, up to `max_retry_after` seconds.
+
+    Share a policy between several connections to share its circuit breakers.
+    """
+
+    def __init__(self, attempts=3, backoff: Backoff=None, retry_posts=False, max_retry_after=30.0,
+                 failure_threshold=5, reset_timeout=30.0):
+        """
+        :param attempts: maximum number of attempts of a request, 1 to never retry.
+        :param backoff: Backoff between attempts, defaults to 0.2 s doubling up to 10 s with 50 % jitter.
+        :param retry_posts: retry POST requests, e.g. query executions, as well.
+        :param max_retry_after: maximum seconds to wait for a Retry-After header.
+        :param failure_threshold: number of consecutive failures that open the circuit breaker of a host, None to not
+            use circuit breakers.
+        :param reset_timeout: seconds until an open circuit breaker lets a trial request through.
+        """
+        if attempts < 1:
+            raise ValueError("Invalid RetryPolicy. attempts must be at least 1")
+        self.attempts = attempts
+        self.backoff = backoff if backoff is not None else Backoff(initial=0.2, factor=2, max_delay=10, jitter=0.5)
+        self.retry_posts = retry_posts
+        self.max_retry_after = max_retry_after
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        # host -> CircuitBreaker
+        self._breakers = {}
+
+    def breaker(self, url):
+        """ The CircuitBreaker of the host of url, None if circuit breakers are not used. """
+        if self.failure_threshold is None:
+            return None
+        host = urlsplit(url).netloc
+        breaker = self._breakers.get(host)
+        if breaker is None:
+            breaker = CircuitBreaker(host, self.failure_threshold, self.reset_timeout)
+            self._breakers[host] = breaker
+        return breaker
+
+    def guard(self, url, metrics: Metrics=None):
+        """ Async context manager passing a single request to url through the circuit breaker of its host. """
+        return _Guard(self.breaker(url), metrics)
+
+    async def run(self, call, method, url, metrics: Metrics=None):
+        """ Call a request, retrying it after transient failures.
+
+        :param call: coroutine function without arguments making the request.
+        :param method: HTTP method of the request.
+        :param url: url of the request, to find the circuit breaker of its host.
+        :param metrics: Metrics to count retries in.
+        :return: the result of the call.
+        :raises CircuitOpenError: if the host's circuit breaker is open.
+        """
+        attempts = self.attempts if method == 'GET' or self.retry_posts else 1
+        for attempt in range(attempts):
+            try:
+                async with self.guard(url, metrics):
+                    return await call()
+            except RETRYABLE_ERRORS as e:
+                if attempt + 1 >= attempts:
+                    raise
+                delay = self.backoff.delay(attempt)
+                if isinstance(e, ConqueryServerError) and e.retry_after is not None:
+                    delay = max(delay, min(e.retry_after, self.max_retry_after))
+                if metrics is not None:
+                    metrics.increment(RETRIES, labels={'method': method, 'error': type(e).__name__})
+                await asyncio.sleep(delay)
+
+
+class _Guard(object):
+    def __init__(self, breaker, metrics):
+        self._breaker = breaker
+        self._metrics = metrics
+        self._trial = False
+
+    async def __aenter__(self):
+        if self._breaker is not None:
+            self._trial = self._breaker.acquire(self._metrics)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self._breaker is None:
+            return
+        if exc_type is None:
+            success = True
+        elif issubclass(exc_type, RETRYABLE_ERRORS):
+            success = False
+        elif issubclass(exc_type, (Exception, CqApiError)):
+            # the host answered, e.g. that the request was invalid
+            success = True
+        else:
+            # cancelled
+            success = None
+        self._breaker.record(success, self._metrics, self._trial)
@@ -0,0 +1,65 @@
+import asyncio
+
+
+class SingleFlight(object):
+    """ Coalesces concurrent calls with the same key into a single call.
+
+    While a call for a key is in flight, further calls for that key do not start a call of their own but wait for the
+    result of the call in flight. With `keep=True` a successful result stays shared until it is `forget`-ed. A call is
+    cancelled once all of its callers are.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        # call in flight -> number of callers waiting for it
+        self._waiters = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def __contains__(self, key):
+        return key in self._flights
+
+    async def do(self, key, call, keep=False):
+        """ Call `call` unless a call for key is already in flight, and return its result.
+
+        :param key: hashable key identifying equivalent calls.
+        :param call: coroutine function without arguments.
+        :param keep: keep sharing the result after the call finished, until `forget` is called for key.
+        :return: the result of the call.
+        """
+        flight = self._flights.get(key)
+        if flight is not None:
+            self.coalesced += 1
+        else:
+            self.calls += 1
+            flight = asyncio.ensure_future(call())
+            self._flights[key] = flight
+            flight.add_done_callback(lambda done: self._land(key, done, keep))
+        self._waiters[flight] = self._waiters.get(flight, 0) + 1
+        try:
+            # shielded, a single caller giving up must not cancel the call for all others
+            return await asyncio.shield(flight)
+        finally:
+            self._waiters[flight] -= 1
+            if not self._waiters[flight]:
+                del self._waiters[flight]
+                # the last caller gave up, nobody is left to use the result
+                if not flight.done():
+                    flight.cancel()
+
+    def forget(self, key):
+        """ Stop sharing the result for key, the next call for key is made anew. """
+        self._flights.pop(key, None)
+
+    async def cancel(self):
+        """ Cancel all calls in flight and wait until they finished. """
+        flights = [flight for flight in self._waiters if not flight.done()]
+        for flight in flights:
+            flight.cancel()
+        await asyncio.gather(*flights, return_exceptions=True)
+
+    def _land(self, key, flight, keep):
+        if self._flights.get(key) is not flight:
+            return
+        if not keep or flight.cancelled() or flight.exception() is not None:
+            del self._flights[key]
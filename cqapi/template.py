@@ -0,0 +1,179 @@
+from cqapi.util import _parse_iso_date
+from datetime import date
+import itertools
+
+
+def _validate_str(value):
+    if type(value) is not str:
+        raise ValueError("Must be a str")
+    return value
+
+
+def _validate_count(value):
+    if type(value) is not int or value < 0:
+        raise ValueError("Must be a positive int")
+    return value
+
+
+def _validate_date(value):
+    if type(value) is not date:
+        value = _parse_iso_date(value)
+    return value.isoformat()
+
+
+def _validate_selects(value):
+    if type(value) is not list or not all(type(select_id) is str for select_id in value):
+        raise ValueError("Must be a list of select ids")
+    return value
+
+
+PLACEHOLDER_KINDS = {
+    'str': _validate_str,
+    'count': _validate_count,
+    'date': _validate_date,
+    'selects': _validate_selects,
+}
+
+
+class Placeholder(object):
+    """ Named placeholder for a value in a QueryTemplate.
+
+    The kind of a placeholder determines how its values are validated:
+        * `'str'`: a str, e.g. a concept id.
+        * `'count'`: a positive int, e.g. `timeCountBefore` of a relative query.
+        * `'date'`: a datetime.date or ISO-formatted date string, inserted as ISO-formatted string.
+        * `'selects'`: a list of select ids.
+        * None: any value, inserted as is.
+    """
+
+    def __init__(self, name: str, kind: str=None, validate=None):
+        """
+        :param name: name of the placeholder, used to pass its values to the template.
+        :param kind: one of the kinds in PLACEHOLDER_KINDS or None.
+        :param validate: function validating a value and returning the value to insert, raising a ValueError for
+            invalid values. Overrides the validation of `kind`.
+        """
+        if kind is not None and kind not in PLACEHOLDER_KINDS:
+            raise ValueError(f"Invalid kind. Must be one of {list(PLACEHOLDER_KINDS)}")
+        self.name = name
+        self.kind = kind
+        if validate is None:
+            validate = PLACEHOLDER_KINDS.get(kind)
+        self._validate = validate
+
+    def __repr__(self):
+        return f"Placeholder({self.name!r}, {self.kind!r})"
+
+    def validate(self, value):
+        """ Validate a value for this placeholder.
+
+        :return: the value to insert into the query.
+        :raises ValueError: if the value is invalid.
+        """
+        if self._validate is None:
+            return value
+        try:
+            return self._validate(value)
+        except (ValueError, TypeError, AttributeError) as e:
+            raise ValueError(f"Invalid value {value!r} for placeholder '{self.name}'. {e}")
+
+
+class QueryTemplate(object):
+    """ A query with named placeholders, compiled for fast instantiation.
+
+    The template is analyzed once on construction. Instantiating it validates only the placeholder values and copies
+    only the parts of the query that contain placeholders; all other parts are shared between the template and its
+    instances and must therefore not be modified in place.
+
+    :example:
+    >>> relative_query = create_relative_query(index_query, before_query, after_query, 0, 0)
+    >>> template = QueryTemplate(dict(relative_query,
+    ...                               timeCountBefore=Placeholder('before', 'count'),
+    ...                               timeCountAfter=Placeholder('after', 'count')))
+    >>> query = template.instantiate(before=4, after=2)
+    >>> queries = template.grid(before=range(1, 9), after=range(1, 9))  # generator over 64 queries
+    """
+
+    def __init__(self, template):
+        """
+        :param template: query definition containing Placeholders anywhere in place of values.
+        """
+        self.placeholders = {}
+        build = self._compile(template)
+        self._build = build if build is not None else (lambda values: template)
+
+    @property
+    def names(self):
+        """ Names of all placeholders of the template. """
+        return list(self.placeholders)
+
+    def instantiate(self, **values):
+        """ Create a query from the template by filling in all placeholders.
+
+        :param values: a value for each placeholder, by name.
+        :return: the query.
+        :raises ValueError: if a value is missing, unknown or invalid.
+        """
+        self._check_names(values)
+        return self._build({name: self.placeholders[name].validate(value) for name, value in values.items()})
+
+    def grid(self, **value_lists):
+        """ Lazily create queries for all combinations of the given placeholder values.
+
+        Every value is validated only once, no matter how many queries it ends up in.
+
+        :param value_lists: an iterable of values for each placeholder, by name.
+        :return: generator over the queries, in the order of itertools.product over the value lists.
+        """
+        for __, query in self.grid_values(**value_lists):
+            yield query
+
+    def grid_values(self, **value_lists):
+        """ Like `grid`, but generates tuples of the validated placeholder values and the query. """
+        self._check_names(value_lists)
+        names = list(value_lists)
+        validated = [[self.placeholders[name].validate(value) for value in value_lists[name]] for name in names]
+        for combination in itertools.product(*validated):
+            values = dict(zip(names, combination))
+            yield values, self._build(values)
+
+    def _check_names(self, values):
+        missing = [name for name in self.placeholders if name not in values]
+        if missing:
+            raise ValueError(f"Missing values for placeholders {missing}")
+        unknown = [name for name in values if name not in self.placeholders]
+        if unknown:
+            raise ValueError(f"Unknown placeholders {unknown}. Must be one of {self.names}")
+
+    def _compile(self, part):
+        """ Compile a part of the template into a function from placeholder values to the instantiated part.
+
+        :return: the function, or None if the part contains no placeholders.
+        """
+        if isinstance(part, Placeholder):
+            known = self.placeholders.setdefault(part.name, part)
+            if known is not part and known.kind != part.kind:
+                raise ValueError(f"Placeholder '{part.name}' is used with different kinds")
+            name = part.name
+            return lambda values: values[name]
+
+        if isinstance(part, dict):
+            builders = [(key, self._compile(value)) for key, value in part.items()]
+        elif isinstance(part, list):
+            builders = [(index, self._compile(value)) for index, value in enumerate(part)]
+        else:
+            return None
+        builders = [(key, build) for key, build in builders if build is not None]
+        if not builders:
+            return None
+
+        # copying the template part keeps its key order, placeholder values are filled in afterwards
+        copy = dict if isinstance(part, dict) else list
+
+        def build(values):
+            instance = copy(part)
+            for key, build_value in builders:
+                instance[key] = build_value(values)
+            return instance
+
+        return build
@@ -0,0 +1,178 @@
+# fields of each node type that hold child nodes, either a single node or a list of nodes
+CHILD_FIELDS = {
+    'CONCEPT_QUERY': ('root',),
+    'RELATIVE_FORM_QUERY': ('query', 'features', 'outcomes'),
+    'AND': ('children',),
+    'OR': ('children',),
+    'NEGATION': ('child',),
+    'DATE_RESTRICTION': ('child',),
+    'CONCEPT': (),
+}
+
+
+def child_fields(node):
+    """ Names of the fields of a node holding its children.
+
+    :raises Exception: if the node type is unknown.
+    """
+    try:
+        return CHILD_FIELDS[node.get('type')]
+    except KeyError:
+        raise Exception(f"Unknown type in query_object: {node.get('type')}")
+
+
+def children(node):
+    """ Direct children of a node, in the order of its child fields.
+
+    :raises Exception: if the node type is unknown.
+    """
+    return [child for __, __, child in _child_slots(node)]
+
+
+def walk(query):
+    """ Iterate over all nodes of a query tree in depth-first pre-order.
+
+    The traversal uses an explicit stack, so it is not limited by the recursion limit regardless of the depth of the
+    query.
+
+    :example:
+    >>> query = {'type': 'CONCEPT_QUERY', 'root': {'type': 'OR', 'children': [
+    ...     {'type': 'CONCEPT', 'ids': ['a']}, {'type': 'CONCEPT', 'ids': ['b']}]}}
+    >>> [node['ids'] for node in walk(query) if node['type'] == 'CONCEPT']
+    [['a'], ['b']]
+
+    :param query: query or node to walk.
+    :return: generator over the nodes of the query.
+    """
+    stack = [query]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(reversed(children(node)))
+
+
+def rewrite(query, rewrite_node):
+    """ Rewrite a query tree bottom-up without copying unchanged subtrees.
+
+    `rewrite_node` is called for every node after its children have been rewritten and returns the node to replace it
+    with, or the node itself to keep it. Nodes returned by `rewrite_node` are not traversed again. A node is copied only
+    if one of its children was replaced, so rewriting a query in which nothing changes returns the query itself.
+
+    All untouched subtrees are shared between the input and the rewritten query. Neither of them must therefore be
+    modified in place afterwards, use copy.deepcopy first if that is necessary.
+
+    The traversal uses an explicit stack, so it takes time linear in the number of nodes and is not limited by the
+    recursion limit regardless of the depth of the query.
+
+    :example:
+    >>> def drop_labels(node):
+    ...     if 'label' in node:
+    ...         return {key: value for key, value in node.items() if key != 'label'}
+    ...     return node
+    >>> rewrite({'type': 'NEGATION', 'child': {'type': 'CONCEPT', 'ids': ['a'], 'label': 'A'}}, drop_labels)
+    {'type': 'NEGATION', 'child': {'type': 'CONCEPT', 'ids': ['a']}}
+
+    :param query: query or node to rewrite.
+    :param rewrite_node: function from a node to its replacement.
+    :return: the rewritten query.
+    """
+    # frames of [node, child slots, rewritten children]
+    stack = [[query, _child_slots(query), []]]
+    while True:
+        node, slots, rewritten = stack[-1]
+        while len(rewritten) < len(slots):
+            child = slots[len(rewritten)][2]
+            if child_fields(child):
+                break
+            # leaves are rewritten right away instead of getting a frame of their own
+            rewritten.append(rewrite_node(child))
+        else:
+            stack.pop()
+            result = rewrite_node(_replace_children(node, slots, rewritten))
+            if not stack:
+                return result
+            stack[-1][2].append(result)
+            continue
+        stack.append([child, _child_slots(child), []])
+
+
+class QueryTransformer(object):
+    """ Rewrites queries with handlers registered per node type.
+
+    Handlers take a node and return its replacement, or the node itself to keep it, see `rewrite`. Nodes of types
+    without a handler are kept.
+
+    :example:
+    >>> transformer = QueryTransformer()
+    >>> @transformer.register('CONCEPT')
+    ... def exclude_from_time_aggregation(node):
+    ...     return dict(node, excludeFromTimeAggregation=True)
+    >>> transformer.transform({'type': 'NEGATION', 'child': {'type': 'CONCEPT', 'ids': ['a']}})
+    {'type': 'NEGATION', 'child': {'type': 'CONCEPT', 'ids': ['a'], 'excludeFromTimeAggregation': True}}
+    """
+
+    def __init__(self, handlers: dict=None):
+        """
+        :param handlers: dict from node type to handler.
+        """
+        self._handlers = {}
+        for node_type, handler in (handlers or {}).items():
+            self.register(node_type, handler)
+
+    def register(self, node_type, handler=None):
+        """ Register the handler for a node type, replacing a previously registered one.
+
+        Can be used as a decorator if no handler is given.
+
+        :param node_type: one of the node types in CHILD_FIELDS.
+        :param handler: function from a node to its replacement.
+        :return: the handler.
+        """
+        if node_type not in CHILD_FIELDS:
+            raise ValueError(f"Invalid node_type. Must be one of {list(CHILD_FIELDS)}")
+        if handler is None:
+            return lambda decorated: self.register(node_type, decorated)
+        self._handlers[node_type] = handler
+        return handler
+
+    def transform(self, query):
+        """ Rewrite a query by applying the registered handlers to all of its nodes.
+
+        :return: the rewritten query, sharing unchanged subtrees with the input query.
+        """
+        handlers = self._handlers
+
+        def rewrite_node(node):
+            handler = handlers.get(node.get('type'))
+            return node if handler is None else handler(node)
+
+        return rewrite(query, rewrite_node)
+
+
+def _child_slots(node):
+    """ List of (field, index in list field or None, child) for all children of a node. """
+    slots = []
+    for field in child_fields(node):
+        value = node.get(field)
+        if type(value) is list:
+            slots.extend((field, index, child) for index, child in enumerate(value))
+        elif value is not None:
+            slots.append((field, None, value))
+    return slots
+
+
+def _replace_children(node, slots, rewritten):
+    """ Copy of node with its rewritten children, or node itself if none of its children changed. """
+    copy = None
+    for (field, index, child), new_child in zip(slots, rewritten):
+        if new_child is child:
+            continue
+        if copy is None:
+            copy = dict(node)
+        if index is None:
+            copy[field] = new_child
+        else:
+            if copy[field] is node[field]:
+                copy[field] = list(node[field])
+            copy[field][index] = new_child
+    return node if copy is None else copy
@@ -1,5 +1,7 @@
+from collections import namedtuple
+from collections.abc import Mapping
 from datetime import date
-from copy import deepcopy
+from cqapi import tree
 
 
 def object_to_dict(obj):
@@ -49,6 +51,68 @@ def dict_to_object(dictionary):
     return object
 
 
+class ConceptIndex(object):
+    """ Lookup tables over concept definitions, built once for constant time lookups.
+
+    Can be built from the dict returned by ConqueryConnection.get_concepts as well as from the list returned by
+    ConqueryConnection.get_concept, and be passed to `selects_per_concept` and `concept_query_from_concept` instead of
+    the concepts themselves.
+
+    :example:
+    >>> concepts = await cq.get_concepts('dataset')
+    >>> index = ConceptIndex(concepts)
+    >>> index.selects.get('concept_x')       # select ids of a concept
+    >>> index.connectors.get('concept_x')    # connector ids of a concept
+    >>> index.parents.get('concept_x.child') # parent id of a child concept
+    >>> index.select_owners.get('select_id') # concept id a select belongs to
+    >>> concept_query = concept_query_from_concept('concept_x', index)
+
+    The lookup tables are shared with all callers and must not be modified.
+    """
+
+    def __init__(self, concepts):
+        """
+        :param concepts: dict (or other mapping) or list of concepts as returned by ConqueryConnection.get_concepts and
+            .get_concept calls.
+        """
+        if isinstance(concepts, Mapping):
+            concept_items = concepts.items()
+        else:
+            concept_items = ((concept_id, concept) for concept in concepts for concept_id in concept.get('ids', []))
+
+        self.concepts = {}
+        self.selects = {}
+        self.connectors = {}
+        self.parents = {}
+        self.select_owners = {}
+        for concept_id, concept in concept_items:
+            self.concepts[concept_id] = concept
+
+            select_ids = [select_dict.get('id') for select_dict in concept.get('selects', [])]
+            self.selects[concept_id] = select_ids
+            for select_id in select_ids:
+                self.select_owners.setdefault(select_id, concept_id)
+
+            tables = concept.get('tables')
+            if type(tables) == list and all('connectorId' in table for table in tables):
+                self.connectors[concept_id] = [table.get('connectorId') for table in tables]
+
+            for child_id in concept.get('children', []):
+                self.parents[child_id] = concept_id
+            if concept.get('parent') is not None:
+                self.parents[concept_id] = concept.get('parent')
+
+    def __contains__(self, concept_id):
+        return concept_id in self.concepts
+
+    def __len__(self):
+        return len(self.concepts)
+
+    def children(self, concept_id):
+        """ Ids of the direct children of a concept. """
+        return self.concepts.get(concept_id, {}).get('children', [])
+
+
 def selects_per_concept(concepts: dict):
     """ Aggregates a dict of concepts to a dict of available selects per concept.
 
@@ -65,9 +129,12 @@ def selects_per_concept(concepts: dict):
         selects_by_concept = selects_per_concept(concepts)
         type(selects_by_concept)  # = dict
 
-    :param concepts: dict of concepts as returned by ConqueryConnection.get_concept and .get_concepts calls.
+    :param concepts: dict of concepts as returned by ConqueryConnection.get_concept and .get_concepts calls, or a
+        ConceptIndex built from them.
     :return: dict of list of available selects, i.e. a mapping from concept to its available selects.
     """
+    if isinstance(concepts, ConceptIndex):
+        return concepts.selects
     return {concept_id: [select_dict.get('id') for select_dict in concept.get('selects', [])] for (concept_id, concept) in concepts.items()}
 
 
@@ -78,41 +145,21 @@ def add_selects_to_concept_query(query, target_concept_id: str, selects: list):
     :param target_concept_id: CONCEPT's id to which the selects should be added.
     :param selects: list of select_ids to be added.
     :return: the enriched query object - will be the same as the input query iff it does not contain any CONCEPT nodes
-        with the target_concept_id.
+        with the target_concept_id. Unchanged subtrees are shared with the input query, see `tree.rewrite`.
     """
     if type(selects) is not list:
         raise Exception("parameter 'selects' must be a list.")
 
-    query_object = deepcopy(query)
-
-    query_object_node_type = query_object.get('type')
-    if query_object_node_type == 'CONCEPT_QUERY' or query_object_node_type == 'RELATIVE_FORM_QUERY':
-        query_object['root'] = add_selects_to_concept_query(query_object.get('root'), target_concept_id, selects)
-        return query_object
-    elif query_object_node_type == 'AND':
-        query_object['children'] = [add_selects_to_concept_query(child, target_concept_id, selects) for child in query_object.get('children')]
-        return query_object
-    elif query_object_node_type == 'OR':
-        query_object['children'] = [add_selects_to_concept_query(child, target_concept_id, selects) for child in query_object.get('children')]
-        return query_object
-    elif query_object_node_type == 'NEGATION':
-        query_object['child'] = add_selects_to_concept_query(query_object.get('child'), target_concept_id, selects)
-        return query_object
-    elif query_object_node_type == 'DATE_RESTRICTION':
-        query_object['child'] = add_selects_to_concept_query(query_object.get('child'), target_concept_id, selects)
-        return query_object
-    elif query_object_node_type == 'CONCEPT':
-        if target_concept_id in query_object.get('ids'):
-            if query_object.get('selects') is not None:
-                query_object.get('selects').extend(selects)
-                return query_object
+    def add_selects(node):
+        if target_concept_id in node.get('ids'):
+            node = dict(node)
+            if node.get('selects') is not None:
+                node['selects'] = node.get('selects') + selects
             else:
-                query_object['selects'] = selects
-                return query_object
-        else:
-            return query_object
-    else:
-        raise Exception(f"Unknown type in query_object: {query_object.get('type')}")
+                node['selects'] = list(selects)
+        return node
+
+    return tree.QueryTransformer({'CONCEPT': add_selects}).transform(query)
 
 
 def add_date_restriction_to_concept_query(query, target_concept_id: str, date_start: date, date_end: date):
@@ -124,52 +171,21 @@ def add_date_restriction_to_concept_query(query, target_concept_id: str, date_st
     :param target_concept_id: Id of concept node in query above which the date restriction node should be added.
     :param date_start: Start-date of the date restriction.
     :param date_end: End-date of the date restriction.
-    :return:
+    :return: the restricted query object. Unchanged subtrees are shared with the input query, see `tree.rewrite`.
     """
-    query_object = deepcopy(query)
+    date_range = _date_range(date_start, date_end)
 
-    if type(date_start) is not date:
-        start = _parse_iso_date(date_start)
-    else:
-        start = date_start
-    if type(date_end) is not date:
-        end = _parse_iso_date(date_end)
-    else:
-        end = date_end
-    if (end - start).days < 0:
-        raise ValueError("Invalid DATE_RESTRICTION: Start-date after end-date")
-
-    query_object_node_type = query_object.get('type')
-
-    if query_object_node_type == 'CONCEPT_QUERY':
-        query_object['root'] = add_date_restriction_to_concept_query(query_object.get('root'), target_concept_id, start, end)
-        return query_object
-    elif query_object_node_type == 'AND':
-        query_object['children'] = [add_date_restriction_to_concept_query(child, target_concept_id, start, end) for child in query_object.get('children')]
-        return query_object
-    elif query_object_node_type == 'OR':
-        query_object['children'] = [add_date_restriction_to_concept_query(child, target_concept_id, start, end) for child in query_object.get('children')]
-        return query_object
-    elif query_object_node_type == 'NEGATION':
-        query_object['child'] = add_date_restriction_to_concept_query(query_object.get('child'), target_concept_id, start, end)
-        return query_object
-    elif query_object_node_type == 'DATE_RESTRICTION':
-        query_object['child'] = add_date_restriction_to_concept_query(query_object.get('child'), target_concept_id, start, end)
-        return query_object
-    elif query_object_node_type == 'CONCEPT':
-        if target_concept_id in query_object.get('ids'):
+    def add_date_restriction(node):
+        if target_concept_id in node.get('ids'):
             return {
                 "type": "DATE_RESTRICTION",
-                "dateRange": {
-                    "min": start.isoformat(),
-                    "max": end.isoformat()
-                },
-                "child": query_object
+                "dateRange": dict(date_range),
+                "child": node
             }
-        else:
-            return query_object
-    else:
-        raise Exception(f"Unknown type in query_object: {query_object.get('type')}")
+        return node
+
+    return tree.QueryTransformer({'CONCEPT': add_date_restriction}).transform(query)
+
 
 
 def concept_query_from_concept(concept_id, concept_object):
@@ -187,9 +203,23 @@ def concept_query_from_concept(concept_id, concept_object):
     >>> # or can be combined with other utility methods to add selects etc.
 
     :param concept_id:
-    :param concept_object:
+    :param concept_object: the concept's definition, or a ConceptIndex containing it.
     :return: a concept query with the given concept as it's sole root node
     """
+    if isinstance(concept_object, ConceptIndex):
+        connector_ids = concept_object.connectors.get(concept_id)
+        if connector_ids is None:
+            # let the checks below report what is wrong with the concept
+            return concept_query_from_concept(concept_id, concept_object.concepts.get(concept_id, {}))
+        return {
+            'type': 'CONCEPT_QUERY',
+            'root': {
+                'type': 'CONCEPT',
+                'ids': [concept_id],
+                'tables': [{'id': connector_id} for connector_id in connector_ids]
+            }
+        }
+
     # todo write tests
     if 'tables' not in concept_object:
         raise KeyError("'concept_object' must have key 'tables'")
@@ -211,27 +241,109 @@ def concept_query_from_concept(concept_id, concept_object):
 
 
 def add_subquery_to_concept_query(query, subquery):
-    query_object = deepcopy(query)
-    query_object_node_type = query_object.get('type')
-
     if subquery.get('type') == 'CONCEPT_QUERY':
         subquery = subquery.get('root')
 
-    if query_object_node_type == 'CONCEPT_QUERY':
-        query_object['root'] = add_subquery_to_concept_query(query_object.get('root'), subquery)
-        return query_object
-    elif query_object_node_type == 'AND':
-        query_object['children'].append(subquery)
-        return query_object
+    query_node_type = query.get('type')
+    if query_node_type == 'CONCEPT_QUERY':
+        return dict(query, root=add_subquery_to_concept_query(query.get('root'), subquery))
+    elif query_node_type == 'AND':
+        return dict(query, children=query.get('children') + [subquery])
     else:
-        query = {
+        return {
             "type": "AND",
             "children": [
-                query_object,
+                query,
                 subquery
             ]
         }
-        return query
+
+
+AddSelects = namedtuple('AddSelects', ['target_concept_id', 'selects'])
+AddSelects.__doc__ = """ Edit for `apply_edits`, see `add_selects_to_concept_query`. """
+
+AddDateRestriction = namedtuple('AddDateRestriction', ['target_concept_id', 'date_start', 'date_end'])
+AddDateRestriction.__doc__ = """ Edit for `apply_edits`, see `add_date_restriction_to_concept_query`. """
+
+AddSubquery = namedtuple('AddSubquery', ['subquery'])
+AddSubquery.__doc__ = """ Edit for `apply_edits`, see `add_subquery_to_concept_query`. """
+
+
+def apply_edits(query, edits: list):
+    """ Apply many edits to a query in a single traversal.
+
+    Gives the same result as calling add_selects_to_concept_query, add_date_restriction_to_concept_query and
+    add_subquery_to_concept_query one after another in the order of the edits, but traverses the query only once. Edits
+    are indexed by their target concept, so the cost is linear in the number of nodes plus the number of edits.
+
+    Like with the helpers, a subquery is edited by the concept edits that follow it, but not by those preceding it.
+    Such subqueries are traversed once more.
+
+    :example:
+    >>> query = apply_edits(query, [
+    ...     AddSelects('concept_a', ['concept_a.select']),
+    ...     AddSelects('concept_b', ['concept_b.select']),
+    ...     AddDateRestriction('concept_a', '2019-01-01', '2019-12-31'),
+    ...     AddSubquery(other_query)
+    ... ])
+
+    :param query: query to edit.
+    :param edits: list of AddSelects, AddDateRestriction and AddSubquery edits.
+    :return: the edited query. Unchanged subtrees are shared with the input query, see `tree.rewrite`.
+    """
+    # target concept id -> list of (position, edit) with parsed date ranges
+    edits_by_concept = {}
+    subqueries = []
+    for position, edit in enumerate(edits):
+        if type(edit) is AddSelects:
+            if type(edit.selects) is not list:
+                raise Exception("parameter 'selects' must be a list.")
+            edits_by_concept.setdefault(edit.target_concept_id, []).append((position, edit))
+        elif type(edit) is AddDateRestriction:
+            date_range = _date_range(edit.date_start, edit.date_end)
+            edits_by_concept.setdefault(edit.target_concept_id, []).append((position, date_range))
+        elif type(edit) is AddSubquery:
+            subqueries.append((position, edit.subquery))
+        else:
+            raise TypeError(f"Unknown edit: {edit}")
+
+    def apply_concept_edits(node, after=-1):
+        concept_edits = [(position, edit) for concept_id in node.get('ids')
+                         for position, edit in edits_by_concept.get(concept_id, []) if position > after]
+        if not concept_edits:
+            return node
+        if len(node.get('ids')) > 1:
+            # edits targeting several ids of the same node apply once, in their original order
+            concept_edits = sorted(dict(concept_edits).items())
+
+        selects = [select for __, edit in concept_edits if type(edit) is AddSelects for select in edit.selects]
+        if selects:
+            node = dict(node)
+            if node.get('selects') is not None:
+                node['selects'] = node.get('selects') + selects
+            else:
+                node['selects'] = selects
+        # later restrictions end up closer to the concept, like when added one after another
+        for __, date_range in reversed(concept_edits):
+            if type(date_range) is dict:
+                node = {
+                    "type": "DATE_RESTRICTION",
+                    "dateRange": dict(date_range),
+                    "child": node
+                }
+        return node
+
+    if edits_by_concept:
+        query = tree.QueryTransformer({'CONCEPT': apply_concept_edits}).transform(query)
+    last_concept_edit = max(position for concept_edits in edits_by_concept.values() for position, __ in concept_edits) \
+        if edits_by_concept else -1
+    for position, subquery in subqueries:
+        if position < last_concept_edit:
+            # the concept edits following the subquery apply to it as well
+            subquery = tree.QueryTransformer(
+                {'CONCEPT': lambda node, after=position: apply_concept_edits(node, after)}).transform(subquery)
+        query = add_subquery_to_concept_query(query, subquery)
+    return query
 
 
 def create_relative_query(index_query, before_query, after_query, time_before, time_after,
@@ -284,3 +396,21 @@ def create_relative_query(index_query, before_query, after_query, time_before, t
 def _parse_iso_date(datestring: str):
     y, m, d = map(lambda x: int(x), datestring.split('-'))
     return date(y, m, d)
+
+
+def _date_range(date_start, date_end):
+    if type(date_start) is not date:
+        start = _parse_iso_date(date_start)
+    else:
+        start = date_start
+    if type(date_end) is not date:
+        end = _parse_iso_date(date_end)
+    else:
+        end = date_end
+    if (end - start).days < 0:
+        raise ValueError("Invalid DATE_RESTRICTION: Start-date after end-date")
+
+    return {
+        "min": start.isoformat(),
+        "max": end.isoformat()
+    }
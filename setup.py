@@ -21,5 +21,11 @@ setup(
     install_requires=[
         'aiohttp==3.5.4'
     ],
+    extras_require={
+        'columnar': ['numpy'],
+        'export': ['numpy', 'pyarrow'],
+        'json': ['orjson'],
+        'prometheus': ['prometheus_client'],
+    },
 )
 
@@ -1,5 +1,18 @@
 from cqapi import ConqueryConnection
 from cqapi import ConqueryClientConnectionError
+from cqapi import ConqueryResponseError
+from cqapi import ConqueryServerError
+from cqapi import QueryFailedError
+from cqapi import QueryTimeoutError
+from cqapi import Backoff
+from cqapi import ConceptCache
+from cqapi import InMemoryMetrics
+from cqapi import ResultCache
+from cqapi import RetryPolicy
+from cqapi import create_session
+from cqapi.metrics import POLLS_PER_QUERY
+import asyncio
+import cqapi.api
 import pytest
 import json
 import os
@@ -37,7 +50,7 @@ def build_test_parametrization(tests_json):
 def create_get_mock(mocked_backend):
     results_by_endpoint = {d.get("endpoint"): d.get("result") for d in mocked_backend}
 
-    async def mocked_get(__, url):
+    async def mocked_get(__, url, **kwargs):
         if url[len(base_url):] in results_by_endpoint.keys():
             return results_by_endpoint.get(url[len(base_url):])
         else:
@@ -49,7 +62,7 @@ def create_get_mock(mocked_backend):
 def create_post_mock(mocked_backend):
     results_by_endpoint = {d.get("endpoint"): d.get("result") for d in mocked_backend}
 
-    async def mocked_post(__, url, ___):
+    async def mocked_post(__, url, ___, **kwargs):
         if url[len(base_url):] in results_by_endpoint.keys():
             return results_by_endpoint.get(url[len(base_url):])
         else:
@@ -70,6 +83,21 @@ def create_get_text_mock(mocked_backend):
     return mocked_get_text
 
 
+def create_get_chunks_mock(mocked_backend):
+    results_by_endpoint = {d.get("endpoint"): d.get("result") for d in mocked_backend if d.get("type") == "csv"}
+
+    async def mocked_get_chunks(__, url, *args, **kwargs):
+        if url[len(base_url):] in results_by_endpoint.keys():
+            body = results_by_endpoint.get(url[len(base_url):]).encode('utf-8')
+            # deliver the body in small chunks to exercise chunk boundaries
+            for i in range(0, len(body), 7):
+                yield body[i:i + 7]
+        else:
+            raise Exception(f"Badly configured test queried url {url}, but endpoints {[base_url + endpoint for endpoint in results_by_endpoint.keys()]} was configured.")
+
+    return mocked_get_chunks
+
+
 # ConqueryConnection init test
 
 @pytest.mark.asyncio
@@ -79,6 +107,17 @@ async def test_cq_conn_init():
             pass
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize("error", [ConqueryServerError("busy", 503), asyncio.TimeoutError()])
+async def test_failed_connection_check_closes_session(mocker, error):
+    mocker.patch('cqapi.api.get', side_effect=error)
+    connection = ConqueryConnection(base_url, retry_policy=RetryPolicy(attempts=1))
+    with pytest.raises(type(error)):
+        async with connection:
+            pass
+    assert connection._session.closed
+
+
 # Backend mock fixture
 
 
@@ -87,6 +126,7 @@ def mock_backend(mocker, api_method, method_params, mocked_backend, expected_res
     mocker.patch('cqapi.api.get', side_effect=create_get_mock(mocked_backend))
     mocker.patch('cqapi.api.post', side_effect=create_post_mock(mocked_backend))
     mocker.patch('cqapi.api.get_text', side_effect=create_get_text_mock(mocked_backend))
+    mocker.patch('cqapi.api.get_chunks', side_effect=create_get_chunks_mock(mocked_backend))
 
 # Tests
 
@@ -103,3 +143,365 @@ async def test_api_methods(api_method, method_params, expected_result):
         result = await method_under_test(*method_params)
         assert expected_result == result
 
+
+
+# Polling tests
+
+
+def create_status_sequence_mock(statuses):
+    responses = iter(statuses)
+
+    async def mocked_get(__, url, **kwargs):
+        return {"id": "demo.query", "status": next(responses), "resultUrl": base_url + "/api/datasets/demo/result/demo.csv"}
+
+    return mocked_get
+
+
+@pytest.mark.asyncio
+async def test_wait_for_query_polls_until_done(mocker):
+    mocker.patch('cqapi.api.get', side_effect=create_status_sequence_mock(['NEW', 'RUNNING', 'RUNNING', 'DONE']))
+    metrics = InMemoryMetrics()
+    async with ConqueryConnection(base_url, check_connection=False, poll_backoff=Backoff(initial=0),
+                                  metrics=metrics) as cq:
+        response = await cq.wait_for_query("demo", "demo.query")
+        assert "DONE" == response["status"]
+        assert 4 == metrics.total(POLLS_PER_QUERY)
+        assert {} == cq._poll_counts
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("status", ["FAILED", "CANCELED"])
+async def test_wait_for_query_stops_on_failure(mocker, status):
+    mocker.patch('cqapi.api.get', side_effect=create_status_sequence_mock(['RUNNING', status, 'DONE']))
+    metrics = InMemoryMetrics()
+    async with ConqueryConnection(base_url, check_connection=False, poll_backoff=Backoff(initial=0),
+                                  metrics=metrics) as cq:
+        with pytest.raises(QueryFailedError) as e:
+            await cq.get_query_result("demo", "demo.query")
+        assert status == e.value.status
+        assert 2 == metrics.total(POLLS_PER_QUERY)
+
+
+@pytest.mark.asyncio
+async def test_wait_for_query_times_out(mocker):
+    mocker.patch('cqapi.api.get', side_effect=create_status_sequence_mock(['RUNNING'] * 1000))
+    metrics = InMemoryMetrics()
+    async with ConqueryConnection(base_url, check_connection=False, poll_backoff=Backoff(initial=0.01),
+                                  query_timeout=0.05, metrics=metrics) as cq:
+        with pytest.raises(QueryTimeoutError):
+            await cq.get_query_result("demo", "demo.query")
+        assert metrics.total(POLLS_PER_QUERY) < 10
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("shared_polling", [False, True])
+async def test_wait_for_unknown_query_fails(mocker, shared_polling):
+    async def mocked_get(__, url, **kwargs):
+        return {"code": 404, "message": "Query demo.expired not found"}
+
+    mocker.patch('cqapi.api.get', side_effect=mocked_get)
+    async with ConqueryConnection(base_url, check_connection=False, poll_backoff=Backoff(initial=0),
+                                  shared_polling=shared_polling) as cq:
+        with pytest.raises(ConqueryResponseError) as e:
+            await asyncio.wait_for(cq.wait_for_query("demo", "demo.expired"), 1)
+    assert 404 == e.value.status
+
+
+# Shared poller tests
+
+
+def create_multi_status_mock(polls_until_done, failing=(), executed=()):
+    polls = {query_id: 0 for query_id in executed}
+
+    async def mocked_get(__, url, **kwargs):
+        query_id = url.rsplit('/', 1)[-1]
+        if query_id == 'stored-queries':
+            for known_id in polls:
+                polls[known_id] += 1
+            return [{"id": known_id, "status": status_of(known_id)} for known_id in polls]
+        polls[query_id] = polls.get(query_id, 0) + 1
+        response = {"id": query_id, "status": status_of(query_id)}
+        if response["status"] == "DONE":
+            # like Conquery, only the query itself tells where its result is, not the listing
+            response["resultUrl"] = f"{base_url}/api/datasets/demo/result/{query_id}.csv"
+        return response
+
+    def status_of(query_id):
+        if query_id in failing:
+            return "FAILED"
+        return "DONE" if polls[query_id] >= polls_until_done else "RUNNING"
+
+    return mocked_get
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("query_count", [3, 50])
+async def test_shared_poller_resolves_all_queries(mocker, query_count):
+    query_ids = [f"demo.query{i}" for i in range(query_count)]
+    get_mock = mocker.patch('cqapi.api.get', side_effect=create_multi_status_mock(3, executed=query_ids))
+    async with ConqueryConnection(base_url, check_connection=False, poll_backoff=Backoff(initial=0),
+                                  shared_polling=True) as cq:
+        responses = await asyncio.gather(*[cq.wait_for_query("demo", query_id) for query_id in query_ids])
+        assert query_ids == [response["id"] for response in responses]
+        assert all(response["status"] == "DONE" for response in responses)
+        if query_count >= 8:
+            # many pending queries are polled through the listing, and only fetched one by one once they finished
+            assert get_mock.call_count < 2 * query_count
+
+
+@pytest.mark.asyncio
+async def test_shared_poller_fetches_queries_finished_in_the_listing(mocker):
+    query_ids = [f"demo.query{i}" for i in range(10)]
+    mocker.patch('cqapi.api.get', side_effect=create_multi_status_mock(2, executed=query_ids))
+    mocker.patch('cqapi.api.get_chunks', side_effect=create_bulk_backend_mock()[2])
+    async with ConqueryConnection(base_url, check_connection=False, poll_backoff=Backoff(initial=0),
+                                  shared_polling=True) as cq:
+        results = await asyncio.gather(*[cq.get_query_result("demo", query_id) for query_id in query_ids])
+    assert [[["query"], [query_id]] for query_id in query_ids] == results
+
+
+@pytest.mark.asyncio
+async def test_shared_poller_coalesces_waiters_and_reports_failures(mocker):
+    get_mock = mocker.patch('cqapi.api.get', side_effect=create_multi_status_mock(2, failing=("demo.failing",)))
+    async with ConqueryConnection(base_url, check_connection=False, poll_backoff=Backoff(initial=0),
+                                  shared_polling=True) as cq:
+        first, second = await asyncio.gather(cq.wait_for_query("demo", "demo.query"),
+                                             cq.wait_for_query("demo", "demo.query"))
+        assert first is second
+        assert 2 == get_mock.call_count
+        with pytest.raises(QueryFailedError):
+            await cq.wait_for_query("demo", "demo.failing")
+
+
+@pytest.mark.asyncio
+async def test_shared_poller_stops_polling_abandoned_queries(mocker):
+    mocker.patch('cqapi.api.get', side_effect=create_multi_status_mock(10 ** 6))
+    async with ConqueryConnection(base_url, check_connection=False, poll_backoff=Backoff(initial=0.01),
+                                  shared_polling=True) as cq:
+        with pytest.raises(QueryTimeoutError):
+            await cq.wait_for_query("demo", "demo.query", timeout=0.05)
+        await asyncio.sleep(0.02)
+        assert 0 == len(cq._poller)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("listing", ["Forbidden", {"code": 403, "message": "Forbidden"}, None])
+async def test_shared_poller_fails_waits_on_error_listings(mocker, listing):
+    async def mocked_get(__, url, **kwargs):
+        return listing
+
+    mocker.patch('cqapi.api.get', side_effect=mocked_get)
+    query_ids = [f"demo.query{i}" for i in range(10)]
+    async with ConqueryConnection(base_url, check_connection=False, poll_backoff=Backoff(initial=0),
+                                  shared_polling=True) as cq:
+        results = await asyncio.wait_for(asyncio.gather(*[cq.wait_for_query("demo", query_id)
+                                                          for query_id in query_ids], return_exceptions=True), 1)
+    assert all(isinstance(result, ConqueryResponseError) for result in results)
+
+
+@pytest.mark.asyncio
+async def test_shared_poller_fails_waits_if_it_breaks(mocker):
+    mocker.patch('cqapi.api.get', side_effect=create_multi_status_mock(10 ** 6))
+    mocker.patch('cqapi.poller.StatusPoller._sweep', side_effect=RuntimeError("broken"))
+    async with ConqueryConnection(base_url, check_connection=False, poll_backoff=Backoff(initial=0),
+                                  shared_polling=True) as cq:
+        with pytest.raises(RuntimeError):
+            await asyncio.wait_for(cq.wait_for_query("demo", "demo.query"), 1)
+        assert 0 == len(cq._poller)
+
+
+# Bulk execution tests
+
+
+def create_bulk_backend_mock(failing_queries=(), active=None):
+    active = active if active is not None else {"now": 0, "max": 0}
+
+    async def mocked_post(__, url, query, **kwargs):
+        if query["label"] in failing_queries:
+            return {"message": "Invalid query", "details": query["label"]}
+        active["now"] += 1
+        active["max"] = max(active["max"], active["now"])
+        return {"id": query["label"]}
+
+    async def mocked_get(__, url, **kwargs):
+        query_id = url.rsplit('/', 1)[-1]
+        await asyncio.sleep(0.001 * (hash(query_id) % 5))
+        return {"id": query_id, "status": "DONE", "resultUrl": f"{base_url}/api/datasets/demo/result/{query_id}.csv"}
+
+    async def mocked_get_chunks(__, url, *args, **kwargs):
+        active["now"] -= 1
+        yield f"query\n{url.rsplit('/', 1)[-1][:-len('.csv')]}\n".encode('utf-8')
+
+    return mocked_post, mocked_get, mocked_get_chunks
+
+
+def mock_bulk_backend(mocker, failing_queries=()):
+    active = {"now": 0, "max": 0}
+    mocked_post, mocked_get, mocked_get_chunks = create_bulk_backend_mock(failing_queries, active)
+    mocker.patch('cqapi.api.post', side_effect=mocked_post)
+    mocker.patch('cqapi.api.get', side_effect=mocked_get)
+    mocker.patch('cqapi.api.get_chunks', side_effect=mocked_get_chunks)
+    return active
+
+
+@pytest.mark.asyncio
+async def test_execute_many_returns_ordered_results_and_errors(mocker):
+    active = mock_bulk_backend(mocker, failing_queries=("q3",))
+    queries = [{"label": f"q{i}"} for i in range(20)]
+    async with ConqueryConnection(base_url, check_connection=False) as cq:
+        results = await cq.execute_many("demo", queries, max_concurrency=4)
+    assert 20 == len(results)
+    assert isinstance(results[3], ValueError)
+    for i, result in enumerate(results):
+        if i != 3:
+            assert [["query"], [f"q{i}"]] == result
+    assert active["max"] <= 4
+
+
+@pytest.mark.asyncio
+async def test_execute_many_as_completed_consumes_queries_lazily(mocker):
+    mock_bulk_backend(mocker)
+    consumed = []
+
+    def queries():
+        for i in range(10):
+            consumed.append(i)
+            yield {"label": f"q{i}"}
+
+    async with ConqueryConnection(base_url, check_connection=False) as cq:
+        seen = {}
+        async for index, result in cq.execute_many_as_completed("demo", queries(), max_concurrency=3):
+            assert len(consumed) <= len(seen) + 3
+            seen[index] = result
+    assert set(range(10)) == set(seen)
+    assert [["query"], ["q7"]] == seen[7]
+
+
+# Concept cache tests
+
+
+@pytest.mark.asyncio
+async def test_concept_cache_fetches_catalog_once(mocker):
+    concepts = tests_json["get_concepts"][0]["mocked_backend"][0]["result"]
+
+    async def mocked_get_conditional(__, url, etag=None, last_modified=None, **kwargs):
+        return concepts, None, None
+
+    get_mock = mocker.patch('cqapi.api.get_conditional', side_effect=mocked_get_conditional)
+    async with ConqueryConnection(base_url, check_connection=False, concept_cache=ConceptCache()) as cq:
+        for _ in range(100):
+            await cq.create_concept_query_with_selects("demo", "demo.icd")
+        assert 1 == get_mock.call_count
+        cq.invalidate_concepts("demo")
+        await cq.get_concepts("demo")
+        assert 2 == get_mock.call_count
+
+
+# Connection pool tests
+
+
+@pytest.mark.asyncio
+async def test_connection_pool_configuration():
+    async with ConqueryConnection(base_url, requests_timout=3, check_connection=False, pool_limit=20,
+                                  pool_limit_per_host=5, keepalive_timeout=30, read_timeout=60) as cq:
+        connector = cq._session.connector
+        assert (20, 5) == (connector.limit, connector.limit_per_host)
+        assert 3 == cq._session.timeout.sock_connect
+        assert 60 == cq._session.timeout.sock_read
+        session = cq._session
+    assert session.closed
+
+
+@pytest.mark.asyncio
+async def test_shared_session_is_not_closed():
+    session = create_session(limit=10)
+    try:
+        async with ConqueryConnection(base_url, check_connection=False, session=session) as first:
+            async with ConqueryConnection(base_url, check_connection=False, session=session) as second:
+                assert first._session is second._session
+        assert not session.closed
+    finally:
+        await session.close()
+
+
+# Result cache tests
+
+
+@pytest.mark.asyncio
+async def test_result_cache_skips_execution_of_cached_queries(mocker, tmp_path):
+    mock_bulk_backend(mocker)
+    post_mock = cqapi.api.post
+    result_cache = ResultCache(str(tmp_path))
+    async with ConqueryConnection(base_url, check_connection=False, result_cache=result_cache) as cq:
+        first_id = await cq.execute_query("demo", {"label": "q1", "type": "CONCEPT_QUERY"})
+        assert [["query"], ["q1"]] == await cq.get_query_result("demo", first_id)
+        assert 1 == post_mock.call_count
+
+        cached_id = await cq.execute_query("demo", {"type": "CONCEPT_QUERY", "label": "q1"})
+        assert first_id != cached_id
+        assert [["query"], ["q1"]] == await cq.get_query_result("demo", cached_id)
+        assert 1 == post_mock.call_count
+
+        # evicted between execution and fetching the result
+        result_cache.invalidate()
+        assert [["query"], ["q1"]] == await cq.get_query_result("demo", cached_id)
+        assert 2 == post_mock.call_count
+        assert {} == cq._result_cache_keys
+
+
+# Coalescing tests
+
+
+@pytest.mark.asyncio
+async def test_identical_concurrent_queries_are_executed_once(mocker):
+    mock_bulk_backend(mocker)
+    async with ConqueryConnection(base_url, check_connection=False, coalesce=True) as cq:
+        query = {"label": "q1", "type": "CONCEPT_QUERY"}
+        reordered_query = {"type": "CONCEPT_QUERY", "label": "q1"}
+
+        async def run(query):
+            query_id = await cq.execute_query("demo", query)
+            return await cq.get_query_result("demo", query_id)
+
+        results = await asyncio.gather(*[run(query) for _ in range(5)], run(reordered_query))
+        assert all(result is results[0] for result in results)
+        assert [["query"], ["q1"]] == results[0]
+        assert 1 == cqapi.api.post.call_count
+        assert {"executions": 1, "coalesced_executions": 5, "result_downloads": 1,
+                "coalesced_result_downloads": 5} == cq.coalescing_stats
+
+        # once the result was fetched, the query is executed anew
+        await run(query)
+        assert 2 == cqapi.api.post.call_count
+
+
+@pytest.mark.asyncio
+async def test_coalesced_executions_are_forgotten_once_failed_evicted_or_expired(mocker):
+    mock_bulk_backend(mocker)
+
+    async def mocked_get(__, url, **kwargs):
+        query_id = url.rsplit('/', 1)[-1]
+        return {"id": query_id, "status": "FAILED" if query_id == "failing" else "DONE"}
+
+    mocker.patch('cqapi.api.get', side_effect=mocked_get)
+    mocker.patch('cqapi.api.MAX_COALESCED_EXECUTIONS', 2)
+    async with ConqueryConnection(base_url, check_connection=False, coalesce=True, poll_backoff=Backoff(initial=0),
+                                  cancel_abandoned=False) as cq:
+        query_id = await cq.execute_query("demo", {"label": "failing"})
+        with pytest.raises(QueryFailedError):
+            await cq.wait_for_query("demo", query_id)
+        await cq.execute_query("demo", {"label": "failing"})
+        assert 2 == cqapi.api.post.call_count
+
+        # finished executions are shared until their result is fetched, as long as they are among the latest ones
+        query_id = await cq.execute_query("demo", {"label": "q1"})
+        await cq.wait_for_query("demo", query_id)
+        await cq.execute_query("demo", {"label": "q1"})
+        assert 3 == cqapi.api.post.call_count
+        await cq.execute_query("demo", {"label": "q2"})
+        await cq.execute_query("demo", {"label": "q1"})
+        assert 5 == cqapi.api.post.call_count
+
+        mocker.patch('cqapi.api.COALESCED_EXECUTION_SECONDS', 0)
+        await cq.execute_query("demo", {"label": "q1"})
+        assert 6 == cqapi.api.post.call_count
@@ -0,0 +1,163 @@
+from aiohttp import web
+from cqapi import ConqueryConnection
+from cqapi import ConqueryResponseError
+from cqapi.api import CACHED_RESULT_PREFIX
+from cqapi.cache import ConceptCache, ResultCache, canonical_query_key
+import asyncio
+import os
+import pytest
+import time
+
+
+def create_fetch_mock(responses):
+    calls = []
+
+    async def fetch(stale_entry):
+        calls.append(stale_entry)
+        return responses[len(calls) - 1]
+
+    return fetch, calls
+
+
+@pytest.mark.asyncio
+async def test_fresh_entries_are_served_from_cache():
+    cache = ConceptCache(ttl=60)
+    fetch, calls = create_fetch_mock([({"concepts": {}}, None, None)])
+    values = [await cache.fetch("url", "demo", fetch) for _ in range(10)]
+    assert 1 == len(calls)
+    assert all(value is values[0] for value in values)
+    assert (9, 1) == (cache.hits, cache.misses)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_misses_share_one_fetch():
+    cache = ConceptCache()
+
+    async def slow_fetch(stale_entry):
+        calls.append(stale_entry)
+        await asyncio.sleep(0.01)
+        return {"concepts": {}}, None, None
+
+    calls = []
+    await asyncio.gather(*[cache.fetch("url", "demo", slow_fetch) for _ in range(10)])
+    assert 1 == len(calls)
+
+
+@pytest.mark.asyncio
+async def test_stale_entries_are_revalidated():
+    cache = ConceptCache(ttl=0)
+    fetch, calls = create_fetch_mock([("v1", '"etag-1"', None), (None, '"etag-1"', None), ("v2", '"etag-2"', None)])
+    assert "v1" == await cache.fetch("url", "demo", fetch)
+    assert calls[0] is None
+    # not modified, keep the cached value
+    assert "v1" == await cache.fetch("url", "demo", fetch)
+    assert '"etag-1"' == calls[1].etag
+    assert "v2" == await cache.fetch("url", "demo", fetch)
+    assert 1 == cache.revalidations
+
+
+@pytest.mark.asyncio
+async def test_lru_eviction_and_invalidation():
+    cache = ConceptCache(max_entries=2)
+    fetch, __ = create_fetch_mock([("a", None, None), ("b", None, None), ("c", None, None)])
+    await cache.fetch("url/a", "demo", fetch)
+    await cache.fetch("url/b", "other", fetch)
+    # touch a, so b is the least recently used entry
+    await cache.fetch("url/a", "demo", fetch)
+    await cache.fetch("url/c", "other", fetch)
+    assert "url/a" in cache and "url/b" not in cache and "url/c" in cache
+
+    cache.invalidate("other")
+    assert "url/a" in cache and "url/c" not in cache
+    cache.invalidate()
+    assert 0 == len(cache)
+
+
+def test_canonical_query_key_ignores_key_order():
+    assert canonical_query_key("demo", {"type": "AND", "children": []}) == \
+        canonical_query_key("demo", {"children": [], "type": "AND"})
+    assert canonical_query_key("demo", {"type": "AND"}) != canonical_query_key("other", {"type": "AND"})
+
+
+def store(cache, key, body):
+    writer = cache.writer(key)
+    writer.write(body)
+    writer.commit()
+
+
+def test_result_cache_stores_and_reads_mapped_results(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    assert cache.open("key") is None
+
+    writer = cache.writer("key")
+    writer.write(b"a;b\n")
+    assert "key" not in cache
+    writer.write(b"1;2\n")
+    writer.commit()
+
+    assert "key" in cache
+    assert b"a;b\n1;2\n" == b"".join(cache.iter_chunks("key", chunk_size=3))
+    assert (1, 1) == (cache.hits, cache.misses)
+
+
+def test_result_cache_aborted_writes_are_discarded(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    writer = cache.writer("key")
+    writer.write(b"partial")
+    writer.abort()
+    assert "key" not in cache
+    assert [] == os.listdir(str(tmp_path))
+
+
+def test_result_cache_evicts_least_recently_used(tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=10)
+    store(cache, "first", b"1234")
+    store(cache, "second", b"1234")
+    past = time.time() - 100
+    os.utime(cache.path("first"), (past, past))
+    os.utime(cache.path("second"), (past + 1, past + 1))
+    # reading first makes second the least recently used result
+    cache.open("first").close()
+    store(cache, "third", b"1234")
+    assert "first" in cache and "second" not in cache and "third" in cache
+
+
+def test_result_cache_ttl(tmp_path):
+    cache = ResultCache(str(tmp_path), ttl=60)
+    store(cache, "key", b"1")
+    assert "key" in cache
+    past = time.time() - 61
+    os.utime(cache.path("key"), (past, past))
+    assert "key" not in cache
+    assert cache.iter_chunks("key") is None
+
+
+@pytest.mark.asyncio
+async def test_result_cache_never_stores_error_responses(tmp_path, serve):
+    async def execute(request):
+        return web.json_response({'id': 'demo.query'})
+
+    async def status(request):
+        return web.json_response({'id': 'demo.query', 'status': 'DONE',
+                                  'resultUrl': str(request.url.with_path('/api/datasets/demo/result/demo.query.csv'))})
+
+    async def result(request):
+        return web.json_response({'message': 'result expired'}, status=404)
+
+    server = await serve(('POST', '/api/datasets/demo/queries', execute),
+                         ('GET', '/api/datasets/demo/queries/{query_id}', status),
+                         ('GET', '/api/datasets/demo/result/{query_id}', result))
+    result_cache = ResultCache(str(tmp_path))
+    async with ConqueryConnection(str(server.make_url('/')), check_connection=False, result_cache=result_cache) as cq:
+        for __ in range(2):
+            query_id = await cq.execute_query('demo', {'type': 'CONCEPT_QUERY'})
+            assert not query_id.startswith(CACHED_RESULT_PREFIX)
+            with pytest.raises(ConqueryResponseError) as error:
+                await cq.get_query_result('demo', query_id)
+            assert 404 == error.value.status and 'result expired' in error.value.message
+
+
+def test_canonical_query_key_ignores_duplicate_selects():
+    query = {"type": "CONCEPT", "ids": ["a"], "selects": ["s1", "s2"]}
+    assert canonical_query_key("demo", query) == canonical_query_key("demo", dict(query, selects=["s1", "s2", "s1"]))
+    assert canonical_query_key("demo", query) != canonical_query_key("demo", dict(query, selects=["s2", "s1"]))
@@ -0,0 +1,153 @@
+from aiohttp import web
+from cqapi import Backoff
+from cqapi import ConqueryConnection
+from cqapi import InMemoryMetrics
+from cqapi import QueryTimeoutError
+from cqapi.metrics import POLLS
+import asyncio
+import itertools
+import pytest
+
+
+no_delay = Backoff(initial=0.01, jitter=0)
+
+
+async def start_server(serve, done_queries=()):
+    """ Server whose queries run until they are cancelled, except for done_queries. """
+    ids = itertools.count()
+    cancelled = []
+
+    async def execute(request):
+        return web.json_response({'id': f"demo.q{next(ids)}"})
+
+    async def status(request):
+        query_id = request.match_info['query_id']
+        if query_id in cancelled:
+            return web.json_response({'id': query_id, 'status': 'CANCELED'})
+        return web.json_response({'id': query_id, 'status': 'DONE' if query_id in done_queries else 'RUNNING'})
+
+    async def cancel(request):
+        cancelled.append(request.match_info['query_id'])
+        return web.Response()
+
+    server = await serve(('POST', '/api/datasets/demo/queries', execute),
+                         ('GET', '/api/datasets/demo/queries/{query_id}', status),
+                         ('POST', '/api/datasets/demo/queries/{query_id}/cancel', cancel))
+    return str(server.make_url('/')), cancelled
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("shared_polling", [False, True])
+async def test_timed_out_wait_cancels_query(shared_polling, serve):
+    url, cancelled = await start_server(serve)
+    async with ConqueryConnection(url, check_connection=False, poll_backoff=no_delay,
+                                  shared_polling=shared_polling) as cq:
+        query_id = await cq.execute_query('demo', {})
+        with pytest.raises(QueryTimeoutError):
+            await cq.get_query_result('demo', query_id, timeout=0.05)
+    assert [query_id] == cancelled
+
+
+@pytest.mark.asyncio
+async def test_cancelled_wait_cancels_query_once_nobody_waits(serve):
+    url, cancelled = await start_server(serve)
+    async with ConqueryConnection(url, check_connection=False, poll_backoff=no_delay) as cq:
+        query_id = await cq.execute_query('demo', {})
+        first = asyncio.ensure_future(cq.wait_for_query('demo', query_id))
+        second = asyncio.ensure_future(cq.wait_for_query('demo', query_id))
+        await asyncio.sleep(0.05)
+        first.cancel()
+        await asyncio.sleep(0.05)
+        assert [] == cancelled
+        second.cancel()
+        await asyncio.gather(first, second, return_exceptions=True)
+    assert [query_id] == cancelled
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("shared_polling", [False, True])
+async def test_cancelled_coalesced_results_cancel_query_once_nobody_waits(shared_polling, serve):
+    url, cancelled = await start_server(serve)
+    metrics = InMemoryMetrics()
+    async with ConqueryConnection(url, check_connection=False, poll_backoff=no_delay, coalesce=True,
+                                  shared_polling=shared_polling, metrics=metrics) as cq:
+        query_id = await cq.execute_query('demo', {})
+        first = asyncio.ensure_future(cq.get_query_result('demo', query_id))
+        second = asyncio.ensure_future(cq.get_query_result('demo', query_id))
+        await asyncio.sleep(0.05)
+        first.cancel()
+        await asyncio.sleep(0.05)
+        assert [] == cancelled
+        second.cancel()
+        await asyncio.gather(first, second, return_exceptions=True)
+        await asyncio.sleep(0.05)
+        assert [query_id] == cancelled
+        polls = metrics.total(POLLS)
+        await asyncio.sleep(0.05)
+        assert polls == metrics.total(POLLS)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("shared_polling", [False, True])
+async def test_coalesced_execution_is_cancelled_once_all_holders_gave_up(shared_polling, serve):
+    url, cancelled = await start_server(serve)
+    async with ConqueryConnection(url, check_connection=False, poll_backoff=no_delay, coalesce=True,
+                                  shared_polling=shared_polling) as cq:
+        first = await cq.execute_query('demo', {'query': 1})
+        second = await cq.execute_query('demo', {'query': 1})
+        assert first == second
+        with pytest.raises(QueryTimeoutError):
+            await cq.get_query_result('demo', first, timeout=0.05)
+        await asyncio.sleep(0.05)
+        assert [] == cancelled
+        with pytest.raises(QueryTimeoutError):
+            await cq.wait_for_query('demo', second, timeout=0.05)
+        await asyncio.sleep(0.05)
+        assert [first] == cancelled
+
+
+@pytest.mark.asyncio
+async def test_coalesced_execution_is_cancelled_once_all_holders_cancelled_shared_results(serve):
+    url, cancelled = await start_server(serve)
+    async with ConqueryConnection(url, check_connection=False, poll_backoff=no_delay, coalesce=True) as cq:
+        query_ids = [await cq.execute_query('demo', {'query': 1}) for __ in range(2)]
+        waiting = [asyncio.ensure_future(cq.get_query_result('demo', query_id)) for query_id in query_ids]
+        await asyncio.sleep(0.05)
+        for task in waiting:
+            task.cancel()
+        await asyncio.gather(*waiting, return_exceptions=True)
+        await asyncio.sleep(0.05)
+        assert query_ids[:1] == cancelled
+
+
+@pytest.mark.asyncio
+async def test_exit_cancels_coalesced_results(serve):
+    url, cancelled = await start_server(serve)
+    async with ConqueryConnection(url, check_connection=False, poll_backoff=no_delay, coalesce=True) as cq:
+        query_id = await cq.execute_query('demo', {})
+        waiting = asyncio.ensure_future(cq.get_query_result('demo', query_id))
+        await asyncio.sleep(0.05)
+    with pytest.raises(asyncio.CancelledError):
+        await waiting
+    assert [query_id] == cancelled
+
+
+@pytest.mark.asyncio
+async def test_abandoned_queries_are_kept_running_if_disabled(serve):
+    url, cancelled = await start_server(serve)
+    async with ConqueryConnection(url, check_connection=False, poll_backoff=no_delay,
+                                  cancel_abandoned=False) as cq:
+        query_id = await cq.execute_query('demo', {})
+        with pytest.raises(QueryTimeoutError):
+            await cq.wait_for_query('demo', query_id, timeout=0.05)
+    assert [] == cancelled
+
+
+@pytest.mark.asyncio
+async def test_exit_cancels_running_queries(serve):
+    url, cancelled = await start_server(serve, done_queries=['demo.q1'])
+    async with ConqueryConnection(url, check_connection=False, poll_backoff=no_delay, cancel_on_exit=True) as cq:
+        running = await cq.execute_query('demo', {})
+        done = await cq.execute_query('demo', {})
+        await cq.wait_for_query('demo', done)
+    assert [running] == cancelled
@@ -0,0 +1,82 @@
+from aiohttp import web
+from cqapi import ConqueryConnection
+from cqapi.codec import LazyObject, available_codecs, get_codec
+import json
+import pytest
+
+
+catalog = {
+    "concepts": {
+        "demo.icd": {"label": "ICD", "children": ["demo.icd.a"], "description": "braces } and \"quotes\" ["},
+        "demo.age": {"label": "Age, in years: {}", "tables": [{"id": "demo.table", "selects": []}]},
+        "demo.empty": {},
+    },
+    "version": 3,
+}
+
+
+@pytest.mark.parametrize("name", available_codecs())
+def test_codecs_round_trip(name):
+    codec = get_codec(name)
+    assert catalog == codec.loads(codec.dumps(catalog))
+    assert isinstance(codec.dumps(catalog), bytes)
+
+
+def test_get_codec_rejects_unknown_codecs():
+    assert available_codecs()[0] == get_codec().name
+    assert 'json' in available_codecs()
+    with pytest.raises(ValueError):
+        get_codec('pickle')
+
+
+@pytest.mark.parametrize("indent", [None, 2])
+def test_lazy_object_decodes_members_on_access(indent):
+    lazy = LazyObject(f"  {json.dumps(catalog, indent=indent)}\n".encode('utf-8'))
+    assert ['concepts', 'version'] == list(lazy)
+    assert 3 == lazy['version']
+
+    concepts = lazy.lazy('concepts')
+    assert 3 == len(concepts) and 'demo.age' in concepts and 'demo.other' not in concepts
+    assert catalog['concepts']['demo.icd'] == concepts['demo.icd']
+    assert concepts['demo.icd'] is concepts['demo.icd']
+    assert catalog == {'concepts': dict(concepts), 'version': 3}
+    assert concepts is lazy.lazy('concepts')
+    with pytest.raises(TypeError):
+        lazy.lazy('version')
+    with pytest.raises(KeyError):
+        concepts['demo.other']
+
+
+def test_lazy_object_scans_only_up_to_accessed_members():
+    lazy = LazyObject(b'{"concepts": {"a": 1, "b": 2,, "c"}, "version": 3}')
+    assert 1 == lazy.lazy('concepts')['a']
+    with pytest.raises(ValueError):
+        lazy['version']
+
+
+def test_lazy_object_rejects_invalid_json():
+    with pytest.raises(ValueError):
+        LazyObject(b'[1, 2]')
+    with pytest.raises(ValueError):
+        dict(LazyObject(b'{"a": {"b": 1}'))
+    with pytest.raises(ValueError):
+        len(LazyObject(b'{"a" 1}'))
+
+
+async def start_concept_server(serve):
+    async def concepts(request):
+        return web.json_response(catalog)
+
+    return await serve(('GET', '/api/datasets/demo/concepts', concepts))
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("json_codec", available_codecs())
+async def test_get_concepts_with_codecs(json_codec, serve):
+    server = await start_concept_server(serve)
+    url = str(server.make_url('/'))
+    async with ConqueryConnection(url, check_connection=False, json_codec=json_codec) as cq:
+        assert catalog['concepts'] == await cq.get_concepts('demo')
+        lazy_concepts = await cq.get_concepts('demo', lazy=True)
+    assert isinstance(lazy_concepts, LazyObject)
+    assert catalog['concepts'] == dict(lazy_concepts)
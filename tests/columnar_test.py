@@ -0,0 +1,128 @@
+from cqapi import ConqueryConnection
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from cqapi.columnar import ColumnarDecoder, DateRangeColumn, DictionaryColumn, decode_columns
+
+
+base_url = "http://localhost:9085"
+
+rows = [
+    ['result', 'count', 'share', 'first', 'dates', 'label', 'label'],
+    ['1|A', '3', '0.5', '2005-01-01', '{2005-01-01/2005-01-31, 2006-01-01/}', 'x', 'a'],
+    ['2|B', '', '', '', '', '', 'b'],
+    ['3|C', '42', '1', '2005-03-31', '{/2007-12-31}', 'x', 'a'],
+]
+
+
+def test_decode_infers_column_types():
+    columns = decode_columns(rows)
+    assert ['result', 'count', 'share', 'first', 'dates', 'label', 'label_1'] == list(columns)
+
+    assert columns['count'].dtype == np.float64
+    assert [3.0, 42.0] == columns['count'][[0, 2]].tolist() and np.isnan(columns['count'][1])
+    assert columns['share'].dtype == np.float64
+    assert columns['first'].dtype == np.dtype('datetime64[D]')
+    assert ['2005-01-01', 'NaT', '2005-03-31'] == np.datetime_as_string(columns['first']).tolist()
+
+    dates = columns['dates']
+    assert isinstance(dates, DateRangeColumn)
+    assert 3 == len(dates)
+    assert [0, 2, 2, 3] == dates.offsets.tolist()
+    assert [(np.datetime64('2005-01-01'), np.datetime64('2005-01-31'))] == dates[0][:1]
+    assert np.isnat(dates.ends[1]) and np.isnat(dates.starts[2])
+    assert [] == dates[1]
+
+    label = columns['label']
+    assert isinstance(label, DictionaryColumn)
+    assert ['x'] == label.categories
+    assert [0, -1, 0] == label.codes.tolist()
+    assert ['x', None, 'x'] == label.to_list()
+    assert ['1|A', '2|B', '3|C'] == columns['result'].to_list()
+
+
+def test_int_column_without_empty_cells_stays_int():
+    columns = decode_columns([['n'], ['1'], ['-2']])
+    assert columns['n'].dtype == np.int64
+    assert [1, -2] == columns['n'].tolist()
+
+
+def test_large_ints_in_columns_with_empty_cells_stay_exact():
+    decoder = ColumnarDecoder()
+    decoder.feed([['id'], ['12345678901234567']])
+    decoder.feed([[''], ['3']])
+    ids = decoder.finish()['id']
+    assert ids.dtype == np.int64
+    assert [12345678901234567, None, 3] == ids.tolist()
+
+
+def test_declared_types_are_not_inferred():
+    columns = decode_columns([['pid', 'n'], ['007', '1'], ['008', '2']], dtypes={'pid': 'string', 'n': 'float'})
+    assert ['007', '008'] == columns['pid'].to_list()
+    assert columns['n'].dtype == np.float64
+
+    with pytest.raises(ValueError):
+        decode_columns([['n'], ['a']], dtypes={'n': 'int'})
+    with pytest.raises(ValueError):
+        ColumnarDecoder({'n': 'decimal'})
+
+
+def test_later_floats_widen_inferred_ints():
+    decoder = ColumnarDecoder()
+    decoder.feed([['n'], ['1'], ['2']])
+    decoder.feed([['1.5']])
+    assert [1.0, 2.0, 1.5] == decoder.finish()['n'].tolist()
+
+
+def test_later_values_not_matching_inferred_types_raise():
+    decoder = ColumnarDecoder()
+    decoder.feed([['n', 'big'], ['7', str(2 ** 60)], ['10', '1']])
+    with pytest.raises(ValueError):
+        decoder.feed([['A12', '0']])
+    with pytest.raises(ValueError):
+        decoder.feed([['1', '1.5']])
+
+
+def test_numbers_with_leading_zeros_are_inferred_as_strings():
+    decoder = ColumnarDecoder()
+    decoder.feed([['id'], ['007'], ['010']])
+    decoder.feed([['A12']])
+    assert ['007', '010', 'A12'] == decoder.finish()['id'].to_list()
+
+
+def test_batches_with_only_empty_cells_are_deferred():
+    decoder = ColumnarDecoder()
+    decoder.feed([['d', 'e'], ['', ''], ['', '']])
+    decoder.feed([['2020-02-29', ''], ['', '']])
+    columns = decoder.finish()
+    assert ['NaT', 'NaT', '2020-02-29', 'NaT'] == np.datetime_as_string(columns['d']).tolist()
+    assert [None] * 4 == columns['e'].to_list()
+
+
+def test_date_ranges_are_concatenated_across_batches():
+    decoder = ColumnarDecoder()
+    decoder.feed([['dates'], ['{2005-01-01/2005-01-31}']])
+    decoder.feed([[''], ['{2006-01-01/2006-01-02, 2007-01-01/2007-01-02}']])
+    dates = decoder.finish()['dates']
+    assert [0, 1, 1, 3] == dates.offsets.tolist()
+    assert ['2006-01-01', '2007-01-01'] == np.datetime_as_string(dates.starts[1:]).tolist()
+
+
+@pytest.mark.asyncio
+async def test_get_query_result_columns(mocker):
+    body = '\n'.join(';'.join(row) for row in rows).encode('utf-8')
+
+    async def mocked_get(__, url, **kwargs):
+        return {"id": "q1", "status": "DONE", "resultUrl": f"{base_url}/result/q1.csv"}
+
+    async def mocked_get_chunks(__, url, *args, **kwargs):
+        for i in range(0, len(body), 5):
+            yield body[i:i + 5]
+
+    mocker.patch('cqapi.api.get', side_effect=mocked_get)
+    mocker.patch('cqapi.api.get_chunks', side_effect=mocked_get_chunks)
+    async with ConqueryConnection(base_url, check_connection=False) as cq:
+        columns = await cq.get_query_result_columns("demo", "q1", dtypes={'count': 'string'})
+    assert ['3', None, '42'] == columns['count'].to_list()
+    assert [0.5, 1.0] == columns['share'][[0, 2]].tolist()
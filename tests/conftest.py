@@ -0,0 +1,32 @@
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+import pytest
+import pytest_asyncio
+
+
+# pytest-asyncio before 0.17 runs async fixtures declared with pytest.fixture
+async_fixture = getattr(pytest_asyncio, 'fixture', pytest.fixture)
+
+
+@async_fixture
+async def serve():
+    """ Starts local servers answering the given routes, closed at the end of the test.
+
+    :example:
+    >>> server = await serve(('GET', '/api/datasets', datasets))
+    >>> url = str(server.make_url('/'))
+    """
+    servers = []
+
+    async def start(*routes):
+        app = web.Application()
+        for method, path, handler in routes:
+            app.router.add_route(method, path, handler)
+        server = TestServer(app)
+        await server.start_server()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        await server.close()
@@ -0,0 +1,93 @@
+from cqapi import ConqueryConnection
+from cqapi import ConceptSnapshot
+import asyncio
+import pytest
+
+
+base_url = "http://localhost:9085"
+
+
+def create_hierarchy(width=3, depth=3):
+    """ Concept nodes of a tree with the given width and depth below two top-level concepts. """
+    nodes = {}
+
+    def add(node_id, level):
+        children = [f"{node_id}.{i}" for i in range(width)] if level < depth else []
+        nodes[node_id] = {"label": node_id, "children": children}
+        for child_id in children:
+            add(child_id, level + 1)
+
+    add("demo.icd", 0)
+    add("demo.ops", 0)
+    return nodes
+
+
+def mock_concept_backend(mocker, nodes, inline=(), current_etag=None):
+    """ Concept endpoints answering with a node, and its whole subtree for nodes in inline. """
+    active = {"now": 0, "max": 0, "requests": 0, "not_modified": 0}
+
+    def response(concept_id):
+        if concept_id not in inline:
+            return {concept_id: nodes[concept_id]}
+        subtree = {node_id: node for node_id, node in nodes.items()
+                   if node_id == concept_id or node_id.startswith(concept_id + '.')}
+        return subtree
+
+    async def mocked_get(__, url, **kwargs):
+        body, __, __ = await mocked_get_conditional(__, url)
+        return body
+
+    async def mocked_get_conditional(__, url, etag=None, last_modified=None, **kwargs):
+        active["requests"] += 1
+        active["now"] += 1
+        active["max"] = max(active["max"], active["now"])
+        await asyncio.sleep(0.001)
+        active["now"] -= 1
+        if url.endswith('/concepts'):
+            return {"concepts": {"demo.icd": {}, "demo.ops": {}}}, None, None
+        if current_etag is not None and etag == current_etag:
+            active["not_modified"] += 1
+            return None, etag, None
+        return response(url.rsplit('/', 1)[-1]), current_etag, None
+
+    mocker.patch('cqapi.api.get', side_effect=mocked_get)
+    mocker.patch('cqapi.api.get_conditional', side_effect=mocked_get_conditional)
+    return active
+
+
+@pytest.mark.asyncio
+async def test_crawl_fetches_each_node_once_with_bounded_concurrency(mocker):
+    nodes = create_hierarchy()
+    active = mock_concept_backend(mocker, nodes, inline=("demo.icd.1",))
+    async with ConqueryConnection(base_url, check_connection=False) as cq:
+        crawled = [item async for item in cq.crawl_concepts("demo", max_concurrency=4)]
+    assert sorted(nodes.items()) == sorted(crawled)
+    # the listing plus all nodes except the inlined descendants of demo.icd.1
+    assert 1 + len(nodes) - 12 == active["requests"]
+    assert 4 == active["max"]
+
+
+@pytest.mark.asyncio
+async def test_crawl_stops_at_max_depth(mocker):
+    nodes = create_hierarchy()
+    mock_concept_backend(mocker, nodes, inline=("demo.icd",))
+    async with ConqueryConnection(base_url, check_connection=False) as cq:
+        crawled = [node_id async for node_id, __ in cq.crawl_concepts("demo", roots=["demo.icd", "demo.ops"],
+                                                                       max_depth=1)]
+    assert sorted(["demo.icd", "demo.ops"] + [f"{root}.{i}" for root in ("demo.icd", "demo.ops") for i in range(3)]) \
+        == sorted(crawled)
+
+
+@pytest.mark.asyncio
+async def test_crawl_revalidates_snapshot(mocker, tmp_path):
+    nodes = create_hierarchy(width=2, depth=2)
+    active = mock_concept_backend(mocker, nodes, current_etag='"v1"')
+    path = str(tmp_path / "concepts.json")
+    async with ConqueryConnection(base_url, check_connection=False) as cq:
+        first = [item async for item in cq.crawl_concepts("demo", snapshot=ConceptSnapshot(path))]
+        snapshot = ConceptSnapshot(path)
+        assert len(nodes) == len(snapshot)
+        second = [item async for item in cq.crawl_concepts("demo", snapshot=snapshot)]
+    assert sorted(first) == sorted(second) == sorted(nodes.items())
+    assert len(nodes) == active["not_modified"] == snapshot.unchanged
+    assert 0 == snapshot.fetched
@@ -0,0 +1,122 @@
+from aiohttp import ClientPayloadError
+from aiohttp import web
+from cqapi import Backoff
+from cqapi import ConqueryConnection
+from cqapi.download import download_ranges, iter_resumable
+import cqapi.api
+import cqapi.download
+import os
+import pytest
+
+
+base_url = "http://localhost:9085"
+
+body = b''.join(f"{i}|ID;{i * 7}\n".encode('utf-8') for i in range(20000))
+
+no_delay = Backoff(initial=0, jitter=0)
+
+
+def create_flaky_get_chunks(failures):
+    """ get_chunks mock failing after delivering the given numbers of bytes, one failure per request. """
+    requests = []
+    failures = list(failures)
+
+    async def flaky_get_chunks(url, start=0, end=None):
+        requests.append((start, end))
+        fail_at = start + failures.pop(0) if failures else None
+        end = len(body) if end is None else end
+        for offset in range(start, end, 1000):
+            if fail_at is not None and offset >= fail_at:
+                raise ClientPayloadError("Connection lost")
+            yield body[offset:min(offset + 1000, end)]
+
+    return flaky_get_chunks, requests
+
+
+@pytest.mark.asyncio
+async def test_iter_resumable_resumes_at_received_offset():
+    get_chunks, requests = create_flaky_get_chunks([5000, 3000])
+    chunks = [chunk async for chunk in iter_resumable(get_chunks, "url", backoff=no_delay)]
+    assert body == b''.join(chunks)
+    assert [(0, None), (5000, None), (8000, None)] == requests
+
+
+@pytest.mark.asyncio
+async def test_iter_resumable_gives_up_after_consecutive_failures():
+    get_chunks, requests = create_flaky_get_chunks([1000, 0, 0, 0])
+    with pytest.raises(ClientPayloadError):
+        async for __ in iter_resumable(get_chunks, "url", retries=2, backoff=no_delay):
+            pass
+    assert [(0, None), (1000, None), (1000, None)] == requests
+
+
+@pytest.mark.asyncio
+async def test_download_ranges_stitches_ranges(tmp_path, monkeypatch):
+    monkeypatch.setattr(cqapi.download, 'MIN_RANGE_BYTES', 10000)
+    get_chunks, requests = create_flaky_get_chunks([4000])
+    path = str(tmp_path / "result.spool")
+    await download_ranges(get_chunks, "url", len(body), path, ranges=4, backoff=no_delay)
+    with open(path, 'rb') as file:
+        assert body == file.read()
+    assert 5 == len(requests)
+
+
+async def start_result_server(serve, supports_ranges=True, fail_first=True):
+    requests = []
+
+    async def result(request):
+        start, end = 0, len(body)
+        range_header = request.headers.get('Range')
+        if supports_ranges and range_header:
+            first, __, last = range_header[len('bytes='):].partition('-')
+            start, end = int(first), int(last) + 1 if last else len(body)
+        requests.append(range_header)
+        response = web.StreamResponse(status=206 if start or end < len(body) else 200)
+        if response.status == 206:
+            response.headers['Content-Range'] = f"bytes {start}-{end - 1}/{len(body)}"
+        response.content_length = end - start
+        await response.prepare(request)
+        if fail_first and len(requests) == 1:
+            await response.write(body[start:start + (end - start) // 2])
+            request.transport.close()
+            return response
+        await response.write(body[start:end])
+        return response
+
+    server = await serve(('GET', '/result.csv', result))
+    return server, requests
+
+
+def mock_done_query(mocker, result_url):
+    async def mocked_get(__, url, **kwargs):
+        return {"id": "q1", "status": "DONE", "resultUrl": result_url}
+
+    mocker.patch('cqapi.api.get', side_effect=mocked_get)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("supports_ranges", [True, False])
+async def test_result_download_resumes_after_connection_loss(mocker, supports_ranges, serve):
+    server, requests = await start_result_server(serve, supports_ranges)
+    mock_done_query(mocker, str(server.make_url('/result.csv')))
+    async with ConqueryConnection(base_url, check_connection=False) as cq:
+        rows = await cq.get_query_result("demo", "q1")
+    assert 20000 == len(rows) and ['19999|ID', '139993'] == rows[-1]
+    assert 2 == len(requests)
+    assert requests[1] is not None and requests[1].startswith('bytes=')
+
+
+@pytest.mark.asyncio
+async def test_large_results_are_downloaded_in_parallel_ranges(mocker, monkeypatch, tmp_path, serve):
+    monkeypatch.setattr(cqapi.api, 'MIN_RANGE_BYTES', 10000)
+    monkeypatch.setattr(cqapi.download, 'MIN_RANGE_BYTES', 10000)
+    server, requests = await start_result_server(serve, fail_first=False)
+    mock_done_query(mocker, str(server.make_url('/result.csv')))
+    async with ConqueryConnection(base_url, check_connection=False, download_ranges=4,
+                                  spool_directory=str(tmp_path)) as cq:
+        rows = await cq.get_query_result("demo", "q1")
+    assert 20000 == len(rows)
+    # the length probe and four ranges
+    assert 5 == len(requests)
+    assert [] == os.listdir(str(tmp_path))
+
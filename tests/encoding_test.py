@@ -0,0 +1,75 @@
+from aiohttp import ClientSession
+from aiohttp import web
+from cqapi import create_session
+from cqapi.encoding import StreamDecoder, TransferStats
+import cqapi.api
+import gzip
+import json
+import pytest
+import zlib
+
+
+body = ('result;dates\n' + '1|A;{2005-01-01/2005-01-31}\n' * 1000).encode('utf-8')
+
+
+def compress_deflate(data, wbits):
+    compressor = zlib.compressobj(wbits=wbits)
+    return compressor.compress(data) + compressor.flush()
+
+
+@pytest.mark.parametrize("encoding, compressed", [
+    ('gzip', gzip.compress(body)),
+    ('deflate', zlib.compress(body)),
+    ('deflate', compress_deflate(body, -zlib.MAX_WBITS)),
+    ('identity', body),
+    (None, body),
+])
+def test_stream_decoder_decodes_in_chunks(encoding, compressed):
+    decoder = StreamDecoder(encoding)
+    decoded = b''.join(decoder.decompress(compressed[i:i + 7]) for i in range(0, len(compressed), 7))
+    assert body == decoded + decoder.flush()
+
+
+def test_stream_decoder_rejects_unknown_encodings():
+    with pytest.raises(ValueError):
+        StreamDecoder('compress')
+
+
+async def start_compressing_server(serve):
+    async def result(request):
+        assert 'gzip' in request.headers['Accept-Encoding']
+        return web.Response(body=gzip.compress(body), headers={'Content-Encoding': 'gzip'})
+
+    async def concepts(request):
+        return web.Response(body=gzip.compress(json.dumps({'concept1': {}}).encode('utf-8')),
+                            headers={'Content-Encoding': 'gzip', 'Content-Type': 'application/json'})
+
+    return await serve(('GET', '/result.csv', result),
+                        ('GET', '/concepts', concepts))
+
+
+@pytest.mark.asyncio
+async def test_helpers_decompress_and_count_bytes(serve):
+    stats = TransferStats()
+    server = await start_compressing_server(serve)
+    async with create_session() as session:
+        url = str(server.make_url('/result.csv'))
+        chunks = [chunk async for chunk in cqapi.api.get_chunks(session, url, stats=stats)]
+        assert body == b''.join(chunks)
+        assert len(body) == stats.decoded_bytes
+        assert len(gzip.compress(body)) == stats.wire_bytes
+        assert stats.compression_ratio > 10
+
+        assert {'concept1': {}} == await cqapi.api.get(session, str(server.make_url('/concepts')), stats)
+        assert 2 == stats.responses
+
+
+@pytest.mark.asyncio
+async def test_helpers_leave_decompression_to_decompressing_sessions(serve):
+    stats = TransferStats()
+    server = await start_compressing_server(serve)
+    async with ClientSession() as session:
+        url = str(server.make_url('/result.csv'))
+        chunks = [chunk async for chunk in cqapi.api.get_chunks(session, url, stats=stats)]
+    assert body == b''.join(chunks)
+    assert stats.wire_bytes == stats.decoded_bytes == len(body)
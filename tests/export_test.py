@@ -0,0 +1,99 @@
+from cqapi import ConqueryConnection
+from datetime import date
+import os
+import pytest
+
+pa = pytest.importorskip('pyarrow')
+pytest.importorskip('numpy')
+import pyarrow.parquet as pq
+
+from cqapi.export import TableWriter
+
+
+base_url = "http://localhost:9085"
+
+rows = [
+    ['result', 'count', 'first', 'dates', 'label'],
+    ['1|A', '3', '2005-01-01', '{2005-01-01/2005-01-31, 2006-01-01/}', 'x'],
+    ['2|B', '', '', '', ''],
+    ['3|C', '42', '2005-03-31', '{/2007-12-31}', 'x'],
+]
+
+
+def read_arrow(path):
+    with pa.ipc.open_file(path) as reader:
+        return reader.read_all()
+
+
+@pytest.mark.parametrize("format, read", [('parquet', pq.read_table), ('arrow', read_arrow)])
+def test_table_writer_writes_typed_row_groups(tmp_path, format, read):
+    path = str(tmp_path / f"result.{format}")
+    writer = TableWriter(path, format, row_group_size=2)
+    writer.write_rows(rows[:2])
+    writer.write_rows(rows[2:])
+    assert 3 == writer.close()
+
+    table = read(path)
+    assert ['result', 'count', 'first', 'dates', 'label'] == table.column_names
+    assert pa.int64() == table.schema.field('count').type
+    assert pa.date32() == table.schema.field('first').type
+    assert [3, None, 42] == table.column('count').to_pylist()
+    assert [[{'start': date(2005, 1, 1), 'end': date(2005, 1, 31)}, {'start': date(2006, 1, 1), 'end': None}],
+            [],
+            [{'start': None, 'end': date(2007, 12, 31)}]] == table.column('dates').to_pylist()
+    assert ['x', None, 'x'] == table.column('label').to_pylist()
+    if format == 'parquet':
+        assert 2 == pq.ParquetFile(path).num_row_groups
+
+
+def test_table_writer_rejects_values_not_matching_first_row_group(tmp_path):
+    path = str(tmp_path / "result.parquet")
+    writer = TableWriter(path, row_group_size=1)
+    with pytest.raises(ValueError):
+        writer.write_rows([['n'], ['1'], ['a']])
+    writer.abort()
+    assert [] == os.listdir(str(tmp_path))
+
+    writer = TableWriter(path, dtypes={'n': 'string'}, row_group_size=1)
+    writer.write_rows([['n'], ['1'], ['a']])
+    writer.close()
+    assert ['1', 'a'] == pq.read_table(path).column('n').to_pylist()
+
+
+def mock_result(mocker, body, fail_after=None):
+    async def mocked_get(__, url, **kwargs):
+        return {"id": "q1", "status": "DONE", "resultUrl": f"{base_url}/result/q1.csv"}
+
+    async def mocked_get_chunks(__, url, *args, **kwargs):
+        for i in range(0, len(body), 5):
+            if fail_after is not None and i >= fail_after:
+                raise ConnectionResetError()
+            yield body[i:i + 5]
+
+    mocker.patch('cqapi.api.get', side_effect=mocked_get)
+    mocker.patch('cqapi.api.get_chunks', side_effect=mocked_get_chunks)
+
+
+@pytest.mark.asyncio
+async def test_export_query_result(mocker, tmp_path):
+    body = '\n'.join(';'.join(row) for row in rows).encode('utf-8') + b'\n'
+    mock_result(mocker, body)
+    async with ConqueryConnection(base_url, check_connection=False) as cq:
+        await cq.export_query_result("demo", "q1", str(tmp_path / "result.parquet"), row_group_size=2)
+        await cq.export_query_result("demo", "q1", str(tmp_path / "result.csv"), format='csv')
+        with pytest.raises(ValueError):
+            await cq.export_query_result("demo", "q1", str(tmp_path / "result.json"), format='json')
+
+    assert ['1|A', '2|B', '3|C'] == pq.read_table(str(tmp_path / "result.parquet")).column('result').to_pylist()
+    with open(str(tmp_path / "result.csv"), 'rb') as file:
+        assert body == file.read()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("format", ['parquet', 'csv'])
+async def test_failed_export_leaves_no_file(mocker, tmp_path, format):
+    mock_result(mocker, '\n'.join(';'.join(row) for row in rows).encode('utf-8'), fail_after=20)
+    async with ConqueryConnection(base_url, check_connection=False) as cq:
+        with pytest.raises(ConnectionResetError):
+            await cq.export_query_result("demo", "q1", str(tmp_path / f"result.{format}"), format=format)
+    assert [] == os.listdir(str(tmp_path))
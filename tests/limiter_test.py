@@ -0,0 +1,126 @@
+from aiohttp import web
+from cqapi import AdaptiveLimiter
+from cqapi import ConqueryConnection
+from cqapi import ConqueryServerError
+from cqapi import InMemoryMetrics
+from cqapi import RetryPolicy
+from cqapi.metrics import LIMITER_LIMIT, LIMITER_WAIT_SECONDS
+import asyncio
+import pytest
+
+
+async def request(limiter, error=None, seconds=0):
+    async with limiter.slot():
+        await asyncio.sleep(seconds)
+        if error is not None:
+            raise error
+
+
+@pytest.mark.asyncio
+async def test_limiter_limits_concurrency():
+    limiter = AdaptiveLimiter(initial_limit=2, target_latency=None)
+    peak = 0
+
+    async def tracked():
+        nonlocal peak
+        async with limiter.slot():
+            peak = max(peak, limiter.in_flight)
+            await asyncio.sleep(0.01)
+
+    await asyncio.gather(*[tracked() for __ in range(6)])
+    assert 2 == peak
+    assert 0 == limiter.in_flight
+
+
+@pytest.mark.asyncio
+async def test_limiter_raises_limit_while_requests_succeed():
+    limiter = AdaptiveLimiter(initial_limit=2, max_limit=4, target_latency=1.0)
+    for __ in range(5):
+        await asyncio.gather(*[request(limiter) for __ in range(limiter.limit)])
+    assert 4 == limiter.limit
+
+
+@pytest.mark.asyncio
+async def test_limiter_cuts_limit_once_per_burst_of_failures():
+    limiter = AdaptiveLimiter(initial_limit=8, target_latency=None)
+    results = await asyncio.gather(*[request(limiter, ConqueryServerError("busy", 503)) for __ in range(8)],
+                                   return_exceptions=True)
+    assert all(isinstance(result, ConqueryServerError) for result in results)
+    assert 4 == limiter.limit
+
+    await asyncio.gather(request(limiter, asyncio.TimeoutError()), return_exceptions=True)
+    assert 2 == limiter.limit
+
+
+@pytest.mark.asyncio
+async def test_limiter_cuts_limit_on_slow_requests_only():
+    limiter = AdaptiveLimiter(initial_limit=4, target_latency=0.01)
+    await request(limiter, seconds=0.05)
+    assert 2 == limiter.limit
+
+    with pytest.raises(ValueError):
+        await request(limiter, ValueError("invalid query"))
+    assert 2 == limiter.limit and 0 == limiter.in_flight
+
+
+@pytest.mark.asyncio
+async def test_cancelled_waiter_gives_up_its_place():
+    metrics = InMemoryMetrics()
+    limiter = AdaptiveLimiter('test', initial_limit=1, target_latency=None, metrics=metrics)
+    first = asyncio.ensure_future(request(limiter, seconds=0.02))
+    second = asyncio.ensure_future(request(limiter))
+    third = asyncio.ensure_future(request(limiter))
+    await asyncio.sleep(0)
+    second.cancel()
+    await asyncio.gather(first, third)
+    assert second.cancelled()
+    assert 0 == limiter.in_flight
+    assert 1 == metrics.count(LIMITER_WAIT_SECONDS, limiter='test')
+    assert limiter.limit == metrics.value(LIMITER_LIMIT, limiter='test')
+
+
+async def start_overloaded_server(serve, overloaded_requests):
+    requests = []
+
+    async def execute(request):
+        requests.append(request)
+        if len(requests) <= overloaded_requests:
+            return web.Response(status=503, text="Service Unavailable", headers={'Retry-After': '2'})
+        return web.json_response({'id': 'demo.query'})
+
+    async def status(request):
+        return web.Response(status=503, text="Service Unavailable")
+
+    server = await serve(('POST', '/api/datasets/demo/queries', execute),
+                         ('GET', '/api/datasets/demo/queries/{query_id}', status))
+    return str(server.make_url('/'))
+
+
+@pytest.mark.asyncio
+async def test_connection_cuts_execute_limit_on_server_errors(serve):
+    metrics = InMemoryMetrics()
+    url = await start_overloaded_server(serve, overloaded_requests=1)
+    async with ConqueryConnection(url, check_connection=False, metrics=metrics, adaptive_limits=True) as cq:
+        assert 8 == cq.limits['execute']
+        with pytest.raises(ConqueryServerError) as error:
+            await cq.execute_query('demo', {})
+        assert 503 == error.value.status and 2 == error.value.retry_after
+        assert 4 == cq.limits['execute']
+        assert 'demo.query' == await cq.execute_query('demo', {})
+    assert 4 == metrics.value(LIMITER_LIMIT, limiter='execute')
+    assert 8 == metrics.value(LIMITER_LIMIT, limiter='poll')
+
+
+@pytest.mark.asyncio
+async def test_shared_poller_survives_server_errors(serve):
+    url = await start_overloaded_server(serve, overloaded_requests=0)
+    async with ConqueryConnection(url, check_connection=False, shared_polling=True, adaptive_limits=True,
+                                  retry_policy=RetryPolicy(attempts=1)) as cq:
+        for __ in range(2):
+            with pytest.raises(ConqueryServerError):
+                await asyncio.wait_for(cq.wait_for_query('demo', 'demo.query'), timeout=5)
+
+
+def test_connection_rejects_unknown_limits():
+    with pytest.raises(ValueError):
+        ConqueryConnection("http://localhost", adaptive_limits={'upload': AdaptiveLimiter()})
@@ -0,0 +1,116 @@
+from aiohttp import web
+from cqapi import Backoff
+from cqapi import ConqueryConnection
+from cqapi.metrics import InMemoryMetrics, OpenTelemetryMetrics, PrometheusMetrics, endpoint, prometheus_client
+from cqapi.metrics import BODY_SECONDS, PARSE_SECONDS, POLLS, POLLS_PER_QUERY, QUERY_WAIT_SECONDS, REQUESTS
+from cqapi.metrics import CONNECT_SECONDS, PENDING_POLLS, TTFB_SECONDS, WIRE_BYTES
+import pytest
+
+
+no_delay = Backoff(initial=0, jitter=0)
+
+
+def test_endpoint_replaces_ids():
+    assert '/api/datasets/{id}/queries/{id}' == endpoint('http://localhost/api/datasets/demo/queries/demo.q1')
+    assert '/api/datasets/{id}/result/{id}' == endpoint('http://localhost/api/datasets/demo/result/demo.q1.csv')
+    assert '/api/datasets' == endpoint('http://localhost/api/datasets')
+
+
+def test_in_memory_metrics_aggregates_by_labels():
+    metrics = InMemoryMetrics()
+    metrics.increment(REQUESTS, labels={'method': 'GET', 'status': '200'})
+    metrics.increment(REQUESTS, 2, labels={'method': 'POST', 'status': '200'})
+    metrics.observe(TTFB_SECONDS, 0.5, {'method': 'GET'})
+    metrics.observe(TTFB_SECONDS, 1.5, {'method': 'GET'})
+    metrics.set(PENDING_POLLS, 3)
+    assert 3 == metrics.total(REQUESTS, status='200')
+    assert 1 == metrics.total(REQUESTS, method='GET')
+    assert 2 == metrics.count(TTFB_SECONDS) and 2.0 == metrics.total(TTFB_SECONDS)
+    assert [2, 2.0, 0.5, 1.5] == metrics.histograms[(TTFB_SECONDS, (('method', 'GET'),))]
+    assert 3 == metrics.value(PENDING_POLLS)
+    assert metrics.value(PENDING_POLLS, dataset='demo') is None
+
+
+def test_open_telemetry_metrics_records_with_instruments():
+    class Instrument(object):
+        def __init__(self, name, description):
+            self.name = name
+            self.values = []
+
+        def add(self, value, attributes=None):
+            self.values.append((value, attributes))
+
+        record = add
+
+    class Meter(object):
+        def __init__(self):
+            self.instruments = {}
+
+        def create(self, name, description=None):
+            self.instruments[name] = Instrument(name, description)
+            return self.instruments[name]
+
+        create_counter = create_histogram = create_up_down_counter = create
+
+    meter = Meter()
+    metrics = OpenTelemetryMetrics(meter)
+    metrics.increment(POLLS, labels={'dataset': 'demo'})
+    metrics.observe(TTFB_SECONDS, 0.25)
+    metrics.set(PENDING_POLLS, 3)
+    metrics.set(PENDING_POLLS, 1)
+    assert [(1, {'dataset': 'demo'})] == meter.instruments[POLLS].values
+    assert [(0.25, None)] == meter.instruments[TTFB_SECONDS].values
+    assert [(3, None), (-2, None)] == meter.instruments[PENDING_POLLS].values
+
+
+@pytest.mark.skipif(prometheus_client is not None, reason="prometheus_client is installed")
+def test_prometheus_metrics_require_prometheus_client():
+    with pytest.raises(ImportError):
+        PrometheusMetrics()
+
+
+async def start_server(serve, polls_until_done=2):
+    status_requests = []
+
+    async def execute(request):
+        return web.json_response({'id': 'demo.query'})
+
+    async def status(request):
+        status_requests.append(request.match_info['query_id'])
+        if len(status_requests) < polls_until_done:
+            return web.json_response({'id': 'demo.query', 'status': 'RUNNING'})
+        return web.json_response({'id': 'demo.query', 'status': 'DONE',
+                                  'resultUrl': str(request.url.with_path('/api/datasets/demo/result/demo.query.csv'))})
+
+    async def result(request):
+        return web.Response(body=b'result;count\n1;2\n3;4\n', content_type='text/csv')
+
+    return await serve(('POST', '/api/datasets/demo/queries', execute),
+                        ('GET', '/api/datasets/demo/queries/{query_id}', status),
+                        ('GET', '/api/datasets/demo/result/{query_id}', result))
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("shared_polling", [False, True])
+async def test_connection_records_metrics(shared_polling, serve):
+    metrics = InMemoryMetrics()
+    server = await start_server(serve, polls_until_done=3)
+    url = str(server.make_url('/'))
+    async with ConqueryConnection(url, check_connection=False, poll_backoff=no_delay, metrics=metrics,
+                                  shared_polling=shared_polling) as cq:
+        query_id = await cq.execute_query('demo', {'type': 'CONCEPT_QUERY'})
+        rows = await cq.get_query_result('demo', query_id)
+    assert [['result', 'count'], ['1', '2'], ['3', '4']] == rows
+
+    assert 1 == metrics.total(REQUESTS, method='POST', endpoint='/api/datasets/{id}/queries', status='200')
+    assert 3 == metrics.total(REQUESTS, method='GET', endpoint='/api/datasets/{id}/queries/{id}')
+    assert 1 == metrics.total(REQUESTS, endpoint='/api/datasets/{id}/result/{id}')
+    assert 5 == metrics.count(TTFB_SECONDS) == metrics.count(BODY_SECONDS)
+    assert 1 <= metrics.count(CONNECT_SECONDS)
+    assert len(b'result;count\n1;2\n3;4\n') == metrics.total(WIRE_BYTES, endpoint='/api/datasets/{id}/result/{id}')
+
+    assert 3 == metrics.total(POLLS, dataset='demo')
+    assert 3 == metrics.total(POLLS_PER_QUERY)
+    assert 1 == metrics.count(QUERY_WAIT_SECONDS, outcome='done')
+    assert 1 == metrics.count(PARSE_SECONDS, format='csv')
+    assert 4 == metrics.count(PARSE_SECONDS, format='json')
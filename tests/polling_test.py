@@ -0,0 +1,26 @@
+from cqapi.polling import Backoff
+import pytest
+
+
+def test_backoff_grows_exponentially_up_to_max_delay():
+    delays = Backoff(initial=1, factor=3, max_delay=20, jitter=0).delays()
+    assert [1, 3, 9, 20, 20, 20] == [next(delays) for _ in range(6)]
+
+
+def test_backoff_jitter_stays_within_bounds():
+    backoff = Backoff(initial=1, factor=2, max_delay=8, jitter=0.25)
+    for attempt in range(10):
+        expected = min(2 ** attempt, 8)
+        for _ in range(20):
+            assert expected * 0.75 <= backoff.delay(attempt) <= expected * 1.25
+
+
+def test_backoff_does_not_overflow():
+    delays = Backoff(initial=1, factor=10, max_delay=60, jitter=0).delays()
+    assert 60 == [next(delays) for _ in range(1000)][-1]
+
+
+@pytest.mark.parametrize("kwargs", [{"initial": -1}, {"max_delay": -1}, {"factor": 0.5}, {"jitter": 2}])
+def test_backoff_invalid_parameters(kwargs):
+    with pytest.raises(ValueError):
+        Backoff(**kwargs)
@@ -0,0 +1,49 @@
+from cqapi.results import CsvRowDecoder
+import pytest
+
+
+csv_body = 'result;dates\n999999999|VID000011;{2005-01-01/2005-01-01, 2005-04-01/2005-04-01}\n' \
+           '"quoted;id";"multi\nline ""label"""\nÄrztin;€\n'
+
+expected_rows = [
+    ['result', 'dates'],
+    ['999999999|VID000011', '{2005-01-01/2005-01-01, 2005-04-01/2005-04-01}'],
+    ['quoted;id', 'multi\nline "label"'],
+    ['Ärztin', '€']
+]
+
+
+def decode_in_chunks(body, chunk_size):
+    decoder = CsvRowDecoder()
+    rows = []
+    for i in range(0, len(body), chunk_size):
+        rows.extend(decoder.feed(body[i:i + chunk_size]))
+    rows.extend(decoder.close())
+    return rows
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 16, 1024])
+def test_decode_in_chunks(chunk_size):
+    assert expected_rows == decode_in_chunks(csv_body.encode('utf-8'), chunk_size)
+
+
+def test_decode_without_trailing_newline():
+    assert expected_rows == decode_in_chunks(csv_body.rstrip('\n').encode('utf-8'), 4)
+
+
+def test_decode_crlf_line_endings():
+    body = 'a;b\r\n1;2\r\n'.encode('utf-8')
+    assert [['a', 'b'], ['1', '2']] == decode_in_chunks(body, 3)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 1024])
+def test_decode_literal_quotes_in_unquoted_fields(chunk_size):
+    body = 'a"b;c\nd;e\n"f";g"h"\n"i""";"j\nk"l\n'.encode('utf-8')
+    assert [['a"b', 'c'], ['d', 'e'], ['f', 'g"h"'], ['i"', 'j\nkl']] == decode_in_chunks(body, chunk_size)
+
+
+def test_rows_are_emitted_before_close():
+    decoder = CsvRowDecoder()
+    assert [['a', 'b']] == decoder.feed(b'a;b\n1;')
+    assert [] == decoder.feed(b'2')
+    assert [['1', '2']] == decoder.close()
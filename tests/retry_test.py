@@ -0,0 +1,231 @@
+from aiohttp import ClientConnectionError
+from aiohttp import web
+from cqapi import Backoff
+from cqapi import CircuitOpenError
+from cqapi import ConqueryConnection
+from cqapi import ConqueryServerError
+from cqapi import InMemoryMetrics
+from cqapi import RetryPolicy
+from cqapi.metrics import BREAKER_REJECTIONS, BREAKER_STATE, RETRIES
+from cqapi.retry import CircuitBreaker
+import asyncio
+import pytest
+import time
+
+
+no_delay = Backoff(initial=0, jitter=0)
+
+
+def create_flaky_call(failures, result='ok'):
+    """ Coroutine function raising the given exceptions one call at a time, then returning result. """
+    calls = []
+    failures = list(failures)
+
+    async def call():
+        calls.append(None)
+        if failures:
+            raise failures.pop(0)
+        return result
+
+    return call, calls
+
+
+@pytest.mark.asyncio
+async def test_retry_policy_retries_get_requests():
+    metrics = InMemoryMetrics()
+    call, calls = create_flaky_call([ConqueryServerError("busy", 503), ClientConnectionError()])
+    policy = RetryPolicy(attempts=3, backoff=no_delay)
+    assert 'ok' == await policy.run(call, 'GET', 'http://conquery/api/datasets', metrics)
+    assert 3 == len(calls)
+    assert 1 == metrics.total(RETRIES, method='GET', error='ConqueryServerError')
+    assert 2 == metrics.total(RETRIES)
+
+    call, calls = create_flaky_call([ConqueryServerError("busy", 503)] * 3)
+    with pytest.raises(ConqueryServerError):
+        await policy.run(call, 'GET', 'http://conquery/api/datasets')
+    assert 3 == len(calls)
+
+
+@pytest.mark.asyncio
+async def test_retry_policy_retries_posts_only_if_enabled():
+    call, calls = create_flaky_call([ConqueryServerError("busy", 503)])
+    with pytest.raises(ConqueryServerError):
+        await RetryPolicy(backoff=no_delay).run(call, 'POST', 'http://conquery/api/datasets/demo/queries')
+    assert 1 == len(calls)
+
+    call, calls = create_flaky_call([ConqueryServerError("busy", 503)])
+    assert 'ok' == await RetryPolicy(backoff=no_delay, retry_posts=True).run(call, 'POST', 'http://conquery/q')
+    assert 2 == len(calls)
+
+
+@pytest.mark.asyncio
+async def test_retry_policy_does_not_retry_invalid_requests():
+    call, calls = create_flaky_call([ValueError("invalid query")])
+    with pytest.raises(ValueError):
+        await RetryPolicy(backoff=no_delay).run(call, 'GET', 'http://conquery/api/datasets')
+    assert 1 == len(calls)
+
+
+@pytest.mark.asyncio
+async def test_retry_policy_waits_for_retry_after():
+    call, calls = create_flaky_call([ConqueryServerError("busy", 429, retry_after=60)])
+    start = time.perf_counter()
+    await RetryPolicy(backoff=no_delay, max_retry_after=0.05).run(call, 'GET', 'http://conquery/api/datasets')
+    assert 0.05 <= time.perf_counter() - start < 1
+
+
+def test_circuit_breaker_opens_after_consecutive_failures():
+    metrics = InMemoryMetrics()
+    breaker = CircuitBreaker('conquery', failure_threshold=2, reset_timeout=0.05)
+    breaker.record(False, metrics)
+    breaker.record(True, metrics)
+    breaker.record(False, metrics)
+    assert CircuitBreaker.CLOSED == breaker.state
+    breaker.record(False, metrics)
+    assert CircuitBreaker.OPEN == breaker.state
+    assert 1 == metrics.value(BREAKER_STATE, host='conquery')
+    with pytest.raises(CircuitOpenError):
+        breaker.acquire(metrics)
+
+    # once the reset timeout elapsed, a single trial request is let through
+    time.sleep(0.05)
+    trial = breaker.acquire(metrics)
+    assert trial
+    assert 2 == metrics.value(BREAKER_STATE, host='conquery')
+    with pytest.raises(CircuitOpenError) as error:
+        breaker.acquire(metrics)
+    assert 'conquery' == error.value.host
+    assert 2 == metrics.total(BREAKER_REJECTIONS, host='conquery')
+    breaker.record(True, metrics, trial)
+    assert CircuitBreaker.CLOSED == breaker.state
+    assert 0 == metrics.value(BREAKER_STATE, host='conquery')
+
+
+def test_only_the_trial_request_closes_or_reopens_a_half_open_breaker():
+    breaker = CircuitBreaker('conquery', failure_threshold=1, reset_timeout=0.05)
+    admitted_before = breaker.acquire()
+    breaker.record(False)
+    assert CircuitBreaker.OPEN == breaker.state
+    time.sleep(0.05)
+    trial = breaker.acquire()
+    # requests admitted before the breaker opened finishing late do not decide the trial
+    breaker.record(True, trial=admitted_before)
+    assert CircuitBreaker.HALF_OPEN == breaker.state
+    breaker.record(False, trial=admitted_before)
+    assert CircuitBreaker.HALF_OPEN == breaker.state
+    with pytest.raises(CircuitOpenError):
+        breaker.acquire()
+    breaker.record(False, trial=trial)
+    assert CircuitBreaker.OPEN == breaker.state
+
+
+@pytest.mark.asyncio
+async def test_open_circuit_breaker_rejects_requests_to_its_host_only():
+    policy = RetryPolicy(attempts=1, failure_threshold=2, reset_timeout=60)
+    for __ in range(2):
+        call, __ = create_flaky_call([ClientConnectionError()])
+        with pytest.raises(ClientConnectionError):
+            await policy.run(call, 'GET', 'http://degraded:8080/api/datasets')
+    call, calls = create_flaky_call([])
+    with pytest.raises(CircuitOpenError):
+        await policy.run(call, 'GET', 'http://degraded:8080/api/datasets/demo/concepts')
+    assert [] == calls
+    assert 'ok' == await policy.run(call, 'GET', 'http://healthy:8080/api/datasets')
+
+
+async def start_failing_server(serve, failures):
+    """ Server answering the first `failures` requests with 503, and status requests always with 500. """
+    requests = []
+
+    async def datasets(request):
+        requests.append(request)
+        if len(requests) <= failures:
+            return web.Response(status=503, text="<html>Service Unavailable</html>")
+        return web.json_response([{'id': 'demo', 'label': 'Demo'}])
+
+    async def status(request):
+        return web.Response(status=500, text="Internal Server Error")
+
+    server = await serve(('GET', '/api/datasets', datasets),
+                         ('GET', '/api/datasets/demo/queries/{query_id}', status))
+    return str(server.make_url('/'))
+
+
+@pytest.mark.asyncio
+async def test_connection_retries_server_errors(serve):
+    url = await start_failing_server(serve, failures=2)
+    async with ConqueryConnection(url, retry_policy=RetryPolicy(backoff=no_delay)) as cq:
+        assert ['demo'] == await cq.get_datasets()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("shared_polling", [False, True])
+async def test_wait_fails_on_persistent_server_errors(shared_polling, serve):
+    url = await start_failing_server(serve, failures=0)
+    async with ConqueryConnection(url, check_connection=False, shared_polling=shared_polling,
+                                  retry_policy=RetryPolicy(backoff=no_delay)) as cq:
+        with pytest.raises(ConqueryServerError) as error:
+            await asyncio.wait_for(cq.wait_for_query('demo', 'demo.query'), 5)
+    assert 500 == error.value.status
+
+
+async def start_outage_server(serve, query_count, outage_seconds, query_seconds):
+    """ Server whose queries finish query_seconds after their execution, and whose status requests fail with 503 for
+    outage_seconds once all query_count queries were executed.
+    """
+    executions = {}
+    outage = []
+    cancelled = []
+
+    async def execute(request):
+        query_id = f"demo.q{len(executions)}"
+        executions[query_id] = time.monotonic()
+        return web.json_response({'id': query_id})
+
+    def unavailable():
+        if len(executions) == query_count and not outage:
+            outage.append(time.monotonic())
+        return outage and time.monotonic() - outage[0] < outage_seconds
+
+    def status_of(query_id):
+        return 'RUNNING' if time.monotonic() - executions[query_id] < query_seconds else 'DONE'
+
+    async def listing(request):
+        if unavailable():
+            return web.Response(status=503, text="Service Unavailable")
+        return web.json_response([{'id': query_id, 'status': status_of(query_id)} for query_id in executions])
+
+    async def status(request):
+        query_id = request.match_info['query_id']
+        if unavailable():
+            return web.Response(status=503, text="Service Unavailable")
+        response = {'id': query_id, 'status': status_of(query_id)}
+        if response['status'] == 'DONE':
+            response['resultUrl'] = str(request.url.with_path(f'/api/datasets/demo/result/{query_id}.csv'))
+        return web.json_response(response)
+
+    async def result(request):
+        return web.Response(text=f"result\n{request.match_info['query_id']}\n")
+
+    async def cancel(request):
+        cancelled.append(request.match_info['query_id'])
+        return web.Response()
+
+    server = await serve(('POST', '/api/datasets/demo/queries', execute),
+                         ('GET', '/api/datasets/demo/stored-queries', listing),
+                         ('GET', '/api/datasets/demo/queries/{query_id}', status),
+                         ('GET', '/api/datasets/demo/result/{query_id}.csv', result),
+                         ('POST', '/api/datasets/demo/queries/{query_id}/cancel', cancel))
+    return str(server.make_url('/')), cancelled
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("shared_polling", [False, True])
+async def test_execute_many_waits_out_short_outages(shared_polling, serve):
+    url, cancelled = await start_outage_server(serve, query_count=20, outage_seconds=0.4, query_seconds=0.6)
+    policy = RetryPolicy(backoff=Backoff(initial=0.2, factor=2, jitter=0), reset_timeout=0.05)
+    async with ConqueryConnection(url, check_connection=False, shared_polling=shared_polling, retry_policy=policy,
+                                  poll_backoff=Backoff(initial=0.01, max_delay=0.05, jitter=0)) as cq:
+        results = await cq.execute_many('demo', [{'query': i} for i in range(20)], max_concurrency=20, timeout=5)
+    assert [[['result'], [f"demo.q{i}"]] for i in range(20)] == sorted(results, key=lambda rows: int(rows[1][0][6:]))
+    assert [] == cancelled
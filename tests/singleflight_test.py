@@ -0,0 +1,88 @@
+from cqapi.singleflight import SingleFlight
+import asyncio
+import pytest
+
+
+def counting_call(result, delay=0.01):
+    calls = []
+
+    async def call():
+        calls.append(None)
+        await asyncio.sleep(delay)
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+    return call, calls
+
+
+@pytest.mark.asyncio
+async def test_concurrent_calls_are_coalesced():
+    flight = SingleFlight()
+    call, calls = counting_call("result")
+    results = await asyncio.gather(*[flight.do("key", call) for _ in range(10)])
+    assert ["result"] * 10 == results
+    assert 1 == len(calls)
+    assert (1, 9) == (flight.calls, flight.coalesced)
+    # finished calls are not shared anymore
+    await flight.do("key", call)
+    assert 2 == len(calls)
+
+
+@pytest.mark.asyncio
+async def test_kept_results_are_shared_until_forgotten():
+    flight = SingleFlight()
+    call, calls = counting_call("result")
+    await flight.do("key", call, keep=True)
+    await flight.do("key", call, keep=True)
+    assert 1 == len(calls)
+    flight.forget("key")
+    await flight.do("key", call, keep=True)
+    assert 2 == len(calls)
+
+
+@pytest.mark.asyncio
+async def test_failures_are_shared_but_not_kept():
+    flight = SingleFlight()
+    call, calls = counting_call(ValueError("failed"))
+    results = await asyncio.gather(*[flight.do("key", call, keep=True) for _ in range(3)], return_exceptions=True)
+    assert all(isinstance(result, ValueError) for result in results)
+    assert "key" not in flight
+
+
+@pytest.mark.asyncio
+async def test_cancelled_caller_does_not_cancel_others():
+    flight = SingleFlight()
+    call, calls = counting_call("result", delay=0.05)
+    first = asyncio.ensure_future(flight.do("key", call))
+    second = asyncio.ensure_future(flight.do("key", call))
+    await asyncio.sleep(0.01)
+    first.cancel()
+    assert "result" == await second
+
+
+@pytest.mark.asyncio
+async def test_call_is_cancelled_once_all_callers_are():
+    flight = SingleFlight()
+    call, calls = counting_call("result", delay=10)
+    callers = [asyncio.ensure_future(flight.do("key", call)) for _ in range(2)]
+    await asyncio.sleep(0.01)
+    callers[0].cancel()
+    await asyncio.sleep(0.01)
+    assert "key" in flight
+    callers[1].cancel()
+    await asyncio.gather(*callers, return_exceptions=True)
+    await asyncio.sleep(0)
+    assert "key" not in flight
+
+
+@pytest.mark.asyncio
+async def test_cancel_cancels_calls_in_flight():
+    flight = SingleFlight()
+    call, calls = counting_call("result", delay=10)
+    caller = asyncio.ensure_future(flight.do("key", call))
+    await asyncio.sleep(0.01)
+    await flight.cancel()
+    assert "key" not in flight
+    with pytest.raises(asyncio.CancelledError):
+        await caller
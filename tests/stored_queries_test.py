@@ -0,0 +1,83 @@
+from cqapi import ConqueryConnection
+from cqapi import StoredQueryMirror
+import asyncio
+import pytest
+
+
+base_url = "http://localhost:9085"
+
+
+def mock_stored_queries(mocker, listing, failing=()):
+    active = {"now": 0, "max": 0, "fetched": []}
+
+    async def mocked_get(__, url, **kwargs):
+        if url.endswith('/stored-queries'):
+            return listing
+        query_id = url.rsplit('/', 1)[-1]
+        active["now"] += 1
+        active["max"] = max(active["max"], active["now"])
+        await asyncio.sleep(0.001 * (hash(query_id) % 3))
+        active["now"] -= 1
+        active["fetched"].append(query_id)
+        if query_id in failing:
+            raise ConnectionError(query_id)
+        return {"id": query_id, "query": {"type": "CONCEPT_QUERY", "label": query_id}}
+
+    mocker.patch('cqapi.api.get', side_effect=mocked_get)
+    return active
+
+
+def create_listing(count, created_at="2019-08-05"):
+    return [{"id": f"q{i}", "label": f"Query {i}", "createdAt": created_at} for i in range(count)]
+
+
+@pytest.mark.asyncio
+async def test_iter_stored_queries_fetches_concurrently(mocker):
+    active = mock_stored_queries(mocker, [], failing=("q3",))
+    async with ConqueryConnection(base_url, check_connection=False) as cq:
+        results = dict([item async for item in cq.iter_stored_queries("demo", (f"q{i}" for i in range(20)),
+                                                                      max_concurrency=5)])
+    assert 5 == active["max"]
+    assert 20 == len(results)
+    assert {"type": "CONCEPT_QUERY", "label": "q7"} == results["q7"]
+    assert isinstance(results["q3"], ConnectionError)
+
+
+@pytest.mark.asyncio
+async def test_mirror_only_fetches_changed_queries(mocker, tmp_path):
+    path = str(tmp_path / "stored-queries.json")
+    listing = create_listing(10)
+    active = mock_stored_queries(mocker, listing)
+    async with ConqueryConnection(base_url, check_connection=False) as cq:
+        stats = await cq.mirror_stored_queries("demo", StoredQueryMirror(path))
+        assert {"fetched": 10, "unchanged": 0, "removed": 0} == stats
+
+        # one query relabeled, one deleted, one created
+        listing[2] = dict(listing[2], label="Renamed")
+        del listing[5]
+        listing.append({"id": "q10", "label": "Query 10", "createdAt": "2019-08-06"})
+        active["fetched"].clear()
+        mirror = StoredQueryMirror(path)
+        stats = await cq.mirror_stored_queries("demo", mirror)
+        assert {"fetched": 2, "unchanged": 8, "removed": 1} == stats
+        assert ["q10", "q2"] == sorted(active["fetched"])
+
+        # only changes of the given fields count
+        listing[0] = dict(listing[0], label="Renamed")
+        assert {"fetched": 0, "unchanged": 10, "removed": 0} == \
+            await cq.mirror_stored_queries("demo", mirror, change_fields=["createdAt"])
+
+    assert 10 == len(StoredQueryMirror(path))
+    assert "q5" not in StoredQueryMirror(path)
+    assert {"type": "CONCEPT_QUERY", "label": "q10"} == StoredQueryMirror(path).queries["q10"]
+
+
+@pytest.mark.asyncio
+async def test_mirror_uses_listed_definitions(mocker, tmp_path):
+    listing = [dict(entry, query={"type": "CONCEPT_QUERY"}) for entry in create_listing(3)]
+    active = mock_stored_queries(mocker, listing)
+    mirror = StoredQueryMirror(str(tmp_path / "stored-queries.json"))
+    async with ConqueryConnection(base_url, check_connection=False) as cq:
+        assert {"fetched": 3, "unchanged": 0, "removed": 0} == await cq.mirror_stored_queries("demo", mirror)
+    assert [] == active["fetched"]
+    assert {"type": "CONCEPT_QUERY"} == mirror.queries["q1"]
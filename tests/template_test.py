@@ -0,0 +1,69 @@
+from cqapi.template import Placeholder, QueryTemplate
+from cqapi.util import add_date_restriction_to_concept_query, concept_query_from_concept, create_relative_query
+from datetime import date
+import pytest
+
+
+concept = {"tables": [{"id": "table", "connectorId": "connector"}]}
+
+index_query = concept_query_from_concept(Placeholder("index_concept", "str"), concept)
+before_query = add_date_restriction_to_concept_query(concept_query_from_concept("before", concept), "before",
+                                                     "2000-01-01", "2000-12-31")
+relative_template = QueryTemplate(dict(create_relative_query(index_query, before_query, before_query, 0, 0),
+                                       timeCountBefore=Placeholder("before", "count"),
+                                       timeCountAfter=Placeholder("after", "count")))
+
+
+def test_instantiate_equals_query_built_from_scratch():
+    query = relative_template.instantiate(index_concept="index", before=4, after=2)
+    expected = create_relative_query(concept_query_from_concept("index", concept), before_query, before_query, 4, 2)
+    assert expected == query
+    assert list(expected) == list(query)
+
+
+def test_instances_share_only_static_parts():
+    first = relative_template.instantiate(index_concept="first", before=1, after=1)
+    second = relative_template.instantiate(index_concept="second", before=1, after=1)
+    assert ["first"] == first["query"]["root"]["ids"]
+    assert ["second"] == second["query"]["root"]["ids"]
+    assert first["features"] is second["features"]
+    assert first["query"]["root"]["tables"] is second["query"]["root"]["tables"]
+
+
+def test_grid_is_lazy_and_complete():
+    grid = relative_template.grid(index_concept=["a", "b"], before=range(1, 5), after=[1, 2, 3])
+    first = next(grid)
+    assert (["a"], 1, 1) == (first["query"]["root"]["ids"], first["timeCountBefore"], first["timeCountAfter"])
+    assert 2 * 4 * 3 - 1 == sum(1 for _ in grid)
+
+    values, query = next(relative_template.grid_values(index_concept=["b"], before=[3], after=[7]))
+    assert {"index_concept": "b", "before": 3, "after": 7} == values
+    assert 7 == query["timeCountAfter"]
+
+
+def test_date_placeholders():
+    template = QueryTemplate({"type": "DATE_RESTRICTION",
+                              "dateRange": {"min": Placeholder("start", "date"), "max": Placeholder("end", "date")},
+                              "child": concept_query_from_concept("c", concept)["root"]})
+    query = template.instantiate(start=date(2019, 1, 1), end="2019-12-31")
+    assert {"min": "2019-01-01", "max": "2019-12-31"} == query["dateRange"]
+
+
+@pytest.mark.parametrize("values", [
+    {"index_concept": 1, "before": 1, "after": 1},
+    {"index_concept": "a", "before": -1, "after": 1},
+    {"index_concept": "a", "before": 1},
+    {"index_concept": "a", "before": 1, "after": 1, "unknown": 1},
+])
+def test_invalid_values(values):
+    with pytest.raises(ValueError):
+        relative_template.instantiate(**values)
+
+
+def test_invalid_templates():
+    with pytest.raises(ValueError):
+        Placeholder("x", "unknown kind")
+    with pytest.raises(ValueError):
+        QueryTemplate([Placeholder("x", "str"), Placeholder("x", "count")])
+    static = {"type": "CONCEPT_QUERY"}
+    assert static is QueryTemplate(static).instantiate()
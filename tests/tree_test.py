@@ -0,0 +1,94 @@
+from cqapi.tree import QueryTransformer, rewrite, walk
+import pytest
+import sys
+
+
+def concept(concept_id):
+    return {"type": "CONCEPT", "ids": [concept_id], "tables": [{"id": "table"}]}
+
+
+query = {
+    "type": "CONCEPT_QUERY",
+    "root": {
+        "type": "AND",
+        "children": [
+            {"type": "OR", "children": [concept("a"), concept("b")]},
+            {"type": "NEGATION", "child": {"type": "DATE_RESTRICTION", "dateRange": {}, "child": concept("c")}}
+        ]
+    }
+}
+
+
+def rename(old, new):
+    def rename_node(node):
+        if node.get('type') == 'CONCEPT' and node.get('ids') == [old]:
+            return dict(node, ids=[new])
+        return node
+    return rename_node
+
+
+def test_rewrite_without_changes_returns_input():
+    assert query is rewrite(query, lambda node: node)
+
+
+def test_rewrite_copies_only_the_changed_path():
+    rewritten = rewrite(query, rename("c", "d"))
+    assert ["d"] == rewritten["root"]["children"][1]["child"]["child"]["ids"]
+    assert ["c"] == query["root"]["children"][1]["child"]["child"]["ids"]
+    assert rewritten["root"]["children"][0] is query["root"]["children"][0]
+    assert rewritten["root"]["children"][1] is not query["root"]["children"][1]
+
+
+def test_rewrite_visits_relative_form_query_fields():
+    relative_query = {"type": "RELATIVE_FORM_QUERY", "query": query, "features": [query], "outcomes": query}
+    rewritten = rewrite(relative_query, rename("a", "z"))
+    for root in (rewritten["query"], rewritten["features"][0], rewritten["outcomes"]):
+        assert ["z"] == root["root"]["children"][0]["children"][0]["ids"]
+
+
+def test_rewrite_unknown_type():
+    with pytest.raises(Exception) as e:
+        rewrite({"type": "AND", "children": [{"type": "SOMETHING"}]}, lambda node: node)
+    assert "Unknown type in query_object: SOMETHING" == str(e.value)
+
+
+def test_walk_visits_nodes_in_pre_order():
+    types = [node["type"] for node in walk(query)]
+    assert ["CONCEPT_QUERY", "AND", "OR", "CONCEPT", "CONCEPT", "NEGATION", "DATE_RESTRICTION", "CONCEPT"] == types
+
+
+def deeply_nested(depth):
+    node = concept("deep")
+    for _ in range(depth):
+        node = {"type": "NEGATION", "child": node}
+    return {"type": "CONCEPT_QUERY", "root": node}
+
+
+def test_deep_queries_exceed_recursion_limit():
+    depth = sys.getrecursionlimit() * 10
+    deep_query = deeply_nested(depth)
+    assert depth + 2 == sum(1 for _ in walk(deep_query))
+
+    rewritten = rewrite(deep_query, rename("deep", "deeper"))
+    node = rewritten["root"]
+    while node["type"] == "NEGATION":
+        node = node["child"]
+    assert ["deeper"] == node["ids"]
+
+
+def test_query_transformer_dispatches_by_node_type():
+    transformer = QueryTransformer()
+    transformer.register("CONCEPT", rename("a", "z"))
+
+    @transformer.register("OR")
+    def or_to_and(node):
+        return dict(node, type="AND")
+
+    transformed = transformer.transform(query)
+    assert "AND" == transformed["root"]["children"][0]["type"]
+    assert ["z"] == transformed["root"]["children"][0]["children"][0]["ids"]
+    assert transformed["root"]["children"][1] is query["root"]["children"][1]
+    assert "OR" == query["root"]["children"][0]["type"]
+
+    with pytest.raises(ValueError):
+        transformer.register("SOMETHING", lambda node: node)
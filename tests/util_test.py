@@ -375,3 +375,136 @@ def test_parse_iso_date_failures(param):
     expected_error = param.get('expected')
     with pytest.raises(expected_error):
         _parse_iso_date(input)
+
+
+concept_definitions = {
+    "tree": {
+        "label": "Tree",
+        "children": ["tree.child"],
+        "tables": [{"id": "tree.table", "connectorId": "tree.connector"},
+                   {"id": "other.table", "connectorId": "tree.other_connector"}],
+        "selects": [{"id": "tree.select.1"}, {"id": "tree.select.2"}]
+    },
+    "tree.child": {
+        "label": "Child",
+        "parent": "tree",
+        "children": []
+    },
+    "no_tables": {
+        "selects": [{"id": "no_tables.select"}]
+    }
+}
+
+
+def test_concept_index_lookups():
+    index = ConceptIndex(concept_definitions)
+    assert 3 == len(index)
+    assert "tree" in index
+    assert ["tree.select.1", "tree.select.2"] == index.selects["tree"]
+    assert ["tree.connector", "tree.other_connector"] == index.connectors["tree"]
+    assert "no_tables" not in index.connectors
+    assert "tree" == index.parents["tree.child"]
+    assert "no_tables" == index.select_owners["no_tables.select"]
+    assert ["tree.child"] == index.children("tree")
+
+
+def test_concept_index_from_get_concept_list():
+    concept_list = [dict(attrs, ids=[concept_id]) for concept_id, attrs in concept_definitions.items()]
+    assert ConceptIndex(concept_definitions).selects == ConceptIndex(concept_list).selects
+    assert ConceptIndex(concept_definitions).parents == ConceptIndex(concept_list).parents
+
+
+def test_helpers_accept_concept_index():
+    index = ConceptIndex(concept_definitions)
+    assert selects_per_concept(concept_definitions) == selects_per_concept(index)
+    assert concept_query_from_concept("tree", concept_definitions["tree"]) == concept_query_from_concept("tree", index)
+    with pytest.raises(KeyError):
+        concept_query_from_concept("no_tables", index)
+    with pytest.raises(KeyError):
+        concept_query_from_concept("unknown", index)
+
+
+def test_rewrites_do_not_modify_input_and_share_untouched_subtrees():
+    original = copy.deepcopy(query_with_concept_and_preexisting_selects)
+    enriched_query = add_selects_to_concept_query(query_with_concept_and_preexisting_selects, target_concept_id,
+                                                  [select_id])
+    assert original == query_with_concept_and_preexisting_selects
+    # the OR branch does not contain the target concept and is shared
+    assert enriched_query['root']['children'][0] is query_with_concept_and_preexisting_selects['root']['children'][0]
+    assert enriched_query['root']['children'][1] is not query_with_concept_and_preexisting_selects['root']['children'][1]
+
+    restricted_query = add_date_restriction_to_concept_query(query_with_concept, "other.id", "2000-01-01", "2000-12-31")
+    assert restricted_query['root']['children'][1] is query_with_concept['root']['children'][1]
+
+    combined = add_subquery_to_concept_query(query_with_concept, query_without_concept)
+    assert query_with_concept['root'] is not combined['root']
+    assert 2 == len(query_with_concept['root']['children'])
+    assert query_without_concept['root'] == combined['root']['children'][-1]
+
+
+def test_add_selects_to_relative_query():
+    concept_query = concept_query_from_concept("tree", concept_definitions["tree"])
+    relative_query = create_relative_query(concept_query, concept_query, {"type": "AND", "children": []}, 1, 1)
+    enriched_query = add_selects_to_concept_query(relative_query, "tree", ["tree.select.1"])
+    assert ["tree.select.1"] == enriched_query['query']['root']['selects']
+    assert ["tree.select.1"] == enriched_query['features']['root']['selects']
+    assert 'selects' not in concept_query['root']
+
+
+def apply_edits_one_by_one(query, edits):
+    for edit in edits:
+        if type(edit) is AddSelects:
+            query = add_selects_to_concept_query(query, *edit)
+        elif type(edit) is AddDateRestriction:
+            query = add_date_restriction_to_concept_query(query, *edit)
+        elif type(edit) is AddSubquery:
+            query = add_subquery_to_concept_query(query, edit.subquery)
+    return query
+
+
+multi_id_query = {
+    "type": "CONCEPT_QUERY",
+    "root": {
+        "type": "OR",
+        "children": [
+            {"type": "CONCEPT", "ids": ["other.id", target_concept_id], "tables": []},
+            {"type": "NEGATION", "child": {"type": "CONCEPT", "ids": ["yet_another.id"], "tables": []}}
+        ]
+    }
+}
+
+
+@pytest.mark.parametrize("query", [query_with_concept, query_with_concept_and_preexisting_selects, query_with_daterange,
+                                   multi_id_query])
+def test_apply_edits_equals_edits_one_by_one(query):
+    edits = [
+        AddSelects(target_concept_id, ["select.1"]),
+        AddDateRestriction(target_concept_id, "2000-01-01", "2000-12-31"),
+        AddSelects("other.id", ["other.select"]),
+        AddSubquery(query_without_concept),
+        AddDateRestriction("other.id", date(2001, 1, 1), date(2001, 6, 30)),
+        AddSelects(target_concept_id, ["select.2", "select.3"]),
+        AddDateRestriction(target_concept_id, "2002-01-01", "2002-12-31"),
+        AddSelects("yet_another.id", ["yet_another.select"]),
+        AddSubquery(query_with_concept)
+    ]
+    original = copy.deepcopy(query)
+    assert apply_edits_one_by_one(query, edits) == apply_edits(query, edits)
+    assert original == query
+
+
+def test_apply_edits_edits_subqueries_added_before():
+    edits = [AddSubquery(query_with_concept), AddSelects(target_concept_id, ["select.1"])]
+    edited = apply_edits(query_without_concept, edits)
+    assert apply_edits_one_by_one(query_without_concept, edits) == edited
+    assert query_with_concept['root'] != edited['root']['children'][-1]
+
+
+def test_apply_edits_validates_edits():
+    with pytest.raises(ValueError):
+        apply_edits(query_with_concept, [AddDateRestriction(target_concept_id, "2019-02-18", "1992-02-18")])
+    with pytest.raises(Exception):
+        apply_edits(query_with_concept, [AddSelects(target_concept_id, "not a list")])
+    with pytest.raises(TypeError):
+        apply_edits(query_with_concept, [("selects", target_concept_id, [])])
+    assert query_with_concept is apply_edits(query_with_concept, [])